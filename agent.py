@@ -1,17 +1,86 @@
 import os
 import re
 import json
-from discord.ext import commands
+import asyncio
+import logging
+from typing import AsyncIterator, Optional
+
+import httpx
 from tenacity import retry, stop_after_attempt, wait_exponential
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from metrics import LLM_TOKENS
+
+logger = logging.getLogger(__name__)
 
 OPENAI_MODEL = "gpt-4o"
 SYSTEM_PROMPT = "You are a helpful assistant."
 
+# Maximum number of chat completion requests in flight across every agent
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+# Keep-alive connections kept open in the shared HTTP pool
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", str(OPENAI_MAX_CONCURRENCY)))
+# Chat completions endpoint, e.g. a local llm_stub server for load testing (unset uses the OpenAI API)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+_shared_client: Optional[AsyncOpenAI] = None
+_shared_semaphore: Optional[asyncio.Semaphore] = None
+
+def get_shared_client() -> AsyncOpenAI:
+    """Return the process-wide async OpenAI client, creating it on first use.
+
+    Every agent shares this client so that all components reuse one pooled
+    set of HTTP connections instead of opening their own."""
+    global _shared_client
+    if _shared_client is None:
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONCURRENCY,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            )
+        )
+        _shared_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=OPENAI_BASE_URL, http_client=http_client)
+    return _shared_client
+
+def get_shared_semaphore() -> asyncio.Semaphore:
+    """Return the semaphore capping in-flight requests across every agent."""
+    global _shared_semaphore
+    if _shared_semaphore is None:
+        _shared_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+    return _shared_semaphore
+
+async def close_shared_client():
+    """Close the shared client and its connection pool."""
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.close()
+        _shared_client = None
+
 class OpenAIAgent:
-    def __init__(self):
-        OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
+    def __init__(self, client: Optional[AsyncOpenAI] = None, semaphore: Optional[asyncio.Semaphore] = None):
+        self.client = client or get_shared_client()
+        self.semaphore = semaphore or get_shared_semaphore()
+        self.usage = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+    def record_usage(self, usage):
+        """Add a response's token counts, including prompt tokens served from the provider's cache."""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        self.usage["requests"] += 1
+        self.usage["prompt_tokens"] += usage.prompt_tokens or 0
+        self.usage["cached_tokens"] += cached_tokens
+        self.usage["completion_tokens"] += usage.completion_tokens or 0
+        LLM_TOKENS.observe(usage.prompt_tokens or 0, "prompt")
+        LLM_TOKENS.observe(cached_tokens, "cached")
+        LLM_TOKENS.observe(usage.completion_tokens or 0, "completion")
+        logger.info(f"LLM usage: {usage.prompt_tokens} prompt tokens ({cached_tokens} cached), {usage.completion_tokens} completion tokens")
+
+    def usage_stats(self) -> dict:
+        stats = dict(self.usage)
+        stats["cached_ratio"] = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+        return stats
 
     def process_tool_call(self, message: str) -> list:
         matches = re.findall(r'<tool>(.*?)</tool>', message, re.DOTALL)
@@ -19,15 +88,51 @@ class OpenAIAgent:
         for match in matches:
             tool_calls.append(json.loads(match))
         return tool_calls
+
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     async def send_message(self, message: str, system_prompt: str = SYSTEM_PROMPT) -> str:
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": message},
         ]
-        response = self.client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=messages,
-        )
+        async with self.semaphore:
+            response = await self.client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+            )
+
+        self.record_usage(getattr(response, "usage", None))
+        return response.choices[0].message.content
+
+    async def stream_message(self, message: str, system_prompt: str = SYSTEM_PROMPT) -> AsyncIterator[str]:
+        """Yield the response text as it is generated.
+
+        Unlike `send_message` this is not retried, since part of the response
+        may already have been shown."""
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": message},
+        ]
+        async with self.semaphore:
+            stream = await self.client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            async for chunk in stream:
+                if chunk.usage:
+                    self.record_usage(chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
 
-        return response.choices[0].message.content        
\ No newline at end of file
+    async def stream_tool_calls(self, message: str, system_prompt: str = SYSTEM_PROMPT) -> AsyncIterator[dict]:
+        """Yield each tool call as soon as its closing tag has been generated."""
+        pending = ""
+        async for delta in self.stream_message(message, system_prompt):
+            pending += delta
+            while "</tool>" in pending:
+                block, pending = pending.split("</tool>", 1)
+                tool_calls = self.process_tool_call(block + "</tool>")
+                for tool_call in tool_calls:
+                    yield tool_call
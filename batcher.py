@@ -0,0 +1,98 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Set
+
+from discord import Message
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for more messages from the same channel before judging them (0 disables batching)
+MODERATION_BATCH_WINDOW = float(os.getenv("MODERATION_BATCH_WINDOW", "0"))
+# Largest number of messages judged in a single LLM request
+MODERATION_BATCH_MAX_SIZE = int(os.getenv("MODERATION_BATCH_MAX_SIZE", "10"))
+
+class ModerationBatcher:
+    """Groups messages from the same channel into batches for a single handler call.
+
+    A batch is flushed when `window` seconds have passed since its first message
+    or as soon as it reaches `max_batch_size` messages, so the added latency is
+    bounded by the window. `enqueue` returns as soon as the message is queued,
+    so callers such as ingest workers are free while the window is open, and
+    the batch is handled by a task of its own. `submit` resolves once the
+    batch holding the message has been handled."""
+
+    def __init__(self, handler: Callable[[List[Message]], Awaitable[object]], window: float = MODERATION_BATCH_WINDOW, max_batch_size: int = MODERATION_BATCH_MAX_SIZE):
+        self.handler = handler
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.pending: Dict[int, List[Message]] = {}  # Channel ID -> queued messages
+        self.waiters: Dict[int, asyncio.Future] = {}  # Channel ID -> future resolved when the batch is handled
+        self.timers: Dict[int, asyncio.Task] = {}  # Channel ID -> delayed flush task
+        self.flushing: Set[asyncio.Task] = set()  # Batches taken from `pending` and still being handled
+        self.batches_flushed = 0
+        self.messages_batched = 0
+
+    def enqueue(self, message: Message) -> asyncio.Future:
+        """Queue a message and return the future of the batch holding it without waiting for it."""
+        key = message.channel.id
+        if key not in self.pending:
+            self.pending[key] = []
+            waiter = self.waiters[key] = asyncio.get_running_loop().create_future()
+            # Errors are logged by _flush; nobody has to wait for the result
+            waiter.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.timers[key] = asyncio.create_task(self._flush_after(key))
+
+        self.pending[key].append(message)
+        waiter = self.waiters[key]
+
+        if len(self.pending[key]) >= self.max_batch_size:
+            self.timers.pop(key).cancel()
+            # Take the batch now so messages arriving before the task runs start the next one
+            task = asyncio.create_task(self._handle(key, *self._take(key)))
+            self.flushing.add(task)
+            task.add_done_callback(self.flushing.discard)
+        return waiter
+
+    async def submit(self, message: Message):
+        return await asyncio.shield(self.enqueue(message))
+
+    async def _flush_after(self, key: int):
+        await asyncio.sleep(self.window)
+        self.timers.pop(key, None)
+        task = asyncio.current_task()
+        self.flushing.add(task)
+        try:
+            await self._flush(key)
+        finally:
+            self.flushing.discard(task)
+
+    async def _flush(self, key: int):
+        await self._handle(key, *self._take(key))
+
+    def _take(self, key: int):
+        return self.pending.pop(key, []), self.waiters.pop(key)
+
+    async def _handle(self, key: int, batch: List[Message], waiter: asyncio.Future):
+        if not batch:
+            waiter.set_result(None)
+            return
+
+        self.batches_flushed += 1
+        self.messages_batched += len(batch)
+        logger.info(f"Flushing moderation batch of {len(batch)} messages for channel {key}")
+        try:
+            result = await self.handler(batch)
+        except Exception as e:
+            logger.error(f"Error handling moderation batch for channel {key}: {e}")
+            waiter.set_exception(e)
+        else:
+            waiter.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "batches_flushed": self.batches_flushed,
+            "messages_batched": self.messages_batched,
+            "pending_channels": len(self.pending),
+            "flushing": len(self.flushing),
+        }
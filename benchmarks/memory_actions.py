@@ -0,0 +1,126 @@
+"""Memory used per stored moderation action.
+
+Fills a Messages instance with synthetic actions and reports the bytes
+allocated per action, next to the previous representation: plain dataclasses
+with a __dict__, string IDs, a fresh copy of every name and two ModAction
+wrappers per action.
+
+    python -m benchmarks.memory_actions --actions 1000000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Optional
+
+from db import Storage
+from messages import Messages, Server, RetentionPolicy
+
+class NullStorage(Storage):
+    """Keeps everything in memory and persists nothing."""
+
+    def record(self, messages, record):
+        pass
+
+@dataclass
+class LegacyMessage:
+    content: str
+    server_id: str
+    server_name: str
+    user_id: str
+    user_name: str
+    channel_id: str
+    channel_name: str
+    message_id: str
+
+@dataclass
+class LegacyModAction:
+    action: str
+    message: LegacyMessage
+
+def copy(text: str) -> str:
+    """A new string equal to `text`, as json.load or string formatting would produce."""
+    return text[:1] + text[1:]
+
+def action_data(i: int, servers: int, users: int, channels: int) -> tuple:
+    server = i % servers
+    channel = i % channels
+    return (
+        server,
+        i % users,
+        {
+            "content": f"message {i}",
+            "server_id": 1_000_000 + server,
+            "server_name": f"Server {server}",
+            "user_name": f"user{i % users}",
+            "channel_id": 2_000_000 + channel,
+            "channel_name": f"channel-{channel}",
+            "message_id": 10**17 + i,
+        },
+    )
+
+def fill_current(count: int, servers: int, users: int, channels: int) -> Messages:
+    messages = Messages(storage=NullStorage())
+    for server in range(servers):
+        # Keep every action in memory so the whole history is measured
+        messages.servers[str(1_000_000 + server)] = Server(id=str(1_000_000 + server), name=f"Server {server}", rules="", recent_actions=[],
+                                                           retention=RetentionPolicy(hot_actions=count, hot_users=count))
+    for i in range(count):
+        _, user, data = action_data(i, servers, users, channels)
+        messages.add_mod_action("delete_message", data, str(3_000_000 + user))
+    return messages
+
+def fill_legacy(count: int, servers: int, users: int, channels: int) -> dict:
+    actions = {}  # Server ID -> user ID -> actions
+    recent = {}  # Server ID -> recent actions
+    for i in range(count):
+        server, user, data = action_data(i, servers, users, channels)
+        message = LegacyMessage(
+            content=data["content"],
+            server_id=str(data["server_id"]),
+            server_name=copy(data["server_name"]),
+            user_id=str(3_000_000 + user),
+            user_name=copy(data["user_name"]),
+            channel_id=str(data["channel_id"]),
+            channel_name=copy(data["channel_name"]),
+            message_id=str(data["message_id"]),
+        )
+        actions.setdefault(server, {}).setdefault(user, []).append(LegacyModAction(copy("delete_message"), message))
+        server_recent = recent.setdefault(server, [])
+        server_recent.append(LegacyModAction(copy("delete_message"), message))
+        recent[server] = server_recent[-20:]
+    return actions
+
+def measure(fill, count: int, servers: int, users: int, channels: int) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    state = fill(count, servers, users, channels)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del state
+    return allocated, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--actions", type=int, default=1_000_000)
+    parser.add_argument("--servers", type=int, default=10)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--channels", type=int, default=200)
+    parser.add_argument("--skip-legacy", action="store_true", help="Only measure the current representation")
+    args = parser.parse_args()
+
+    shape = (args.actions, args.servers, args.users, args.channels)
+    print(f"{args.actions} actions, {args.servers} servers, {args.users} users, {args.channels} channels")
+    current, elapsed = measure(fill_current, *shape)
+    print(f"current: {current / args.actions:7.1f} bytes/action, {current / 2**20:8.1f} MiB total, {elapsed:.1f}s")
+    if not args.skip_legacy:
+        legacy, elapsed = measure(fill_legacy, *shape)
+        print(f"legacy:  {legacy / args.actions:7.1f} bytes/action, {legacy / 2**20:8.1f} MiB total, {elapsed:.1f}s")
+        print(f"current uses {current / legacy:.0%} of the legacy memory")
+
+if __name__ == "__main__":
+    main()
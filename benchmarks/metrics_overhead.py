@@ -0,0 +1,82 @@
+"""Cost of the latency and counter instrumentation.
+
+Times the primitives the pipeline calls per message (a stage timer, a
+histogram observation, a counter increment, a decorated coroutine) against an
+empty loop, and estimates the overhead per moderated message from the number
+of each the pipeline records.
+
+    python -m benchmarks.metrics_overhead --iterations 1000000
+"""
+import argparse
+import asyncio
+import time
+
+from metrics import Registry, Counter, Histogram, Timer, timed
+
+# Metrics recorded while moderating one message with tool calls: total, context,
+# prompt, llm and tools stages, three token observations, and two tool calls
+TIMERS_PER_MESSAGE = 5
+OBSERVATIONS_PER_MESSAGE = 5
+INCREMENTS_PER_MESSAGE = 2
+
+def per_call(func, iterations: int) -> float:
+    """Seconds per call of `func`, minus the cost of the loop itself."""
+    def empty():
+        pass
+
+    def run(f):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            f()
+        return (time.perf_counter() - start) / iterations
+
+    return max(0.0, run(func) - run(empty))
+
+async def async_per_call(func, iterations: int) -> float:
+    async def empty():
+        pass
+
+    async def run(f):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await f()
+        return (time.perf_counter() - start) / iterations
+
+    return max(0.0, await run(func) - await run(empty))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    registry = Registry()
+    histogram = Histogram("benchmark_seconds", "Benchmark latency.", ("handler", "stage"), registry=registry)
+    counter = Counter("benchmark_total", "Benchmark counter.", ("action", "result"), registry=registry)
+
+    def stage_timer():
+        with Timer(histogram, ("moderate", "llm")):
+            pass
+
+    @timed("moderate", "llm")
+    async def decorated():
+        pass
+
+    timer = per_call(stage_timer, args.iterations)
+    observe = per_call(lambda: histogram.observe(0.2, "moderate", "llm"), args.iterations)
+    increment = per_call(lambda: counter.inc("send_dm", "ok"), args.iterations)
+    coroutine = asyncio.run(async_per_call(decorated, args.iterations))
+
+    print(f"{args.iterations} iterations")
+    print(f"stage timer:         {timer * 1e9:7.0f} ns")
+    print(f"histogram observe:   {observe * 1e9:7.0f} ns")
+    print(f"counter increment:   {increment * 1e9:7.0f} ns")
+    print(f"timed coroutine:     {coroutine * 1e9:7.0f} ns")
+    per_message = TIMERS_PER_MESSAGE * timer + OBSERVATIONS_PER_MESSAGE * observe + INCREMENTS_PER_MESSAGE * increment
+    print(f"per moderated message: {per_message * 1e6:.2f} us")
+
+    start = time.perf_counter()
+    rendered = registry.render()
+    print(f"render: {(time.perf_counter() - start) * 1e6:.0f} us for {len(rendered.splitlines())} lines")
+
+if __name__ == "__main__":
+    main()
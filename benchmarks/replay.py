@@ -0,0 +1,359 @@
+"""End-to-end throughput of the moderation pipeline.
+
+Replays synthetic (or recorded) guild traffic through Moderation the way
+on_message feeds it: each message is recorded into the channel buffer and
+submitted to the ingest queue. Discord is a fake bot whose guilds and
+channels count every API call, and the LLM is a local stub answering after a
+configurable latency with tool calls for the messages containing a marker,
+either in process or, with --llm-url, a running llm_stub server.
+Reports throughput, p50/p95/p99 latency per stage, Discord API calls per
+message and event loop lag. Calls that block the loop are reported with
+their location; --fail-on-stall exits with status 1 if there were any, so a
+change that brings blocking I/O back into the handlers fails the run.
+
+    python -m benchmarks.replay --messages 2000 --rate 200 --llm-latency 0.3
+
+A recorded trace is a JSONL file with one message per line, holding
+"guild_id", "channel_id", "author_id" and "content", and optionally
+"author_name" and "admin". The scheduler's rate limits apply as in
+production; set DISCORD_GLOBAL_RATE and friends to change them.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from functools import wraps
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional
+from unittest.mock import patch
+
+import discord
+from openai import AsyncOpenAI
+
+import agent
+from benchmarks.memory_actions import NullStorage
+from llm_stub import VIOLATION_MARKER, synthetic_reply
+from loop_monitor import LoopMonitor
+from messages import Messages
+from moderation import Moderation
+
+class DiscordCalls(Counter):
+    """Discord API calls made by the fakes, by endpoint."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+
+    async def call(self, endpoint: str):
+        self[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+class FakeUser:
+    def __init__(self, calls: DiscordCalls, user_id: int, name: str, admin: bool = False):
+        self.calls = calls
+        self.id = user_id
+        self.name = name
+        self.bot = False
+        self.guild_permissions = SimpleNamespace(administrator=admin)
+        self.dm_channel = None
+
+    async def create_dm(self):
+        await self.calls.call("create_dm")
+        self.dm_channel = FakeChannel(self.calls, self.id, f"dm-{self.name}")
+        return self.dm_channel
+
+class FakeChannel:
+    def __init__(self, calls: DiscordCalls, channel_id: int, name: str):
+        self.calls = calls
+        self.id = channel_id
+        self.name = name
+        self.sent: List[SimpleNamespace] = []  # Oldest first
+
+    async def history(self, limit: int = 100, **kwargs):
+        await self.calls.call("history")
+        for message in reversed(self.sent[-limit:]):
+            yield message
+
+    async def send(self, content: str):
+        await self.calls.call("send")
+
+    async def delete_messages(self, messages: list):
+        await self.calls.call("delete_messages")
+
+    def get_partial_message(self, message_id: int):
+        return SimpleNamespace(delete=lambda: self.calls.call("delete"))
+
+class FakeGuild:
+    def __init__(self, calls: DiscordCalls, guild_id: int, name: str):
+        self.calls = calls
+        self.id = guild_id
+        self.name = name
+        self.members: Dict[int, FakeUser] = {}
+
+    def get_member(self, user_id: int) -> Optional[FakeUser]:
+        return self.members.get(user_id)
+
+    async def ban(self, user):
+        await self.calls.call("ban")
+
+    async def kick(self, user):
+        await self.calls.call("kick")
+
+    async def unban(self, user):
+        await self.calls.call("unban")
+
+class FakeBot:
+    """The gateway cache of a bot that has seen every guild, channel and member of the replayed traffic."""
+
+    def __init__(self, calls: DiscordCalls):
+        self.calls = calls
+        self.guilds: Dict[int, FakeGuild] = {}
+        self.channels: Dict[int, FakeChannel] = {}
+        self.users: Dict[int, FakeUser] = {}
+        self.last_message_id = 0
+
+    def get_guild(self, guild_id: int) -> Optional[FakeGuild]:
+        return self.guilds.get(guild_id)
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channels.get(channel_id)
+
+    def get_user(self, user_id: int) -> Optional[FakeUser]:
+        return self.users.get(user_id)
+
+    async def fetch_user(self, user_id: int) -> FakeUser:
+        await self.calls.call("fetch_user")
+        return self.users[user_id]
+
+    def message(self, entry: dict) -> SimpleNamespace:
+        """A new message in the guild and channel of a traffic entry, creating them on first sight."""
+        guild_id, channel_id, author_id = int(entry["guild_id"]), int(entry["channel_id"]), int(entry["author_id"])
+        guild = self.guilds.get(guild_id) or self.guilds.setdefault(guild_id, FakeGuild(self.calls, guild_id, f"Server {guild_id}"))
+        channel = self.channels.get(channel_id) or self.channels.setdefault(channel_id, FakeChannel(self.calls, channel_id, f"channel-{channel_id}"))
+        author = guild.members.get(author_id)
+        if author is None:
+            author = FakeUser(self.calls, author_id, entry.get("author_name", f"user{author_id}"), bool(entry.get("admin")))
+            guild.members[author_id] = self.users[author_id] = author
+
+        # IDs must be current snowflakes, since deletions of old messages are not bulk deleted
+        self.last_message_id = max(self.last_message_id + 1, discord.utils.time_snowflake(datetime.now(timezone.utc)))
+        message = SimpleNamespace(
+            id=self.last_message_id,
+            content=entry["content"],
+            author=author,
+            channel=channel,
+            guild=guild,
+            reference=None,
+            mentions=[],
+        )
+        channel.sent.append(message)
+        return message
+
+class StubLLM:
+    """Stands in for AsyncOpenAI's chat completions without a server.
+
+    Answers after `latency` seconds, give or take `jitter`, with
+    llm_stub.synthetic_reply."""
+
+    def __init__(self, latency: float, jitter: float, actions: List[str], rng: random.Random):
+        self.latency = latency
+        self.jitter = jitter
+        self.actions = actions
+        self.rng = rng
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model: str, messages: list, stream: bool = False, **kwargs):
+        if stream:
+            raise NotImplementedError("Moderation does not stream responses")
+        await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+        prompt = "".join(m["content"] for m in messages)
+        content = synthetic_reply(messages[-1]["content"], self.actions)
+        usage = SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(content) // 4, prompt_tokens_details=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+def synthetic_traffic(count: int, guilds: int, channels: int, users: int, violation_rate: float, admin_rate: float, rng: random.Random) -> Iterator[dict]:
+    for i in range(count):
+        guild = rng.randrange(guilds)
+        user = rng.randrange(users)
+        if rng.random() < violation_rate:
+            content = f"{VIOLATION_MARKER} cheap followers at example.com, offer {i}"
+        else:
+            content = f"message {i} about topic {rng.randrange(100)}"
+        yield {
+            "guild_id": 1_000_000 + guild,
+            "channel_id": 2_000_000 + guild * channels + rng.randrange(channels),
+            "author_id": 3_000_000 + user,
+            "content": content,
+            "admin": rng.random() < admin_rate,
+        }
+
+def recorded_traffic(path: str) -> Iterator[dict]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+class StageTimings:
+    """Latencies in seconds, by pipeline stage."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage: str, func):
+        @wraps(func)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+async def replay(traffic: Iterator[dict], args) -> dict:
+    calls = DiscordCalls(args.discord_latency)
+    bot = FakeBot(calls)
+    if args.llm_url:
+        llm = AsyncOpenAI(api_key="stub", base_url=args.llm_url)
+    else:
+        llm = StubLLM(args.llm_latency, args.llm_jitter, args.tool_actions, random.Random(args.seed))
+    with patch.object(agent, "_shared_client", llm), patch.object(agent, "_shared_semaphore", None), \
+            patch.object(Messages, "load", return_value=Messages(storage=NullStorage())):
+        moderation = Moderation(bot, batch_window=args.batch_window)
+    monitor = LoopMonitor(threshold=args.lag_threshold)
+    monitor.start()
+
+    timings = StageTimings()
+    submitted: Dict[int, float] = {}
+    active = 0
+
+    moderation.get_message_context = timings.wrap("context", moderation.get_message_context)
+    moderation.agent.send_message = timings.wrap("llm", moderation.agent.send_message)
+    moderation.run_tool_calls = timings.wrap("tools", moderation.run_tool_calls)
+    handle = timings.wrap("handle", moderation.handle_message)
+
+    async def handle_and_record(message):
+        nonlocal active
+        active += 1
+        try:
+            await handle(message)
+        finally:
+            active -= 1
+            timings.add("end_to_end", time.perf_counter() - submitted.pop(message.id))
+
+    moderation.ingest.handler = handle_and_record
+
+    count = 0
+    start = time.perf_counter()
+    for entry in traffic:
+        if args.rate > 0:
+            delay = start + count / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        message = bot.message(entry)
+        submitted[message.id] = time.perf_counter()
+        # As on_message does
+        moderation.record_message(message)
+        if not moderation.ingest.submit(message):
+            submitted.pop(message.id)
+        count += 1
+        if args.rate <= 0 and count % 100 == 0:
+            # Let the workers run between bursts, as the gateway would
+            await asyncio.sleep(0)
+
+    def busy() -> bool:
+        # Batched messages are only judged once their window closes, after the ingest workers are done with them
+        batcher = moderation.batcher
+        if batcher is not None and (batcher.pending or batcher.timers or batcher.flushing):
+            return True
+        scheduler = moderation.scheduler.stats()
+        return bool(active or moderation.ingest.stats()["depth"] or scheduler["in_flight"] or any(scheduler["queue_depth"].values()))
+
+    while busy():
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    await moderation.ingest.stop()
+    await monitor.stop()
+    if args.llm_url:
+        await llm.close()
+
+    return {
+        "messages": count,
+        "handled": len(timings.samples.get("handle", [])),
+        "elapsed": elapsed,
+        "timings": timings.samples,
+        "discord_calls": dict(calls),
+        "llm_requests": moderation.agent.usage_stats()["requests"],
+        "stats": moderation.stats(),
+        "loop": monitor.stats(),
+    }
+
+def report(result: dict):
+    messages = result["messages"]
+    print(f"{messages} messages replayed, {result['handled']} handled in {result['elapsed']:.2f}s: {result['handled'] / result['elapsed']:.1f} messages/s")
+    print(f"{'stage':<12} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for stage in ("end_to_end", "handle", "context", "llm", "tools"):
+        samples = sorted(result["timings"].get(stage, []))
+        if not samples:
+            continue
+        print(f"{stage:<12} {len(samples):>7} " + " ".join(f"{percentile(samples, p) * 1000:>9.1f}" for p in (0.5, 0.95, 0.99)) + f" {samples[-1] * 1000:>9.1f}")
+
+    total_calls = sum(result["discord_calls"].values())
+    print(f"discord API calls: {total_calls} ({total_calls / messages:.3f} per message)")
+    for endpoint, calls in sorted(result["discord_calls"].items()):
+        print(f"  {endpoint:<16} {calls:>7} ({calls / messages:.3f} per message)")
+    print(f"LLM requests: {result['llm_requests']} ({result['llm_requests'] / messages:.3f} per message)")
+    ingest = result["stats"]["ingest"]
+    print(f"ingest: {ingest['dropped']} dropped, {ingest['coalesced']} coalesced, {ingest['errors']} errors")
+    loop = result["loop"]
+    print(f"event loop lag: {loop['avg_lag_ms']:.1f}ms avg, {loop['max_lag_ms']:.1f}ms max, {loop['stalls']} stalls")
+    for location, stalls in loop["top_stall_locations"]:
+        print(f"  {stalls:>5} at {location}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--trace", help="Replay a recorded JSONL trace instead of synthetic traffic")
+    parser.add_argument("--rate", type=float, default=0, help="Messages submitted per second (0 submits them as fast as possible)")
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--channels", type=int, default=5, help="Channels per guild")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--violation-rate", type=float, default=0.1, help="Fraction of synthetic messages the stub LLM acts on")
+    parser.add_argument("--admin-rate", type=float, default=0.0, help="Fraction of synthetic messages sent by admins")
+    parser.add_argument("--llm-url", help="Send LLM requests to a running llm_stub server, e.g. http://localhost:8089/v1")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Seconds the in-process stub LLM takes per request")
+    parser.add_argument("--llm-jitter", type=float, default=0.05, help="Seconds the stub LLM latency varies by, either way")
+    parser.add_argument("--tool-actions", default="delete_message,send_dm", help="Comma separated tool calls returned for a flagged message")
+    parser.add_argument("--discord-latency", type=float, default=0.0, help="Seconds each fake Discord API call takes")
+    parser.add_argument("--batch-window", type=float, default=0.0, help="Moderation batching window in seconds (0 disables batching)")
+    parser.add_argument("--lag-threshold", type=float, default=0.05, help="Event loop lag in seconds reported as a stall")
+    parser.add_argument("--fail-on-stall", action="store_true", help="Exit with status 1 if the event loop was blocked")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    args.tool_actions = [action for action in args.tool_actions.split(",") if action]
+
+    logging.disable(logging.WARNING)
+    rng = random.Random(args.seed)
+    if args.trace:
+        traffic = recorded_traffic(args.trace)
+    else:
+        traffic = synthetic_traffic(args.messages, args.guilds, args.channels, args.users, args.violation_rate, args.admin_rate, rng)
+    result = asyncio.run(replay(traffic, args))
+    report(result)
+    if args.fail_on_stall and result["loop"]["stalls"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,15 @@ import os
 import discord
 import logging
 import signal
-import sys
+import asyncio
 
 from discord.ext import commands
 from dotenv import load_dotenv
 from moderation import Moderation
-from summarizer import Summarizer
+from agent import close_shared_client
+from streaming import StreamingReply
+from metrics import stage, start_http_server, METRICS_PORT
+from loop_monitor import LoopMonitor, LOOP_LAG_THRESHOLD
 
 PREFIX = "!"
 
@@ -23,7 +26,14 @@ load_dotenv()
 # Create the bot with all intents
 # The message content and members intent must be enabled in the Discord Developer Portal for the bot to work.
 intents = discord.Intents.all()
-bot = commands.Bot(command_prefix=PREFIX, intents=intents)
+
+class ModerationBot(commands.Bot):
+    async def close(self):
+        """Close the gateway connection, then the shared OpenAI client's connection pool."""
+        await super().close()
+        await close_shared_client()
+
+bot = ModerationBot(command_prefix=PREFIX, intents=intents)
 
 # Import the Mistral agent from the agent.py file
 
@@ -32,26 +42,28 @@ token = os.getenv("DISCORD_TOKEN")
 
 moderation = Moderation(bot)
 
-# Initialize the summarizer
-summarizer = Summarizer()
+# Reuse the moderation summarizer so every component shares one LLM client
+summarizer = moderation.summarizer
+channel_summaries = moderation.channel_summaries
+# Runner of the /metrics endpoint, started once the bot is connected
+metrics_server = None
+# Logs calls that block the event loop, with their stack
+loop_monitor = LoopMonitor()
 # Handle graceful shutdown
 def signal_handler(sig, frame):
     """Handle SIGINT and SIGTERM signals to gracefully shut down the bot."""
     logger.info("Received shutdown signal, saving data and exiting...")
     
-    # Save messages state
+    # Save messages state, including changes still queued for the background writer
     try:
-        moderation.messages.save()
+        moderation.messages.flush()
         logger.info("Successfully saved messages state")
     except Exception as e:
         logger.error(f"Error saving messages state: {e}")
-    
-    # Close the bot
+
+    # Close the bot and the shared OpenAI client; bot.run returns once they are closed
     logger.info("Closing bot connection...")
-    bot.loop.create_task(bot.close())
-    
-    # Exit after a short delay
-    sys.exit(0)
+    asyncio.run_coroutine_threadsafe(bot.close(), bot.loop)
 
 # Register signal handlers
 signal.signal(signal.SIGINT, signal_handler)
@@ -67,6 +79,13 @@ async def on_ready():
     """
     logger.info(f"{bot.user} has connected to Discord!")
 
+    # on_ready fires again after reconnects; the endpoint is only started once
+    global metrics_server
+    if METRICS_PORT and metrics_server is None:
+        metrics_server = await start_http_server(METRICS_PORT)
+    if LOOP_LAG_THRESHOLD > 0:
+        loop_monitor.start()
+
 
 @bot.event
 async def on_message(message: discord.Message):
@@ -78,16 +97,15 @@ async def on_message(message: discord.Message):
     # Don't delete this line! It's necessary for the bot to process commands.
     await bot.process_commands(message)
 
+    # Keep the in-memory channel buffer current so context doesn't need a REST fetch
+    moderation.record_message(message)
+
     # Ignore messages from self or other bots to prevent infinite loops.
     if message.author.bot or message.content.startswith("!"):
         return
-        
-    if message.guild:
-        # sent to a server
-        await moderation.moderate(message)
-    else:
-        # sent to a user
-        await moderation.handle_user_conversation(message)
+
+    # Queue the message so a flood in one server cannot hold up the others
+    moderation.ingest.submit(message)
 
 # Commands
 @bot.command(name="ping", help="Pings the bot.")
@@ -99,34 +117,90 @@ async def ping(ctx, *, arg=None):
 
 @bot.command(name="summarize", help="Summarizes the last N messages in the current channel.")
 async def summarize(ctx, number: int = SUMMARY_MESSAGE_LIMIT):
-    # Fetch the last N messages from the channel, where N is defined by the user or defaults to SUMMARY_MESSAGE_LIMIT
-    messages = [message async for message in ctx.channel.history(limit=number)]
+    header = f"Summary of the last {number} messages:\n"
+    # Reply at once, then fill the summary in as it is generated
+    reply = StreamingReply(ctx)
+    await reply.start(header)
+
+    # Answer from the channel's cached summary, brought up to date with the messages sent since
+    with stage("summarize", "cache"):
+        segments = await channel_summaries.latest(ctx.channel, number)
+    if segments is not None:
+        # Segments are cached whole, so say how many messages they actually cover
+        covered = sum(segment.message_count for segment in segments)
+        if covered != number:
+            header = f"Summary of the last {covered} messages:\n"
+        with stage("summarize", "llm"):
+            await reply.stream(header, channel_summaries.stream(segments))
+        return
 
-    # Generate a summary
-    summary = await summarizer.summarize_messages(messages)
+    # Fetch the last N messages from the channel, where N is defined by the user or defaults to SUMMARY_MESSAGE_LIMIT
+    with stage("summarize", "history"):
+        messages = [message async for message in ctx.channel.history(limit=number)]
 
-    # Send the summary back to the channel
-    await ctx.send(f"Summary of the last {number} messages:\n{summary}")
+    # Generate the summary, editing the reply as it streams in
+    # History is newest first; the summarizer expects the oldest message first
+    with stage("summarize", "llm"):
+        text = await reply.stream(header, summarizer.stream_summary(messages[::-1]))
+    channel_summaries.seed(ctx.channel.id, messages[::-1], text[len(header):])
 
 @bot.command(name="summarize_unread", help="Summarizes unread messages in the current channel.")
 async def summarize_unread(ctx):
+    last_read_id = await moderation.messages.get_last_read(ctx.author.id, ctx.channel.id)
+    header = "Summary of unread messages:\n"
+
+    # Answer from the channel's cached summary segments when they reach back to the last read message
+    with stage("summarize_unread", "cache"):
+        segments = await channel_summaries.since(ctx.channel, last_read_id) if last_read_id else None
+    if segments is not None:
+        if not segments:
+            await ctx.send("No unread messages to summarize.")
+            return
+        reply = StreamingReply(ctx)
+        await reply.start(header)
+        with stage("summarize_unread", "llm"):
+            await reply.stream(header, channel_summaries.stream(segments))
+        moderation.messages.update_last_read(ctx.author.id, ctx.channel.id, channel_summaries.get(ctx.channel.id).last_message_id, guild_id=ctx.guild.id if ctx.guild else None)
+        return
+
     # Get unread messages for the user in the current channel
-    unread_messages = await moderation.get_unread_messages(ctx.author.id, ctx.channel.id, ctx.message)
+    with stage("summarize_unread", "history"):
+        unread_messages = await moderation.get_unread_messages(ctx.author.id, ctx.channel.id, ctx.message)
 
     if not unread_messages:
         await ctx.send("No unread messages to summarize.")
         return
 
-    # Generate a summary
-    summary = await summarizer.summarize_messages(unread_messages)
-
-    # Send the summary back to the channel
-    await ctx.send(f"Summary of unread messages:\n{summary}")
+    # Generate the summary, editing the reply as it streams in
+    reply = StreamingReply(ctx)
+    await reply.start(header)
+    with stage("summarize_unread", "llm"):
+        text = await reply.stream(header, summarizer.stream_summary(unread_messages))
+    channel_summaries.seed(ctx.channel.id, unread_messages, text[len(header):], after_id=last_read_id)
 
     # Update the last read message for the user
-    if unread_messages:
-        last_message_id = unread_messages[0].id
-        moderation.messages.update_last_read(ctx.author.id, ctx.channel.id, last_message_id)
+    last_message_id = unread_messages[-1].id
+    moderation.messages.update_last_read(ctx.author.id, ctx.channel.id, last_message_id, guild_id=ctx.guild.id if ctx.guild else None)
+
+@bot.command(name="retention", help="Shows or sets how much moderation history this server keeps: !retention [hot actions per user] [archive days, 0 to keep forever].")
+@commands.has_permissions(administrator=True)
+@commands.guild_only()
+async def retention(ctx, hot_actions: int = None, archive_days: int = None):
+    if (hot_actions is not None and hot_actions < 0) or (archive_days is not None and archive_days < 0):
+        await ctx.send("Retention values cannot be negative.")
+        return
+    moderation.messages.ensure_server_exists(ctx.message)
+    changes = {}
+    if hot_actions is not None:
+        changes["hot_actions"] = hot_actions
+    if archive_days is not None:
+        changes["archive_days"] = archive_days
+    if changes:
+        moderation.messages.set_retention(ctx.guild.id, **changes)
+
+    policy = moderation.messages.servers[str(ctx.guild.id)].retention
+    archive = f"{policy.archive_days} days" if policy.archive_days else "forever"
+    await ctx.send(f"Keeping the last {policy.hot_actions} actions per user in memory for up to {policy.hot_users} users; archived actions are kept {archive}.")
 
 # Start the bot, connecting it to the gateway
 bot.run(token)
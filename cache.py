@@ -0,0 +1,194 @@
+import os
+import re
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from discord import Message
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# Cached moderation verdicts kept before the least recently used one is dropped
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", "10000"))
+# Seconds a cached moderation verdict stays valid
+VERDICT_CACHE_TTL = float(os.getenv("VERDICT_CACHE_TTL", "600"))
+
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Cache lookups, by cache and whether they hit.", ("cache", "result"))
+
+_MISSING = object()
+
+class TTLCache:
+    """Least-recently-used cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, max_entries: int, ttl: float, name: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.name = name  # Label of the cache's lookups on /metrics, or None to not export them
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()  # Key -> (expiry, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.entries.get(key, _MISSING)
+        if entry is _MISSING or entry[0] < time.monotonic():
+            if entry is not _MISSING:
+                del self.entries[key]
+            self.misses += 1
+            if self.name is not None:
+                CACHE_LOOKUPS.inc(self.name, "miss")
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        if self.name is not None:
+            CACHE_LOOKUPS.inc(self.name, "hit")
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.entries.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+def normalize_content(content: str) -> str:
+    """Normalize message content so trivially different copies share a cache key."""
+    content = re.sub(r"[\u200b-\u200f\u2060\ufeff]", "", content)
+    return " ".join(content.casefold().split())
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class VerdictCache:
+    """Caches the tool calls returned for a message, keyed by its normalized content
+    and the server's rules.
+
+    Plans are stored as templates: fields holding the IDs, author name or
+    content of the message that produced them, and the author's name in free
+    text, are replaced with placeholders and filled in with the new message's
+    values on a hit. Plans holding any other ID, such as a deletion of an
+    earlier message, are not cached."""
+
+    def __init__(self, max_entries: int = VERDICT_CACHE_SIZE, ttl: float = VERDICT_CACHE_TTL):
+        self.cache = TTLCache(max_entries, ttl, name="verdicts")
+
+    def key(self, message: Message, rules: str) -> tuple:
+        return (str(message.guild.id), _digest(rules), _digest(normalize_content(message.content)))
+
+    def get(self, message: Message, rules: str) -> Optional[list]:
+        template = self.cache.get(self.key(message, rules))
+        if template is None:
+            return None
+        return _from_template(template, message)
+
+    def put(self, message: Message, rules: str, tool_calls: list):
+        if any(tool_call.get("action") == "update_server_rules" for tool_call in tool_calls):
+            return
+        template = _to_template(tool_calls, message)
+        if _references_other_ids(template):
+            # The plan acts on another message or user from the context, which a copy would act on again
+            return
+        self.cache.put(self.key(message, rules), template)
+
+    def invalidate_server(self, server_id: str):
+        # Rules change rarely, so the cache is scanned rather than keeping an index of each server's keys
+        server_id = str(server_id)
+        for key in [key for key in self.cache.entries if key[0] == server_id]:
+            self.cache.pop(key)
+        logger.info(f"Invalidated cached verdicts for server {server_id}")
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+# Tool call fields holding a value of the judged message; only whole values are templated
+TEMPLATED_FIELDS = ("content", "message_id", "user_id", "channel_id", "server_id", "user_name", "channel_name")
+# Templated fields holding Discord IDs; a plan is only cached if all of them are the judged message's
+ID_FIELDS = ("message_id", "user_id", "channel_id", "server_id")
+# Author names shorter than this are not templated inside free text, where they would match ordinary words
+MIN_TEMPLATED_NAME = 3
+
+def _placeholder(field: str) -> str:
+    # NUL never appears in Discord text, so a placeholder cannot collide with what the LLM wrote
+    return f"\x00{field}\x00"
+
+def _message_values(message: Message) -> dict[str, Optional[str]]:
+    return {
+        "content": message.content,
+        "message_id": str(message.id),
+        "user_id": str(message.author.id),
+        "channel_id": str(message.channel.id),
+        "server_id": str(message.guild.id),
+        "user_name": message.author.name,
+        "channel_name": getattr(message.channel, "name", None),
+    }
+
+def _to_template(value: Any, message: Message) -> Any:
+    """Replace the message's values in tool calls with placeholders.
+
+    A field named in TEMPLATED_FIELDS is replaced only when its whole value is
+    the message's. In other text, such as a DM, only the author's name is
+    replaced, and only as a whole word."""
+    values = _message_values(message)
+    name = message.author.name
+    name_pattern = re.compile(rf"(?<!\w){re.escape(name)}(?!\w)") if len(name) >= MIN_TEMPLATED_NAME else None
+
+    def template(value: Any, field: Optional[str]) -> Any:
+        if isinstance(value, dict):
+            return {k: template(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [template(v, None) for v in value]
+        if field in values and values[field] is not None and str(value) == values[field]:
+            return _placeholder(field)
+        if isinstance(value, str) and name_pattern is not None:
+            return name_pattern.sub(lambda match: _placeholder("user_name"), value)
+        return value
+
+    return template(value, None)
+
+def _references_other_ids(template: Any) -> bool:
+    """Whether a templated plan still holds an ID that is not the judged message's."""
+    if isinstance(template, dict):
+        return any(
+            (field in ID_FIELDS and value is not None and value != _placeholder(field)) or _references_other_ids(value)
+            for field, value in template.items()
+        )
+    if isinstance(template, list):
+        return any(_references_other_ids(value) for value in template)
+    return False
+
+def _from_template(value: Any, message: Message) -> Any:
+    """Fill the placeholders left by `_to_template` with the new message's values."""
+    values = _message_values(message)
+    whole = {_placeholder(field): value for field, value in values.items()}
+    name_placeholder = _placeholder("user_name")
+
+    def fill(value: Any) -> Any:
+        if isinstance(value, dict):
+            return {k: fill(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [fill(v) for v in value]
+        if isinstance(value, str):
+            if value in whole:
+                return whole[value]
+            return value.replace(name_placeholder, values["user_name"])
+        return value
+
+    return fill(value)
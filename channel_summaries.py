@@ -0,0 +1,144 @@
+import os
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional
+
+import discord
+
+from messages import Messages, ChannelSummary, SummarySegment
+from summarizer import Summarizer
+
+logger = logging.getLogger(__name__)
+
+# Messages a summary segment covers before new messages start the next segment
+SUMMARY_SEGMENT_MESSAGES = int(os.getenv("SUMMARY_SEGMENT_MESSAGES", "50"))
+# Newest messages fetched when bringing a channel's summary up to date
+SUMMARY_DELTA_LIMIT = int(os.getenv("SUMMARY_DELTA_LIMIT", "500"))
+
+class ChannelSummaries:
+    """Rolling per-channel summaries kept up to date from the messages sent since the last one.
+
+    A channel's summary is a list of segments, oldest first, each covering a
+    run of consecutive messages. New messages are folded into the newest
+    segment until it covers `segment_messages` messages, after which they
+    start a new segment. Requests are answered from the cached segments, so
+    only the messages sent since the last request are sent to the LLM. A
+    summary is never extended past messages it could not fetch. Bot
+    messages, including the summaries themselves, and bot commands are left
+    out."""
+
+    def __init__(self, summarizer: Summarizer, messages: Messages, segment_messages: int = SUMMARY_SEGMENT_MESSAGES, delta_limit: int = SUMMARY_DELTA_LIMIT, command_prefix: str = "!"):
+        self.summarizer = summarizer
+        self.messages = messages
+        self.segment_messages = segment_messages
+        self.delta_limit = delta_limit
+        self.command_prefix = command_prefix
+        self.locks: Dict[str, asyncio.Lock] = {}  # Channel ID -> lock, so one refresh per channel runs at a time
+        self.hits = 0
+        self.misses = 0
+        self.folds = 0
+        self.segments_started = 0
+        self.gaps = 0
+
+    def summarized(self, message) -> bool:
+        return not message.author.bot and not message.content.startswith(self.command_prefix)
+
+    def get(self, channel_id) -> Optional[ChannelSummary]:
+        return self.messages.channel_summaries.get(str(channel_id))
+
+    async def refresh(self, channel, needed: Optional[int] = None) -> Optional[ChannelSummary]:
+        """Fold the messages sent since the cached summary into it. Channels without one are left alone.
+
+        If more than `delta_limit` messages were sent since, the ones in between
+        cannot be fetched, so the cached summary is dropped instead of skipping
+        past them. With `needed`, nothing is folded and None is returned unless
+        the summary would then cover at least `needed` messages."""
+        channel_id = str(channel.id)
+        lock = self.locks.setdefault(channel_id, asyncio.Lock())
+        async with lock:
+            state = self.get(channel_id)
+            if state is None:
+                return None
+            # One message past the limit shows whether any were left out
+            fetched = [message async for message in channel.history(limit=self.delta_limit + 1, after=discord.Object(id=state.last_message_id), oldest_first=False)]
+            if len(fetched) > self.delta_limit:
+                logger.warning(f"More than {self.delta_limit} messages in channel {channel_id} since its last summary, dropping it")
+                self.messages.drop_channel_summary(channel_id)
+                self.gaps += 1
+                return None
+            delta = [message for message in fetched if self.summarized(message)]
+            if needed is not None and sum(segment.message_count for segment in state.segments) + len(delta) < needed:
+                return None
+            if not delta:
+                return state
+            delta.reverse()
+
+            last = state.segments[-1] if state.segments else None
+            if last is not None and last.message_count + len(delta) <= self.segment_messages:
+                summary = await self.summarizer.fold_summary(last.summary, delta)
+                segment = SummarySegment(last.first_message_id, delta[-1].id, last.message_count + len(delta), summary)
+                self.messages.add_summary_segment(channel_id, segment, replace_last=True)
+                self.folds += 1
+            else:
+                summary = await self.summarizer.summarize_messages(delta)
+                self.messages.add_summary_segment(channel_id, SummarySegment(delta[0].id, delta[-1].id, len(delta), summary))
+                self.segments_started += 1
+            return state
+
+    def seed(self, channel_id, messages: list, summary: str, after_id: Optional[int] = None):
+        """Start a channel's cached summary from a summary of `messages`, oldest first, unless it has one.
+
+        `after_id` is the message the summarized ones were fetched after, if
+        any, so the segment also answers requests for everything after it."""
+        messages = [message for message in messages if self.summarized(message)]
+        if not messages or self.get(channel_id) is not None:
+            return
+        first_message_id = after_id + 1 if after_id is not None else messages[0].id
+        self.messages.add_summary_segment(str(channel_id), SummarySegment(first_message_id, messages[-1].id, len(messages), summary))
+        self.segments_started += 1
+
+    async def latest(self, channel, count: int) -> Optional[List[SummarySegment]]:
+        """The newest segments covering at least the last `count` messages, or None if the cache does not reach back that far.
+
+        Segments are returned whole, so they may cover more than `count` messages."""
+        state = await self.refresh(channel, needed=count)
+        segments = []
+        covered = 0
+        for segment in reversed(state.segments if state else []):
+            segments.append(segment)
+            covered += segment.message_count
+            if covered >= count:
+                self.hits += 1
+                return segments[::-1]
+        self.misses += 1
+        return None
+
+    async def since(self, channel, after_id: int) -> Optional[List[SummarySegment]]:
+        """The segments covering every message after `after_id`, or None if the cache does not reach back that far.
+
+        A segment that starts before `after_id` is returned whole."""
+        # Check coverage before fetching and folding the messages sent since
+        state = self.get(channel.id)
+        if state is None or not state.segments or state.segments[0].first_message_id > after_id + 1:
+            self.misses += 1
+            return None
+        state = await self.refresh(channel)
+        if state is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [segment for segment in state.segments if segment.last_message_id > after_id]
+
+    def stream(self, segments: List[SummarySegment]) -> AsyncIterator[str]:
+        """Yield one summary of the given segments, oldest first."""
+        return self.summarizer.stream_combined([segment.summary for segment in segments])
+
+    def stats(self) -> dict:
+        return {
+            "channels": len(self.messages.channel_summaries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "folds": self.folds,
+            "segments_started": self.segments_started,
+            "gaps": self.gaps,
+        }
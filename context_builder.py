@@ -0,0 +1,105 @@
+import os
+import logging
+from typing import Iterable, List, Optional
+
+from discord import Message
+
+from message_buffer import BufferedMessage
+
+logger = logging.getLogger(__name__)
+
+# Tokens of channel history included in each prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "800"))
+# Relevance bonus for the newest message in the window, scaled down linearly for older ones
+CONTEXT_RECENCY_WEIGHT = 3.0
+# Relevance bonuses for messages connected to the one being judged
+CONTEXT_REPLY_CHAIN_SCORE = 8.0
+CONTEXT_SAME_AUTHOR_SCORE = 4.0
+CONTEXT_MENTION_SCORE = 2.0
+
+def channel_header(message: Message) -> str:
+    """The details shared by every message in a channel, written once per transcript."""
+    if message.guild:
+        return f"#{message.channel.name} (channel id: {message.channel.id}) in server {message.guild.name} (server id: {message.guild.id})"
+    return f"DM with {message.author.name} (user id: {message.author.id})"
+
+TRANSCRIPT_LEGEND = "Each line is: [message id] author (user id) [-> id of the message replied to]: content"
+
+class ContextBuilder:
+    """Picks the channel history to send with a prompt within a token budget.
+
+    Buffered messages are scored by how closely they relate to the message(s)
+    being judged (the reply chain, the same author, mentions between the
+    authors) plus a bonus for recency. The highest scoring messages are kept
+    until the budget is spent, then written oldest first as a compact
+    transcript that states the channel and server only once."""
+
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET):
+        self.budget = budget
+        self.builds = 0
+        self.considered = 0
+        self.included = 0
+        self.tokens = 0
+
+    def score(self, targets: List[Message], candidates: List[BufferedMessage]) -> List[float]:
+        by_id = {entry.id: entry for entry in candidates}
+        author_ids = {m.author.id for m in targets}
+        mentioned_ids = {user.id for m in targets for user in m.mentions}
+
+        # Walk each target's reply chain back through the buffered messages
+        chain = set()
+        for m in targets:
+            reference_id = m.reference.message_id if m.reference else None
+            while reference_id in by_id and reference_id not in chain:
+                chain.add(reference_id)
+                reference_id = by_id[reference_id].reference_id
+
+        scores = []
+        for index, entry in enumerate(candidates):
+            score = CONTEXT_RECENCY_WEIGHT * (index + 1) / len(candidates)
+            if entry.id in chain:
+                score += CONTEXT_REPLY_CHAIN_SCORE
+            if entry.author_id in author_ids:
+                score += CONTEXT_SAME_AUTHOR_SCORE
+            if entry.author_id in mentioned_ids or author_ids.intersection(entry.mention_ids):
+                score += CONTEXT_MENTION_SCORE
+            scores.append(score)
+        return scores
+
+    def select(self, targets: List[Message], candidates: List[BufferedMessage], budget: Optional[int] = None) -> List[BufferedMessage]:
+        """Return the most relevant candidates fitting in the budget, oldest first."""
+        budget = self.budget if budget is None else budget
+        scores = self.score(targets, candidates)
+        ranked = sorted(range(len(candidates)), key=lambda i: (scores[i], i), reverse=True)
+
+        chosen = []
+        used = 0
+        for i in ranked:
+            tokens = candidates[i].tokens
+            if used + tokens > budget:
+                continue
+            chosen.append(i)
+            used += tokens
+
+        chosen.sort()
+        self.builds += 1
+        self.considered += len(candidates)
+        self.included += len(chosen)
+        self.tokens += used
+        return [candidates[i] for i in chosen]
+
+    def build(self, targets: Iterable[Message], candidates: List[BufferedMessage], budget: Optional[int] = None) -> str:
+        targets = list(targets)
+        selected = self.select(targets, candidates, budget)
+        if not selected:
+            return ""
+        return "\n".join([channel_header(targets[0]), TRANSCRIPT_LEGEND, *[entry.line for entry in selected]])
+
+    def stats(self) -> dict:
+        return {
+            "builds": self.builds,
+            "considered": self.considered,
+            "included": self.included,
+            "tokens": self.tokens,
+            "avg_tokens": self.tokens / self.builds if self.builds else 0.0,
+        }
@@ -1,9 +1,16 @@
 import json
 import os
+import time
 import logging
+import sqlite3
+import asyncio
+import heapq
+import threading
+from collections import deque
 from dataclasses import asdict
 from typing import Dict, List, Optional
-from messages import Messages, Server, ModAction, SingleMessage
+from metrics import timed
+from messages import Messages, Server, ModAction, SingleMessage, ChannelSummary, SummarySegment, RetentionPolicy, MAX_RECENT_MOD_ACTIONS, MAX_MESSAGE_CONTEXT, MAX_SUMMARY_SEGMENTS
 
 logger = logging.getLogger(__name__)
 
@@ -11,8 +18,94 @@ logger = logging.getLogger(__name__)
 DB_DIR = "db"
 SERVERS_FILE = os.path.join(DB_DIR, "servers.json")
 DM_HISTORY_FILE = os.path.join(DB_DIR, "dm_history.json")
+JOURNAL_FILE = os.path.join(DB_DIR, "journal.jsonl")
+SUMMARIES_FILE = os.path.join(DB_DIR, "channel_summaries.json")
+# Every moderation action, one JSONL file per user in a directory per server, read only when history outside the hot tier is needed
+ARCHIVE_DIR = os.path.join(DB_DIR, "archive")
+# Seconds between checks of a server's archive for actions past its retention, since each check opens every user's file
+ARCHIVE_PRUNE_INTERVAL = float(os.getenv("DB_ARCHIVE_PRUNE_INTERVAL", "3600"))
 
-class FileDB:
+# Append each mutation to the journal instead of rewriting every file per change
+JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "1") == "1"
+# Number of journaled mutations after which a full snapshot is written and the journal reset
+JOURNAL_COMPACT_EVERY = int(os.getenv("DB_JOURNAL_COMPACT_EVERY", "1000"))
+# Key in servers.json holding the journal sequence number the snapshot includes
+JOURNAL_SEQ_KEY = "_journal_seq"
+
+# Server ID -> time.monotonic() of the last archive prune
+_archive_pruned: Dict[str, float] = {}
+
+# Storage backend used by Messages: "file" or "sqlite"
+DB_BACKEND = os.getenv("DB_BACKEND", "file")
+# Buffer mutations and persist them from a background task instead of inside the handler
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "1") == "1"
+# Seconds between background flushes
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "1.0"))
+# Pending mutations that trigger a flush before the interval ends
+DB_FLUSH_THRESHOLD = int(os.getenv("DB_FLUSH_THRESHOLD", "100"))
+SQLITE_FILE = os.path.join(DB_DIR, "moderation.sqlite3")
+
+class Storage:
+    """Interface between Messages and a persistence backend.
+
+    `record` persists a single mutation as it happens and `save_messages`
+    persists the whole state. Backends with `indexed = True` keep per-user
+    moderation history and unread tracking out of memory and answer those
+    lookups with queries instead."""
+
+    indexed = False
+
+    def load_messages(self) -> Messages:
+        raise NotImplementedError
+
+    def prepare_flush(self, messages: Messages, records: list[dict], snapshot: bool = False):
+        """Collect what `write_flush` needs to persist `records` (and the whole state
+        when `snapshot` is set). Runs on the event loop, so it must copy anything
+        `write_flush` reads from `messages`."""
+        raise NotImplementedError
+
+    def write_flush(self, job):
+        """Write a job built by `prepare_flush`. May run in a worker thread."""
+        raise NotImplementedError
+
+    def record(self, messages: Messages, record: dict):
+        self.write_flush(self.prepare_flush(messages, [record]))
+
+    def save_messages(self, messages: Messages):
+        self.write_flush(self.prepare_flush(messages, [], snapshot=True))
+
+    def flush(self, messages: Messages):
+        """Force everything to disk, e.g. on shutdown."""
+        self.save_messages(messages)
+
+    def get_user_mod_actions(self, user_id: str, server_ids: list[str], limit: int, since: Optional[float] = None) -> list[ModAction]:
+        raise NotImplementedError
+
+    def load_archived_actions(self, server_id: str, user_id: str, limit: Optional[int] = None) -> list[ModAction]:
+        """Return the user's most recent archived actions in the server, oldest first. Blocking."""
+        return []
+
+    def get_last_read(self, user_id: str, channel_id: str) -> Optional[int]:
+        raise NotImplementedError
+
+_storage: Optional[Storage] = None
+
+def get_storage() -> Storage:
+    """Return the storage backend selected by DB_BACKEND."""
+    global _storage
+    if _storage is None:
+        if DB_BACKEND == "sqlite":
+            _storage = SQLiteDB()
+            _storage.import_files()
+        elif DB_BACKEND == "file":
+            _storage = FileDB()
+        else:
+            raise ValueError(f"Unknown DB_BACKEND: {DB_BACKEND}")
+        if DB_WRITE_BEHIND:
+            _storage = WriteBehindStorage(_storage)
+    return _storage
+
+class FileDB(Storage):
     """Simple file-based database for storing Messages and Moderation data."""
     
     @staticmethod
@@ -22,56 +115,274 @@ class FileDB:
             os.makedirs(DB_DIR)
             logger.info(f"Created database directory: {DB_DIR}")
     
+    @staticmethod
+    def write_json(path: str, data):
+        """Write JSON to a temporary file and move it into place so a crash never leaves a partial file."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def record(messages: Messages, record: dict):
+        """Persist a single mutation.
+
+        In journal mode the mutation is appended to the journal and a snapshot is
+        only written every JOURNAL_COMPACT_EVERY mutations; otherwise the whole
+        state is saved."""
+        FileDB.write_flush(FileDB.prepare_flush(messages, [record]))
+
     @staticmethod
     def save_messages(messages: Messages):
-        """Save Messages data to JSON files."""
+        """Save a full snapshot of Messages data to JSON files and reset the journal."""
+        FileDB.write_flush(FileDB.prepare_flush(messages, [], snapshot=True))
+
+    @staticmethod
+    def flush(messages: Messages):
+        FileDB.save_messages(messages)
+
+    @staticmethod
+    @timed("filedb", "prepare_flush")
+    def prepare_flush(messages: Messages, records: list[dict], snapshot: bool = False) -> dict:
+        """Number the records for the journal and, when a snapshot is due, copy the state to write."""
+        # Moderation actions are archived as they happen, since memory only holds the hot tier
+        timestamp = time.time()
+        archive = [
+            (str(record["message"]["server_id"]), {"timestamp": record.get("timestamp", timestamp), "user_id": str(record["user_id"]), "action": record["action"], "message": record["message"]})
+            for record in records if record["op"] == "mod_action"
+        ]
+        if not JOURNAL_MODE:
+            return {"records": [], "archive": archive, "snapshot": FileDB.snapshot(messages)}
+
+        journal_records = []
+        for record in records:
+            messages.journal_seq += 1
+            journal_records.append({"seq": messages.journal_seq, **record})
+        messages.journal_size += len(journal_records)
+
+        if snapshot or messages.journal_size >= JOURNAL_COMPACT_EVERY:
+            messages.journal_size = 0
+            return {"records": journal_records, "archive": archive, "snapshot": FileDB.snapshot(messages)}
+        return {"records": journal_records, "archive": archive, "snapshot": None}
+
+    @staticmethod
+    @timed("filedb", "write_flush")
+    def write_flush(job: dict):
         FileDB.ensure_db_dir()
-        
+        if job["archive"]:
+            FileDB.append_archive(job["archive"])
+        if job["records"]:
+            FileDB.append_journal(*job["records"])
+        if job["snapshot"] is not None:
+            FileDB.write_snapshot(job["snapshot"])
+
+    @staticmethod
+    def snapshot(messages: Messages) -> dict:
+        """Copy the containers of the current state so it can be serialized off the event loop.
+
+        The records themselves are never modified once created, so only the
+        lists and dicts holding them are copied."""
+        return {
+            "journal_seq": messages.journal_seq,
+            "servers": {
+                server_id: (
+                    (server.id, server.name, server.rules, server.retention),
+                    list(server.recent_actions),
+                    {user_id: list(user_actions) for user_id, user_actions in server.actions.items()},
+                    {channel_id: dict(users) for channel_id, users in server.channels.items()},
+                )
+                for server_id, server in messages.servers.items()
+            },
+            "dm_history": {user_id: list(ids) for user_id, ids in messages.dm_history.items()},
+            "channel_summaries": {
+                channel_id: (state.last_message_id, list(state.segments))
+                for channel_id, state in messages.channel_summaries.items()
+            },
+        }
+
+    @staticmethod
+    def append_journal(*records: dict):
+        """Append mutation records to the journal."""
+        FileDB.ensure_db_dir()
+        with open(JOURNAL_FILE, 'a') as f:
+            f.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records))
+
+    @staticmethod
+    def archive_dir(server_id: str) -> str:
+        return os.path.join(ARCHIVE_DIR, str(server_id))
+
+    @staticmethod
+    def archive_path(server_id: str, user_id: str) -> str:
+        # One file per user, so a lookup reads only that user's history
+        return os.path.join(FileDB.archive_dir(server_id), f"{user_id}.jsonl")
+
+    @staticmethod
+    def append_archive(entries: list[tuple]):
+        """Append (server ID, entry) pairs to the archives of the entries' users."""
+        by_user: Dict[tuple, list[str]] = {}
+        for server_id, entry in entries:
+            by_user.setdefault((str(server_id), str(entry["user_id"])), []).append(json.dumps(entry, separators=(",", ":")) + "\n")
+        for (server_id, user_id), lines in by_user.items():
+            os.makedirs(FileDB.archive_dir(server_id), exist_ok=True)
+            with open(FileDB.archive_path(server_id, user_id), 'a') as f:
+                f.writelines(lines)
+
+    @staticmethod
+    def split_legacy_archive(server_id: str):
+        """Move a server's archive written as a single file into per-user files."""
+        path = os.path.join(ARCHIVE_DIR, f"{server_id}.jsonl")
+        if not os.path.exists(path):
+            return
+        FileDB.append_archive([(server_id, entry) for entry in FileDB._read_archive_file(path)])
+        os.remove(path)
+        logger.info(f"Split the archive of server {server_id} by user")
+
+    @staticmethod
+    def _read_archive_file(path: str):
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A line may still be being appended
+                    continue
+
+    @staticmethod
+    def read_archive(server_id: str):
+        """Yield the server's archive entries, oldest first."""
+        directory = FileDB.archive_dir(server_id)
+        if not os.path.isdir(directory):
+            return
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".jsonl")]
+        yield from heapq.merge(*[FileDB._read_archive_file(path) for path in paths], key=lambda entry: entry["timestamp"])
+
+    @staticmethod
+    def load_archived_actions(server_id: str, user_id: str, limit: Optional[int] = None) -> list[ModAction]:
+        actions = deque(maxlen=limit)
+        for entry in FileDB._read_archive_file(FileDB.archive_path(server_id, user_id)):
+            actions.append(ModAction(action=entry["action"], message=SingleMessage(**entry["message"]), timestamp=entry["timestamp"]))
+        return list(actions)
+
+    @staticmethod
+    def prune_archive(server_id: str, cutoff: float):
+        """Drop archive entries older than `cutoff`. Only rewrites a user's file when its oldest entry is expired."""
+        directory = FileDB.archive_dir(server_id)
+        now = time.monotonic()
+        if not os.path.isdir(directory) or now - _archive_pruned.get(str(server_id), -ARCHIVE_PRUNE_INTERVAL) < ARCHIVE_PRUNE_INTERVAL:
+            return
+        _archive_pruned[str(server_id)] = now
+        pruned = False
+        for name in os.listdir(directory):
+            if not name.endswith(".jsonl"):
+                continue
+            path = os.path.join(directory, name)
+            oldest = next(FileDB._read_archive_file(path), None)
+            if oldest is None or oldest["timestamp"] >= cutoff:
+                continue
+            kept = [entry for entry in FileDB._read_archive_file(path) if entry["timestamp"] >= cutoff]
+            if not kept:
+                os.remove(path)
+            else:
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    f.writelines(json.dumps(entry, separators=(",", ":")) + "\n" for entry in kept)
+                os.replace(tmp_path, path)
+            pruned = True
+        if pruned:
+            logger.info(f"Pruned archived actions older than {cutoff} for server {server_id}")
+
+    @staticmethod
+    def replay_journal(messages: Messages, after_seq: int):
+        """Apply journaled mutations newer than the snapshot to `messages`."""
+        if not os.path.exists(JOURNAL_FILE):
+            return
+
+        replayed = 0
+        with open(JOURNAL_FILE, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-append can leave a truncated last line
+                    logger.warning(f"Skipping unreadable journal record: {line!r}")
+                    continue
+                if record["seq"] <= after_seq:
+                    continue
+                try:
+                    messages.replay(record)
+                    replayed += 1
+                except Exception as e:
+                    logger.error(f"Error replaying journal record {record['seq']}: {e}")
+        messages.journal_size = replayed
+        logger.info(f"Replayed {replayed} journal records from {JOURNAL_FILE}")
+
+    @staticmethod
+    def write_snapshot(snapshot: dict):
+        """Serialize a snapshot to JSON files and reset the journal."""
         # Convert servers to a serializable format
         servers_data = {}
-        for server_id, server in messages.servers.items():
+        for server_id, ((id, name, rules, retention), server_recent_actions, server_actions, channels) in snapshot["servers"].items():
             # Convert ModAction objects to dictionaries
             recent_actions = []
-            for action in server.recent_actions:
+            for action in server_recent_actions:
                 recent_actions.append({
                     "action": action.action,
-                    "message": asdict(action.message)
+                    "message": asdict(action.message),
+                    "timestamp": action.timestamp
                 })
             
             # Convert user actions to dictionaries
             actions = {}
-            for user_id, user_actions in server.actions.items():
+            for user_id, user_actions in server_actions.items():
                 actions[user_id] = []
                 for action in user_actions:
                     actions[user_id].append({
                         "action": action.action,
-                        "message": asdict(action.message)
+                        "message": asdict(action.message),
+                        "timestamp": action.timestamp
                     })
             
             # Create server data dictionary
             servers_data[server_id] = {
-                "id": server.id,
-                "name": server.name,
-                "rules": server.rules,
+                "id": id,
+                "name": name,
+                "rules": rules,
                 "recent_actions": recent_actions,
-                "actions": actions
+                "actions": actions,
+                "channels": channels,
+                "retention": asdict(retention),
             }
+            if retention.archive_days:
+                FileDB.prune_archive(server_id, time.time() - retention.archive_days * 86400)
         
+        # Record which journal records the snapshot already includes
+        servers_data[JOURNAL_SEQ_KEY] = snapshot["journal_seq"]
+
         # Save servers data
-        with open(SERVERS_FILE, 'w') as f:
-            json.dump(servers_data, f, indent=2)
-            logger.info(f"Saved servers data to {SERVERS_FILE}")
+        FileDB.write_json(SERVERS_FILE, servers_data)
+        logger.info(f"Saved servers data to {SERVERS_FILE}")
         
         # Save DM history
-        with open(DM_HISTORY_FILE, 'w') as f:
-            json.dump(messages.dm_history, f, indent=2)
-            logger.info(f"Saved DM history to {DM_HISTORY_FILE}")
+        FileDB.write_json(DM_HISTORY_FILE, snapshot["dm_history"])
+        logger.info(f"Saved DM history to {DM_HISTORY_FILE}")
+
+        # Save cached channel summaries
+        FileDB.write_json(SUMMARIES_FILE, {
+            channel_id: {"last_message_id": last_message_id, "segments": [asdict(segment) for segment in segments]}
+            for channel_id, (last_message_id, segments) in snapshot["channel_summaries"].items()
+        })
+
+        # Everything journaled so far is now in the snapshot
+        if os.path.exists(JOURNAL_FILE):
+            os.remove(JOURNAL_FILE)
     
     @staticmethod
     def load_messages() -> Messages:
         """Load Messages data from JSON files."""
         FileDB.ensure_db_dir()
-        messages = Messages()
+        messages = Messages(storage=FileDB())
         
         # Load servers data if file exists
         if os.path.exists(SERVERS_FILE):
@@ -79,6 +390,7 @@ class FileDB:
                 with open(SERVERS_FILE, 'r') as f:
                     servers_data = json.load(f)
                 
+                messages.journal_seq = servers_data.pop(JOURNAL_SEQ_KEY, 0)
                 for server_id, server_data in servers_data.items():
                     # Create Server object
                     server = Server(
@@ -86,22 +398,35 @@ class FileDB:
                         name=server_data["name"],
                         rules=server_data["rules"],
                         recent_actions=[],
-                        actions={}
+                        actions={},
+                        channels=server_data.get("channels", {}),
+                        retention=RetentionPolicy(**server_data.get("retention", {}))
                     )
                     
                     # Load recent actions
                     for action_data in server_data["recent_actions"]:
                         message = SingleMessage(**action_data["message"])
-                        action = ModAction(action=action_data["action"], message=message)
+                        action = ModAction(action=action_data["action"], message=message, timestamp=action_data.get("timestamp", 0.0))
                         server.recent_actions.append(action)
-                    
-                    # Load user actions
+
+                    FileDB.split_legacy_archive(server_id)
+                    # Snapshots written before the archive existed hold every action; archive them first
+                    if server_data["actions"] and not os.path.exists(FileDB.archive_dir(server_id)):
+                        FileDB.append_archive([
+                            # Actions stored before timestamps were kept count as the oldest, not as taken now
+                            (server_id, {**action_data, "timestamp": action_data.get("timestamp", 0.0), "user_id": user_id})
+                            for user_id, user_actions_data in server_data["actions"].items()
+                            for action_data in user_actions_data
+                        ])
+                        logger.info(f"Archived the moderation history of server {server_id}")
+
+                    # Load the hot tier of user actions
                     for user_id, user_actions_data in server_data["actions"].items():
-                        server.actions[user_id] = []
-                        for action_data in user_actions_data:
-                            message = SingleMessage(**action_data["message"])
-                            action = ModAction(action=action_data["action"], message=message)
-                            server.actions[user_id].append(action)
+                        user_actions = [
+                            ModAction(action=action_data["action"], message=SingleMessage(**action_data["message"]), timestamp=action_data.get("timestamp", 0.0))
+                            for action_data in user_actions_data[-server.retention.hot_actions:]
+                        ]
+                        server.keep_hot(user_id, user_actions)
                     
                     messages.servers[server_id] = server
                 
@@ -117,5 +442,423 @@ class FileDB:
                 logger.info(f"Loaded DM history from {DM_HISTORY_FILE}")
             except Exception as e:
                 logger.error(f"Error loading DM history: {e}")
+
+        # Load cached channel summaries if file exists
+        if os.path.exists(SUMMARIES_FILE):
+            try:
+                with open(SUMMARIES_FILE, 'r') as f:
+                    for channel_id, state in json.load(f).items():
+                        messages.channel_summaries[channel_id] = ChannelSummary(
+                            last_message_id=state["last_message_id"],
+                            segments=[SummarySegment(**segment) for segment in state["segments"]]
+                        )
+                logger.info(f"Loaded channel summaries from {SUMMARIES_FILE}")
+            except Exception as e:
+                logger.error(f"Error loading channel summaries: {e}")
+
+        messages.index_last_read()
+
+        # Apply the mutations made since the snapshot was written
+        FileDB.replay_journal(messages, messages.journal_seq)
         
-        return messages 
\ No newline at end of file
+        return messages 
+
+class SQLiteDB(Storage):
+    """SQLite database that writes each mutation as its own small transaction.
+
+    Per-user moderation history and unread tracking stay on disk and are read
+    through indexes on (server_id, user_id, timestamp) and (channel_id, user_id),
+    so memory does not grow with the size of the history."""
+
+    indexed = True
+
+    def __init__(self, path: str = None):
+        self.path = path or SQLITE_FILE
+        FileDB.ensure_db_dir()
+        # Writes may come from the write-behind worker thread while lookups run on the event loop
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+
+    def create_tables(self):
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS servers (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    rules TEXT NOT NULL,
+                    retention TEXT
+                );
+                CREATE TABLE IF NOT EXISTS mod_actions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    server_id TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    timestamp REAL NOT NULL,
+                    action TEXT NOT NULL,
+                    content TEXT,
+                    server_name TEXT,
+                    user_name TEXT,
+                    channel_id TEXT,
+                    channel_name TEXT,
+                    message_id TEXT
+                );
+                CREATE INDEX IF NOT EXISTS mod_actions_user ON mod_actions (server_id, user_id, timestamp);
+                CREATE INDEX IF NOT EXISTS mod_actions_server ON mod_actions (server_id, timestamp);
+                CREATE TABLE IF NOT EXISTS dm_history (
+                    user_id TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    timestamp REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS dm_history_user ON dm_history (user_id, timestamp);
+                CREATE TABLE IF NOT EXISTS last_read (
+                    channel_id TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    PRIMARY KEY (channel_id, user_id)
+                );
+                CREATE TABLE IF NOT EXISTS summary_segments (
+                    channel_id TEXT NOT NULL,
+                    first_message_id INTEGER NOT NULL,
+                    last_message_id INTEGER NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    summary TEXT NOT NULL,
+                    PRIMARY KEY (channel_id, first_message_id)
+                );
+            """)
+            # Databases created before retention policies were stored lack the column
+            if "retention" not in [row["name"] for row in self.conn.execute("PRAGMA table_info(servers)")]:
+                self.conn.execute("ALTER TABLE servers ADD COLUMN retention TEXT")
+
+    def import_files(self):
+        """Import the data FileDB wrote, once, into a new database.
+
+        The JSON snapshot and journal are loaded as FileDB would, and every
+        archived action is copied, so switching DB_BACKEND to sqlite keeps the
+        full history. The database's user_version marks the import as done."""
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] > 0:
+            return
+        has_files = os.path.exists(SERVERS_FILE) or os.path.exists(JOURNAL_FILE)
+        if has_files and self.conn.execute("SELECT 1 FROM servers LIMIT 1").fetchone() is None:
+            legacy = FileDB.load_messages()
+            records = []
+            for server_id, server in legacy.servers.items():
+                records.append({"op": "server", "id": server_id, "name": server.name, "rules": server.rules})
+                records.append({"op": "retention", "server_id": server_id, "retention": asdict(server.retention)})
+                records.extend({"op": "mod_action", **entry} for entry in FileDB.read_archive(server_id))
+            for user_id, message_ids in legacy.dm_history.items():
+                records.extend({"op": "dm", "user_id": user_id, "message_id": message_id} for message_id in message_ids)
+            for (channel_id, user_id), message_id in legacy.last_read.items():
+                records.append({"op": "last_read", "channel_id": channel_id, "user_id": user_id, "message_id": message_id})
+            for channel_id, state in legacy.channel_summaries.items():
+                records.extend({"op": "summary_segment", "channel_id": channel_id, "segment": asdict(segment), "replace_last": False} for segment in state.segments)
+            # DM history has no timestamps; equal ones keep the insertion order
+            self.write_flush({"records": records, "servers": [], "timestamp": 0.0})
+            logger.info(f"Imported {len(legacy.servers)} servers and their history from {DB_DIR} into {self.path}")
+        with self.conn:
+            self.conn.execute("PRAGMA user_version = 1")
+
+    @staticmethod
+    def row_to_action(row: sqlite3.Row) -> ModAction:
+        message = SingleMessage(
+            content=row["content"],
+            server_id=row["server_id"],
+            server_name=row["server_name"],
+            user_id=row["user_id"],
+            user_name=row["user_name"],
+            channel_id=row["channel_id"],
+            channel_name=row["channel_name"],
+            message_id=row["message_id"]
+        )
+        return ModAction(action=row["action"], message=message, timestamp=row["timestamp"])
+
+    def load_messages(self) -> Messages:
+        """Load server settings, each server's recent actions and recent DM history."""
+        messages = Messages(storage=self)
+
+        for row in self.conn.execute("SELECT id, name, rules, retention FROM servers"):
+            server = Server(id=row["id"], name=row["name"], rules=row["rules"], recent_actions=[], actions={})
+            if row["retention"]:
+                server.retention = RetentionPolicy(**json.loads(row["retention"]))
+            rows = self.conn.execute(
+                "SELECT * FROM mod_actions WHERE server_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (row["id"], MAX_RECENT_MOD_ACTIONS)
+            ).fetchall()
+            server.recent_actions = [self.row_to_action(r) for r in reversed(rows)]
+            messages.servers[row["id"]] = server
+
+        for row in self.conn.execute("SELECT DISTINCT user_id FROM dm_history"):
+            rows = self.conn.execute(
+                "SELECT message_id FROM dm_history WHERE user_id = ? ORDER BY timestamp DESC, rowid DESC LIMIT ?",
+                (row["user_id"], MAX_MESSAGE_CONTEXT)
+            ).fetchall()
+            messages.dm_history[row["user_id"]] = [r["message_id"] for r in reversed(rows)]
+
+        for row in self.conn.execute("SELECT * FROM summary_segments ORDER BY channel_id, first_message_id"):
+            segment = SummarySegment(row["first_message_id"], row["last_message_id"], row["message_count"], row["summary"])
+            messages._apply_summary_segment(row["channel_id"], segment, replace_last=False)
+
+        logger.info(f"Loaded {len(messages.servers)} servers from {self.path}")
+        return messages
+
+    @timed("sqlitedb", "prepare_flush")
+    def prepare_flush(self, messages: Messages, records: list[dict], snapshot: bool = False) -> dict:
+        # Every mutation is already stored as its own row, so a snapshot only rewrites server settings
+        servers = [
+            (str(server.id), server.name, server.rules, json.dumps(asdict(server.retention)))
+            for server in messages.servers.values()
+        ] if snapshot else []
+        return {"records": list(records), "servers": servers, "timestamp": time.time()}
+
+    @timed("sqlitedb", "write_flush")
+    def write_flush(self, job: dict):
+        """Write all records of the job in a single transaction."""
+        with self.lock, self.conn:
+            for record in job["records"]:
+                self.write_record(record, job["timestamp"])
+            if job["servers"]:
+                self.conn.executemany(
+                    "INSERT INTO servers (id, name, rules, retention) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET name = excluded.name, rules = excluded.rules, retention = excluded.retention",
+                    job["servers"]
+                )
+                logger.info(f"Saved servers data to {self.path}")
+
+    def write_record(self, record: dict, timestamp: float):
+        op = record["op"]
+        if op == "server":
+            # Upsert, so the server's retention policy is kept
+            self.conn.execute(
+                "INSERT INTO servers (id, name, rules) VALUES (?, ?, ?) ON CONFLICT (id) DO UPDATE SET name = excluded.name, rules = excluded.rules",
+                (str(record["id"]), record["name"], record["rules"])
+            )
+        elif op == "rules":
+            self.conn.execute("UPDATE servers SET rules = ? WHERE id = ?", (record["rules"], record["server_id"]))
+        elif op == "mod_action":
+            message = record["message"]
+            self.conn.execute(
+                "INSERT INTO mod_actions (server_id, user_id, timestamp, action, content, server_name, user_name, channel_id, channel_name, message_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(message["server_id"]), str(record["user_id"]), record.get("timestamp", timestamp), record["action"],
+                    message["content"], message["server_name"], message["user_name"],
+                    _optional_str(message["channel_id"]), message["channel_name"], str(message["message_id"])
+                )
+            )
+        elif op == "dm":
+            self.conn.execute(
+                "INSERT INTO dm_history (user_id, message_id, timestamp) VALUES (?, ?, ?)",
+                (record["user_id"], str(record["message_id"]), timestamp)
+            )
+        elif op == "last_read":
+            self.conn.execute(
+                "INSERT OR REPLACE INTO last_read (channel_id, user_id, message_id) VALUES (?, ?, ?)",
+                (str(record["channel_id"]), str(record["user_id"]), str(record["message_id"]))
+            )
+        elif op == "retention":
+            self.conn.execute("UPDATE servers SET retention = ? WHERE id = ?", (json.dumps(record["retention"]), str(record["server_id"])))
+        elif op == "summary_segment":
+            segment = record["segment"]
+            if record["replace_last"]:
+                self.conn.execute(
+                    "DELETE FROM summary_segments WHERE channel_id = ? AND first_message_id = (SELECT MAX(first_message_id) FROM summary_segments WHERE channel_id = ?)",
+                    (record["channel_id"], record["channel_id"])
+                )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO summary_segments (channel_id, first_message_id, last_message_id, message_count, summary) VALUES (?, ?, ?, ?, ?)",
+                (record["channel_id"], segment["first_message_id"], segment["last_message_id"], segment["message_count"], segment["summary"])
+            )
+            # Keep only the most recent MAX_SUMMARY_SEGMENTS, as in memory
+            self.conn.execute(
+                "DELETE FROM summary_segments WHERE channel_id = ? AND first_message_id NOT IN "
+                "(SELECT first_message_id FROM summary_segments WHERE channel_id = ? ORDER BY first_message_id DESC LIMIT ?)",
+                (record["channel_id"], record["channel_id"], MAX_SUMMARY_SEGMENTS)
+            )
+        elif op == "summary_drop":
+            self.conn.execute("DELETE FROM summary_segments WHERE channel_id = ?", (record["channel_id"],))
+        else:
+            raise ValueError(f"Unknown record: {record}")
+
+    def get_user_mod_actions(self, user_id: str, server_ids: list[str], limit: int, since: Optional[float] = None) -> list[ModAction]:
+        """Return the user's most recent actions across `server_ids`, oldest first, taken at or after `since` if given.
+
+        Blocking, and waits for a write in progress; call it with `asyncio.to_thread` from the event loop."""
+        if not server_ids:
+            return []
+        placeholders = ", ".join("?" for _ in server_ids)
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT * FROM mod_actions WHERE server_id IN ({placeholders}) AND user_id = ? AND timestamp >= ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (*server_ids, str(user_id), since or 0.0, limit)
+            ).fetchall()
+        return [self.row_to_action(r) for r in reversed(rows)]
+
+    def get_last_read(self, user_id: str, channel_id: str) -> Optional[int]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT message_id FROM last_read WHERE channel_id = ? AND user_id = ?",
+                (str(channel_id), str(user_id))
+            ).fetchone()
+        return int(row["message_id"]) if row else None
+
+    def close(self):
+        self.conn.close()
+
+class WriteBehindStorage(Storage):
+    """Wraps a storage backend so mutations are persisted by a background task.
+
+    Mutations only queue a record. The task wakes every `interval` seconds, or
+    as soon as `threshold` records are pending, and writes everything queued in
+    one job in a worker thread, so a burst of N mutations costs one write
+    instead of N. Without a running event loop, records are written
+    immediately. `flush` forces a final synchronous write, e.g. on shutdown."""
+
+    def __init__(self, inner: Storage, interval: float = DB_FLUSH_INTERVAL, threshold: int = DB_FLUSH_THRESHOLD):
+        self.inner = inner
+        self.interval = interval
+        self.threshold = threshold
+        self.messages: Optional[Messages] = None
+        self.pending: list[dict] = []
+        self.snapshot_requested = False
+        self.wake: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.write_lock = threading.Lock()  # Serializes the worker thread with a shutdown flush
+        self.writing: list[dict] = []  # Records of the job being written, or of the failed job
+        self.failed_job = None  # Prepared job whose write failed, retried before anything newer
+        self.flushes = 0
+        self.records_flushed = 0
+
+    @property
+    def indexed(self) -> bool:
+        return self.inner.indexed
+
+    def load_messages(self) -> Messages:
+        messages = self.inner.load_messages()
+        messages.storage = self
+        return messages
+
+    def record(self, messages: Messages, record: dict):
+        if not self._ensure_started():
+            self.inner.record(messages, record)
+            return
+        self.messages = messages
+        self.pending.append(record)
+        if len(self.pending) >= self.threshold:
+            self.wake.set()
+
+    def save_messages(self, messages: Messages):
+        if not self._ensure_started():
+            self.inner.save_messages(messages)
+            return
+        self.messages = messages
+        self.snapshot_requested = True
+        self.wake.set()
+
+    def flush(self, messages: Messages):
+        """Synchronously write everything pending together with a full snapshot."""
+        with self.write_lock:
+            if self.failed_job is not None:
+                self.inner.write_flush(self.failed_job)
+                self.failed_job = None
+        records, self.pending = self.pending, []
+        self.snapshot_requested = False
+        job = self.inner.prepare_flush(messages, records, snapshot=True)
+        with self.write_lock:
+            self.inner.write_flush(job)
+        self.writing = []
+
+    def _ensure_started(self) -> bool:
+        if self.task is not None and not self.task.done():
+            return True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        self.wake = asyncio.Event()
+        self.task = loop.create_task(self._run())
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            await self.flush_pending()
+
+    async def flush_pending(self):
+        """Write the queued records (and a requested snapshot) in a worker thread.
+
+        A job that failed to write is retried as it was prepared before
+        anything newer is written; preparing its records again would journal
+        and archive them twice."""
+        if self.failed_job is not None:
+            try:
+                await asyncio.to_thread(self._write, self.failed_job)
+            except Exception as e:
+                logger.error(f"Error retrying a flush of {len(self.writing)} records to storage: {e}")
+                return
+            self.failed_job = None
+            self._flushed()
+        if not self.pending and not self.snapshot_requested:
+            return
+        records, self.pending = self.pending, []
+        snapshot, self.snapshot_requested = self.snapshot_requested, False
+        job = self.inner.prepare_flush(self.messages, records, snapshot=snapshot)
+        self.writing = records
+        try:
+            await asyncio.to_thread(self._write, job)
+        except Exception as e:
+            logger.error(f"Error flushing {len(records)} records to storage: {e}")
+            self.failed_job = job
+            return
+        self._flushed()
+
+    def _flushed(self):
+        self.flushes += 1
+        self.records_flushed += len(self.writing)
+        self.writing = []
+
+    def _write(self, job):
+        with self.write_lock:
+            self.inner.write_flush(job)
+
+    def get_user_mod_actions(self, user_id: str, server_ids: list[str], limit: int, since: Optional[float] = None) -> list[ModAction]:
+        """Query the backend, adding the user's actions that are still queued, which are newer than any stored one."""
+        # Copy the queued records before querying, so a record written meanwhile is found twice rather than missed
+        unwritten = [
+            record for record in self.writing + self.pending
+            if record["op"] == "mod_action" and str(record["user_id"]) == str(user_id)
+            and str(record["message"]["server_id"]) in server_ids and record.get("timestamp", 0.0) >= (since or 0.0)
+        ]
+        stored = self.inner.get_user_mod_actions(user_id, server_ids, limit, since)
+        seen = {(a.action, a.message.server_id, a.message.message_id, a.timestamp) for a in stored}
+        for record in unwritten:
+            action = ModAction(action=record["action"], message=SingleMessage(**record["message"]), timestamp=record.get("timestamp", 0.0))
+            if (action.action, action.message.server_id, action.message.message_id, action.timestamp) not in seen:
+                stored.append(action)
+        return stored if limit < 0 else stored[-limit:]
+
+    def load_archived_actions(self, server_id: str, user_id: str, limit: Optional[int] = None) -> list[ModAction]:
+        return self.inner.load_archived_actions(server_id, user_id, limit)
+
+    def get_last_read(self, user_id: str, channel_id: str) -> Optional[int]:
+        """Return the newest queued last read message for the channel, or else the stored one."""
+        for record in reversed(self.writing + self.pending):
+            if record["op"] == "last_read" and record["user_id"] == str(user_id) and record["channel_id"] == str(channel_id):
+                return record["message_id"]
+        return self.inner.get_last_read(user_id, channel_id)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "failed": len(self.writing) if self.failed_job is not None else 0,
+            "flushes": self.flushes,
+            "records_flushed": self.records_flushed,
+        }
+
+def _optional_str(value) -> Optional[str]:
+    return None if value is None else str(value)
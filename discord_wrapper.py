@@ -1,39 +1,216 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import discord
 from discord.ext import commands
 
+from cache import TTLCache
+from metrics import Counter
+from streaming import split_message
+
+logger = logging.getLogger(__name__)
+
+# Users and DM channels fetched over REST kept before the least recently used one is dropped
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "10000"))
+# Seconds a fetched user or DM channel is reused before it is fetched again
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", "3600"))
+# Seconds to collect deletions in a channel before sending them together (0 deletes each message immediately)
+DELETE_COALESCE_WINDOW = float(os.getenv("DELETE_COALESCE_WINDOW", "0.25"))
+# Most messages Discord accepts in one bulk delete
+BULK_DELETE_MAX = 100
+# Discord refuses to bulk delete messages older than two weeks; keep a margin for clock skew
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)
+
+ENTITY_LOOKUPS = Counter("discord_user_lookups_total", "User lookups, by where the user was found.", ("source",))
+
 class DiscordWrapper:
-    def __init__(self, bot: commands.Bot):
+    """Runs moderation actions against Discord with as few REST requests as possible.
+
+    Users are looked up in the gateway cache first, then in a bounded cache of
+    users fetched earlier, and only then over REST. Bans, kicks and unbans only
+    need the user's ID and are sent with a `discord.Object`.
+
+    Deletions never fetch the message. Deletions in the same channel within
+    `delete_window` seconds are sent as bulk deletes of up to 100 messages;
+    messages too old for bulk delete are deleted one by one. Deletions are
+    collected before they reach `scheduler`, so a deletion waiting for its
+    window takes no scheduler slot and each flush is one scheduled bulk delete."""
+
+    def __init__(self, bot: commands.Bot, cache_size: int = ENTITY_CACHE_SIZE, cache_ttl: float = ENTITY_CACHE_TTL, delete_window: float = DELETE_COALESCE_WINDOW, scheduler=None):
         self.bot = bot
+        self.scheduler = scheduler  # ActionScheduler the deletions are sent through, or None to send them directly
+        self.delete_window = delete_window
+        self.pending_deletes: Dict[int, List[Tuple[int, asyncio.Future]]] = {}  # Channel ID -> (message ID, future) queued for deletion
+        self.delete_timers: Dict[int, asyncio.Task] = {}  # Channel ID -> delayed flush task
+        self.flushing: Set[asyncio.Task] = set()  # Keeps flushes started by a full batch referenced until they finish
+        self.bulk_deletes = 0
+        self.single_deletes = 0
+        self.users = TTLCache(cache_size, cache_ttl, name="users")  # User ID -> fetched user
+        self.dm_channels = TTLCache(cache_size, cache_ttl, name="dm_channels")  # User ID -> DM channel
+        self.gateway_hits = 0
+        self.rest_fetches = 0
+
+    async def get_user(self, user_id: int, guild_id: Optional[int] = None):
+        """Return the user (or guild member) with the given ID, fetching it only if no cache has it."""
+        if guild_id is not None:
+            guild = self.bot.get_guild(int(guild_id))
+            member = guild.get_member(user_id) if guild else None
+            if member is not None:
+                self.gateway_hits += 1
+                ENTITY_LOOKUPS.inc("gateway")
+                return member
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            self.gateway_hits += 1
+            ENTITY_LOOKUPS.inc("gateway")
+            return user
+        user = self.users.get(user_id)
+        if user is None:
+            self.rest_fetches += 1
+            ENTITY_LOOKUPS.inc("rest")
+            user = await self.bot.fetch_user(user_id)
+            self.users.put(user_id, user)
+        else:
+            ENTITY_LOOKUPS.inc("cache")
+        return user
+
+    async def get_dm_channel(self, user_id: int):
+        channel = self.dm_channels.get(user_id)
+        if channel is None:
+            user = await self.get_user(user_id)
+            channel = user.dm_channel or await user.create_dm()
+            self.dm_channels.put(user_id, channel)
+        return channel
 
     async def send_dm(self, user_id: str, message: str):
-        user = await self.bot.fetch_user(int(user_id))
-        await user.send(message)
+        channel = await self.get_dm_channel(int(user_id))
+        # Long replies are split like streamed channel replies, since Discord rejects messages over its limit
+        for part in split_message(message):
+            await channel.send(part)
 
     async def send_message(self, channel_id: str, message: str):
         channel = self.bot.get_channel(int(channel_id))
         if channel:
-            await channel.send(message)
+            for part in split_message(message):
+                await channel.send(part)
 
     async def ban_user(self, guild_id: str, user_id: str):
         guild = self.bot.get_guild(int(guild_id))
-        user = await self.bot.fetch_user(int(user_id))
-        if guild and user:
-            await guild.ban(user)
+        if guild:
+            await guild.ban(discord.Object(id=int(user_id)))
 
     async def kick_user(self, guild_id: str, user_id: str):
         guild = self.bot.get_guild(int(guild_id))
-        user = await self.bot.fetch_user(int(user_id))
-        if guild and user:
-            await guild.kick(user)
+        if guild:
+            await guild.kick(discord.Object(id=int(user_id)))
 
     async def unban_user(self, guild_id: str, user_id: str):
         guild = self.bot.get_guild(int(guild_id))
-        user = await self.bot.fetch_user(int(user_id))
-        if guild and user:
-            await guild.unban(user)
+        if guild:
+            await guild.unban(discord.Object(id=int(user_id)))
 
     async def delete_message(self, channel_id: str, message_id: str):
         channel = self.bot.get_channel(int(channel_id))
-        if channel:
-            message = await channel.fetch_message(int(message_id))
-            if message:
-                await message.delete()  
+        if not channel:
+            return
+        if self.delete_window <= 0:
+            await self._schedule("delete_message", channel.id, self._delete_one, channel, int(message_id))
+            return
+
+        # Queue the deletion and wait until the batch holding it has been sent
+        key = channel.id
+        future = asyncio.get_running_loop().create_future()
+        self.pending_deletes.setdefault(key, []).append((int(message_id), future))
+        if len(self.pending_deletes[key]) >= BULK_DELETE_MAX:
+            timer = self.delete_timers.pop(key, None)
+            if timer:
+                timer.cancel()
+            # Take the batch now so deletions arriving before the task runs start the next one
+            task = asyncio.create_task(self._send_batch(channel, self.pending_deletes.pop(key)))
+            self.flushing.add(task)
+            task.add_done_callback(self.flushing.discard)
+        elif key not in self.delete_timers:
+            self.delete_timers[key] = asyncio.create_task(self._flush_deletes_after(channel))
+        await future
+
+    async def _schedule(self, action: str, major_id, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        if self.scheduler is None:
+            return await func(*args)
+        return await self.scheduler.run(action, major_id, func, *args)
+
+    async def _flush_deletes_after(self, channel):
+        await asyncio.sleep(self.delete_window)
+        self.delete_timers.pop(channel.id, None)
+        await self._flush_deletes(channel)
+
+    async def _flush_deletes(self, channel):
+        await self._send_batch(channel, self.pending_deletes.pop(channel.id, []))
+
+    async def _send_batch(self, channel, pending: List[Tuple[int, asyncio.Future]]):
+        if not pending:
+            return
+        try:
+            await self._send_deletes(channel, pending)
+        except Exception as e:
+            logger.error(f"Deleting {len(pending)} messages in channel {channel.id} failed: {e}")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # Never leave a caller waiting, even if the flush was cancelled
+            for _, future in pending:
+                if not future.done():
+                    future.cancel()
+
+    async def _send_deletes(self, channel, pending: List[Tuple[int, asyncio.Future]]):
+        cutoff = datetime.now(timezone.utc) - BULK_DELETE_MAX_AGE
+        recent = [(message_id, future) for message_id, future in pending if discord.utils.snowflake_time(message_id) > cutoff]
+        old = [(message_id, future) for message_id, future in pending if discord.utils.snowflake_time(message_id) <= cutoff]
+
+        # Discord takes at most BULK_DELETE_MAX messages per bulk delete
+        if len(recent) == 1:
+            old.extend(recent)
+            recent = []
+        for start in range(0, len(recent), BULK_DELETE_MAX):
+            chunk = recent[start:start + BULK_DELETE_MAX]
+            if len(chunk) == 1:
+                old.extend(chunk)
+                continue
+            try:
+                await self._schedule("bulk_delete", channel.id, channel.delete_messages, [discord.Object(id=message_id) for message_id, _ in chunk])
+                self.bulk_deletes += 1
+                for _, future in chunk:
+                    if not future.done():
+                        future.set_result(None)
+            except (discord.HTTPException, discord.ClientException) as e:
+                logger.warning(f"Bulk delete of {len(chunk)} messages in channel {channel.id} failed, deleting one by one: {e}")
+                old.extend(chunk)
+
+        # Messages bulk delete cannot handle are deleted on their own
+        await asyncio.gather(*[self._resolve_delete(channel, message_id, future) for message_id, future in old])
+
+    async def _resolve_delete(self, channel, message_id: int, future: asyncio.Future):
+        try:
+            await self._schedule("delete_message", channel.id, self._delete_one, channel, message_id)
+            if not future.done():
+                future.set_result(None)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+    async def _delete_one(self, channel, message_id: int):
+        self.single_deletes += 1
+        await channel.get_partial_message(message_id).delete()
+
+    def stats(self) -> dict:
+        return {
+            "gateway_hits": self.gateway_hits,
+            "rest_fetches": self.rest_fetches,
+            "bulk_deletes": self.bulk_deletes,
+            "single_deletes": self.single_deletes,
+            "users": self.users.stats(),
+            "dm_channels": self.dm_channels.stats(),
+        }
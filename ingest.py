@@ -0,0 +1,181 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+from discord import Message
+
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Workers handling queued messages, which also caps the messages handled at once
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "8"))
+# Messages queued per guild (or for all DMs) before the overload policy applies
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "100"))
+# What to do with a low priority message when its guild's queue is full: "coalesce" replaces a
+# queued message from the same author and channel, or else drops the oldest low priority one;
+# "skip" drops the incoming message
+INGEST_OVERLOAD_POLICY = os.getenv("INGEST_OVERLOAD_POLICY", "coalesce")
+
+DM_QUEUE_KEY = "dm"
+
+INGEST_MESSAGES = Counter("ingest_messages_total", "Messages submitted for moderation, by what happened to them.", ("result",))
+INGEST_WAIT_SECONDS = Histogram("ingest_wait_seconds", "Seconds a message waited in the ingest queue before a worker took it.")
+INGEST_QUEUE_DEPTH = Gauge("ingest_queue_depth", "Messages waiting in the ingest queues.")
+
+@dataclass(slots=True)
+class IngestItem:
+    message: Message
+    priority: bool  # Priority messages (from admins) are never dropped
+    enqueued: float = field(default_factory=time.monotonic)
+
+class IngestQueue:
+    """Bounded per-guild queues of incoming messages drained by a fixed pool of workers.
+
+    Workers take one message at a time from each guild with queued messages in
+    turn, so a flood in one guild only delays that guild. When a guild's queue
+    is full, low priority messages are coalesced or skipped according to
+    `overload_policy`; priority messages are always queued."""
+
+    def __init__(self, handler: Callable[[Message], Awaitable[object]], is_priority: Callable[[Message], bool] = lambda message: False,
+                 workers: int = INGEST_WORKERS, max_queue_size: int = INGEST_QUEUE_SIZE, overload_policy: str = INGEST_OVERLOAD_POLICY):
+        if overload_policy not in ("coalesce", "skip"):
+            raise ValueError(f"Invalid overload policy: {overload_policy}")
+        self.handler = handler
+        self.is_priority = is_priority
+        self.worker_count = workers
+        self.max_queue_size = max_queue_size
+        self.overload_policy = overload_policy
+        self.queues: Dict[object, Deque[IngestItem]] = {}  # Guild ID (or DM_QUEUE_KEY) -> queued messages
+        self.ready: Deque[object] = deque()  # Guilds with queued messages, in the order they are served
+        self.available = asyncio.Semaphore(0)  # Released once per queued message
+        self.workers: list[asyncio.Task] = []
+        self.enqueued = 0
+        self.processed = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # The most recently created queue is the one exported
+        INGEST_QUEUE_DEPTH.set_function(lambda: {(): sum(len(q) for q in self.queues.values())})
+
+    def submit(self, message: Message) -> bool:
+        """Queue a message for handling. Returns False if it was dropped by the overload policy."""
+        if not self.workers:
+            self.start()
+        key = message.guild.id if message.guild else DM_QUEUE_KEY
+        queue = self.queues.setdefault(key, deque())
+        item = IngestItem(message, priority=self.is_priority(message))
+
+        if len(queue) >= self.max_queue_size:
+            if not item.priority and self.overload_policy == "coalesce" and self._coalesce(queue, item):
+                INGEST_MESSAGES.inc("coalesced")
+                return True
+            if item.priority or self.overload_policy == "coalesce":
+                dropped = self._drop_oldest(key, queue)
+            else:
+                dropped = False
+            # Admin messages are queued over the bound if nothing can be dropped
+            if not dropped and not item.priority:
+                self.dropped += 1
+                INGEST_MESSAGES.inc("dropped")
+                logger.warning(f"Ingest queue for {key} is full, dropped message {message.id}")
+                return False
+
+        if not queue:
+            self.ready.append(key)
+        queue.append(item)
+        self.enqueued += 1
+        INGEST_MESSAGES.inc("enqueued")
+        self.available.release()
+        return True
+
+    def _coalesce(self, queue: Deque[IngestItem], item: IngestItem) -> bool:
+        """Replace a queued message from the same author and channel with `item`.
+
+        The replaced message stays in the channel buffer, so it is still seen as
+        context when the newer one is judged."""
+        for index, queued in enumerate(queue):
+            if not queued.priority and queued.message.channel.id == item.message.channel.id and queued.message.author.id == item.message.author.id:
+                item.enqueued = queued.enqueued
+                queue[index] = item
+                self.coalesced += 1
+                return True
+        return False
+
+    def _drop_oldest(self, key, queue: Deque[IngestItem]) -> bool:
+        """Drop the oldest low priority message. Its worker permit is left for a worker to skip."""
+        for queued in queue:
+            if not queued.priority:
+                queue.remove(queued)
+                if not queue:
+                    # The guild is queued again when the next message is added
+                    self.ready.remove(key)
+                self.dropped += 1
+                INGEST_MESSAGES.inc("dropped")
+                logger.warning(f"Ingest queue is full, dropped message {queued.message.id}")
+                return True
+        return False
+
+    def start(self):
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def _next(self) -> Optional[IngestItem]:
+        """Take the next message round-robin across guilds."""
+        if not self.ready:
+            return None
+        key = self.ready.popleft()
+        queue = self.queues[key]
+        item = queue.popleft()
+        if queue:
+            self.ready.append(key)
+        else:
+            del self.queues[key]
+        return item
+
+    async def _worker(self):
+        while True:
+            await self.available.acquire()
+            item = None
+            try:
+                item = self._next()
+                if item is None:
+                    continue
+                wait = time.monotonic() - item.enqueued
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                INGEST_WAIT_SECONDS.observe(wait)
+                await self.handler(item.message)
+            except Exception as e:
+                self.errors += 1
+                INGEST_MESSAGES.inc("error")
+                logger.error(f"Error handling message {item.message.id if item else None}: {e}")
+            finally:
+                if item is not None:
+                    self.processed += 1
+                    INGEST_MESSAGES.inc("processed")
+
+    def stats(self) -> dict:
+        return {
+            "depth": sum(len(q) for q in self.queues.values()),
+            "max_guild_depth": max((len(q) for q in self.queues.values()), default=0),
+            "guilds_queued": len(self.queues),
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "avg_wait_ms": self.wait_total / self.processed * 1000 if self.processed else 0.0,
+            "max_wait_ms": self.wait_max * 1000,
+        }
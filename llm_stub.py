@@ -0,0 +1,269 @@
+"""Local OpenAI-compatible chat completions server for load testing without spending tokens.
+
+Serves recorded responses from a cassette file, keyed by a hash of the
+prompt, and answers unknown prompts with synthetic responses. With
+--upstream, unknown prompts are sent to the real API instead and recorded.
+Latency, jitter, error rate and streaming chunking are configurable.
+
+    python -m llm_stub --port 8089 --cassette db/cassette.jsonl --latency 0.5 --error-rate 0.01
+    OPENAI_BASE_URL=http://localhost:8089/v1 OPENAI_API_KEY=stub python bot.py
+"""
+import os
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import argparse
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+from utils import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Synthetic responses act on judged messages whose content contains this
+VIOLATION_MARKER = "BUY-FOLLOWERS"
+# Header of each judged message in a moderation prompt, as written by utils.format_message
+JUDGED_MESSAGE = re.compile(r"\(user id: (\d+), message id: (\d+)\) in .*? \(channel id: (\d+)\) in server .*? \(server id: (\d+)\):\n(.*)")
+# Error statuses returned at the configured error rate; the OpenAI client retries all of them
+ERROR_STATUSES = (429, 500, 503)
+
+def synthetic_reply(prompt: str, actions: List[str]) -> str:
+    """A response to `prompt` that needs no model.
+
+    Moderation prompts get one tool call per action in `actions` for every
+    judged message containing VIOLATION_MARKER, and none for the others. Any
+    other prompt gets a short text answer."""
+    judged = JUDGED_MESSAGE.findall(prompt)
+    if not judged:
+        return f"Synthetic response to a {count_tokens(prompt)} token prompt."
+
+    tool_calls = []
+    for user_id, message_id, channel_id, server_id, content in judged:
+        if VIOLATION_MARKER not in content:
+            continue
+        args = {
+            "delete_message": {"channel_id": channel_id, "message_id": message_id},
+            "send_dm": {"user_id": user_id, "message": "Please follow the server rules."},
+            "send_message": {"channel_id": channel_id, "message": "A message was removed for breaking the rules."},
+            "ban_user": {"server_id": server_id, "user_id": user_id},
+            "kick_user": {"server_id": server_id, "user_id": user_id},
+        }
+        for action in actions:
+            tool_calls.append({"action": action, "message_id": message_id, "args": args[action]})
+    return "\n".join(f"<tool>{json.dumps(tool_call)}</tool>" for tool_call in tool_calls) or "No action needed."
+
+def usage_for(messages: list, content: str) -> dict:
+    prompt_tokens = sum(count_tokens(m.get("content") or "") for m in messages)
+    completion_tokens = count_tokens(content)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0},
+    }
+
+class Cassette:
+    """Recorded responses keyed by a hash of the model and messages they answered.
+
+    The file holds one JSON record per line; each recording is appended in a
+    worker thread, so recording never rewrites the file or blocks the server."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.responses: Dict[str, dict] = {}  # Prompt hash -> {"content": ..., "usage": ...}
+        self.lock = threading.Lock()  # Keeps appended lines whole
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line may have been cut short by a crash
+                        continue
+                    self.responses[record["key"]] = record["response"]
+
+    @staticmethod
+    def key(model: str, messages: list) -> str:
+        return hashlib.sha256(json.dumps({"model": model, "messages": messages}, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.responses.get(key)
+
+    async def put(self, key: str, response: dict):
+        self.responses[key] = response
+        if self.path:
+            await asyncio.to_thread(self._append, json.dumps({"key": key, "response": response}) + "\n")
+
+    def _append(self, line: str):
+        with self.lock, open(self.path, 'a') as f:
+            f.write(line)
+
+class StubServer:
+    """Answers `POST /v1/chat/completions` like the OpenAI API, streamed or not.
+
+    Each request waits `latency` seconds, give or take `jitter`, then fails
+    with a retryable error status at `error_rate`. Otherwise it is answered
+    from the cassette, from `upstream` (recording the answer) when the
+    cassette does not have it, or with `synthetic_reply`. Streamed responses
+    are sent `chunk_size` characters at a time, `chunk_delay` seconds apart."""
+
+    def __init__(self, cassette: Optional[Cassette] = None, upstream: Optional[str] = None, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, chunk_size: int = 16, chunk_delay: float = 0.0, actions: Optional[List[str]] = None, seed: Optional[int] = None):
+        self.cassette = cassette or Cassette()
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.actions = actions if actions is not None else ["delete_message", "send_dm"]
+        self.rng = random.Random(seed)
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.requests = 0
+        self.replayed = 0
+        self.recorded = 0
+        self.synthetic = 0
+        self.errors = 0
+        self.streamed = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle_completions)
+        app.router.add_post("/chat/completions", self.handle_completions)
+        app.router.add_get("/stats", self.handle_stats)
+        app.on_cleanup.append(self.close)
+        return app
+
+    async def close(self, app: Optional[web.Application] = None):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def handle_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            status = self.rng.choice(ERROR_STATUSES)
+            return web.json_response({"error": {"message": f"Synthetic error {status}", "type": "server_error", "code": None}}, status=status)
+
+        content, usage = await self.respond(body, request.headers.get("Authorization"))
+        model = body.get("model", "stub")
+        if body.get("stream"):
+            self.streamed += 1
+            include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+            return await self.stream(request, model, content, usage if include_usage else None)
+        return web.json_response({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    async def respond(self, body: dict, authorization: Optional[str] = None) -> Tuple[str, dict]:
+        """Return the response content and token usage for a request."""
+        messages = body.get("messages", [])
+        key = Cassette.key(body.get("model"), messages)
+        recorded = self.cassette.get(key)
+        if recorded is not None:
+            self.replayed += 1
+            return recorded["content"], recorded["usage"]
+
+        if self.upstream:
+            recorded = await self.fetch_upstream(body, authorization)
+            await self.cassette.put(key, recorded)
+            self.recorded += 1
+            return recorded["content"], recorded["usage"]
+
+        self.synthetic += 1
+        content = synthetic_reply((messages[-1].get("content") or "") if messages else "", self.actions)
+        return content, usage_for(messages, content)
+
+    async def fetch_upstream(self, body: dict, authorization: Optional[str]) -> dict:
+        """Ask the real API, unstreamed, so the whole response can be recorded."""
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        request = {k: v for k, v in body.items() if k not in ("stream", "stream_options")}
+        headers = {"Authorization": authorization or f"Bearer {os.getenv('OPENAI_API_KEY', '')}"}
+        async with self.session.post(f"{self.upstream}/chat/completions", json=request, headers=headers) as response:
+            response.raise_for_status()
+            data = await response.json()
+        return {"content": data["choices"][0]["message"]["content"], "usage": data.get("usage")}
+
+    async def stream(self, request: web.Request, model: str, content: str, usage: Optional[dict]) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        chunk = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+
+        async def send(choices: list, usage: Optional[dict] = None):
+            await response.write(f"data: {json.dumps({**chunk, 'choices': choices, 'usage': usage})}\n\n".encode())
+
+        await send([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+        for start in range(0, len(content), self.chunk_size):
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+            await send([{"index": 0, "delta": {"content": content[start:start + self.chunk_size]}, "finish_reason": None}])
+        await send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if usage is not None:
+            await send([], usage)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "replayed": self.replayed,
+            "recorded": self.recorded,
+            "synthetic": self.synthetic,
+            "errors": self.errors,
+            "streamed": self.streamed,
+            "cassette_size": len(self.cassette.responses),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--cassette", help="JSONL file of recorded responses to serve, and to record into with --upstream")
+    parser.add_argument("--upstream", help="Base URL of the real API to record unknown prompts from, e.g. https://api.openai.com/v1")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Seconds the latency varies by, either way")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a retryable error")
+    parser.add_argument("--chunk-size", type=int, default=16, help="Characters per streamed chunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="Seconds between streamed chunks")
+    parser.add_argument("--tool-actions", default="delete_message,send_dm", help="Comma separated tool calls in synthetic responses to flagged messages")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = StubServer(
+        cassette=Cassette(args.cassette),
+        upstream=args.upstream,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        chunk_size=args.chunk_size,
+        chunk_delay=args.chunk_delay,
+        actions=[action for action in args.tool_actions.split(",") if action],
+        seed=args.seed,
+    )
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Deque, Optional, Tuple
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Seconds between event loop lag measurements
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1"))
+# Lag in seconds after which the loop counts as blocked and the blocking stack is captured (0 disables the monitor)
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.1"))
+# Blocked stretches kept with their stacks, newest last
+LOOP_MONITOR_MAX_STALLS = int(os.getenv("LOOP_MONITOR_MAX_STALLS", "50"))
+
+LOOP_LAG_SECONDS = Histogram("event_loop_lag_seconds", "Seconds the event loop was late running a scheduled callback.")
+
+@dataclass(slots=True)
+class Stall:
+    lag: float  # Seconds the loop was late
+    location: str  # Innermost frame of the captured stack, or "unknown" if it finished before it was captured
+    stack: Optional[str]  # Stack of the event loop thread while it was blocked
+    at: float  # time.time() when the stall ended
+
+class LoopMonitor:
+    """Measures event loop lag and captures what is blocking the loop.
+
+    A task on the loop wakes every `interval` seconds and records how late
+    it woke in a lag histogram. A watchdog thread watches the task's
+    heartbeat; once it is `threshold` seconds overdue, the thread captures the
+    loop thread's stack with `sys._current_frames`, which shows the blocking
+    call while it is still running. Each blocked stretch is logged with its
+    stack and kept in `stalls`."""
+
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD, max_stalls: int = LOOP_MONITOR_MAX_STALLS, lag: Histogram = LOOP_LAG_SECONDS):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = lag
+        self.stalls: Deque[Stall] = deque(maxlen=max_stalls)
+        self.stall_locations: Counter = Counter()  # Innermost blocking frame -> stalls
+        self.heartbeat = time.monotonic()  # When the loop task last started waiting
+        self.captured: Optional[Tuple[float, str, str]] = None  # (heartbeat, location, stack) captured by the watchdog
+        self.loop_thread_id: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+        self.samples = 0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def start(self):
+        """Start monitoring the running event loop."""
+        if self.task is not None and not self.task.done():
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopping.clear()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+        self.watchdog = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        self.watchdog.start()
+
+    async def stop(self):
+        self.stopping.set()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.watchdog is not None:
+            await asyncio.to_thread(self.watchdog.join)
+            self.watchdog = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            self.heartbeat = started
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - started - self.interval)
+            self.lag.observe(lag)
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                captured = self.captured
+                if captured is not None and captured[0] == started:
+                    self._record_stall(lag, captured[1], captured[2])
+                else:
+                    self._record_stall(lag, "unknown", None)
+
+    def _watch(self):
+        # Poll often enough to catch the loop while it is still blocked
+        poll = min(self.interval, self.threshold) / 2
+        while not self.stopping.wait(poll):
+            heartbeat = self.heartbeat
+            overdue = time.monotonic() - heartbeat - self.interval
+            if overdue < self.threshold or (self.captured is not None and self.captured[0] == heartbeat):
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                stack = traceback.extract_stack(frame)
+                # The innermost frame is the blocking call
+                location = f"{stack[-1].filename}:{stack[-1].lineno} in {stack[-1].name}"
+                self.captured = (heartbeat, location, "".join(stack.format()))
+                del frame
+
+    def _record_stall(self, lag: float, location: str, stack: Optional[str]):
+        self.stalls.append(Stall(lag=lag, location=location, stack=stack, at=time.time()))
+        self.stall_locations[location] += 1
+        logger.warning(f"Event loop blocked for {lag * 1000:.0f}ms at {location}" + (f"\n{stack}" if stack else ""))
+
+    def stats(self) -> dict:
+        return {
+            "samples": self.samples,
+            "avg_lag_ms": self.total_lag / self.samples * 1000 if self.samples else 0.0,
+            "max_lag_ms": self.max_lag * 1000,
+            "stalls": sum(self.stall_locations.values()),
+            "top_stall_locations": self.stall_locations.most_common(5),
+        }
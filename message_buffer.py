@@ -0,0 +1,139 @@
+import os
+import time
+import logging
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Deque, Iterable, List, Optional, Tuple
+
+from discord import Message
+from utils import count_tokens, format_compact_message
+
+logger = logging.getLogger(__name__)
+
+# Messages kept per channel or DM
+MESSAGE_BUFFER_SIZE = int(os.getenv("MESSAGE_BUFFER_SIZE", "50"))
+# Channels kept in memory before the least recently active one is dropped
+MESSAGE_BUFFER_MAX_CHANNELS = int(os.getenv("MESSAGE_BUFFER_MAX_CHANNELS", "5000"))
+# Seconds without a message after which a channel is dropped
+MESSAGE_BUFFER_IDLE_TTL = float(os.getenv("MESSAGE_BUFFER_IDLE_TTL", "3600"))
+# Longest message content kept per entry
+MESSAGE_BUFFER_MAX_CONTENT = 2000
+
+@dataclass(slots=True)
+class BufferedMessage:
+    id: int
+    author_id: int
+    author_name: str
+    content: str
+    reference_id: Optional[int]  # ID of the message this one replies to
+    mention_ids: Tuple[int, ...]  # IDs of the users this message mentions
+    line: str  # The message already rendered as a transcript line
+    tokens: int  # Token count of `line`
+
+    @classmethod
+    def from_message(cls, message: Message) -> "BufferedMessage":
+        content = message.content[:MESSAGE_BUFFER_MAX_CONTENT]
+        reference_id = message.reference.message_id if message.reference else None
+        line = format_compact_message(message.id, message.author.name, message.author.id, content, reference_id)
+        return cls(
+            id=message.id,
+            author_id=message.author.id,
+            author_name=message.author.name,
+            content=content,
+            reference_id=reference_id,
+            mention_ids=tuple(user.id for user in message.mentions),
+            line=line,
+            tokens=count_tokens(line),
+        )
+
+class MessageBuffer:
+    """Rolling window of recent messages per channel (or DM channel), kept in memory.
+
+    A channel is "warm" once it has been seeded from REST history; after that it
+    is kept current from `on_message` and context can be read without a REST
+    call. Channels idle for longer than `idle_ttl` are dropped, and at most
+    `max_channels` channels are kept, evicting the least recently active one."""
+
+    def __init__(self, size: int = MESSAGE_BUFFER_SIZE, max_channels: int = MESSAGE_BUFFER_MAX_CHANNELS, idle_ttl: float = MESSAGE_BUFFER_IDLE_TTL):
+        self.size = size
+        self.max_channels = max_channels
+        self.idle_ttl = idle_ttl
+        self.channels: OrderedDict[int, Deque[BufferedMessage]] = OrderedDict()  # Least recently active first
+        self.last_active: dict[int, float] = {}
+        self.last_sweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def is_warm(self, channel_id: int) -> bool:
+        return channel_id in self.channels
+
+    def add(self, message: Message):
+        """Record a new message; messages for cold channels are skipped until they are seeded."""
+        channel_id = message.channel.id
+        if channel_id not in self.channels:
+            return
+        self.channels[channel_id].append(BufferedMessage.from_message(message))
+        self._touch(channel_id)
+
+    def seed(self, channel_id: int, messages: Iterable[Message]):
+        """Fill a channel from REST history, oldest message first."""
+        self.channels[channel_id] = deque((BufferedMessage.from_message(m) for m in messages), maxlen=self.size)
+        self._touch(channel_id)
+        while len(self.channels) > self.max_channels:
+            self._evict(next(iter(self.channels)))
+
+    def recent(self, channel_id: int, limit: int, before_id: Optional[int] = None) -> List[BufferedMessage]:
+        """Return up to `limit` buffered messages, oldest first, optionally only those older than `before_id`."""
+        buffered = self.channels.get(channel_id)
+        if buffered is None:
+            self.misses += 1
+            return []
+        self.hits += 1
+        result = []
+        for entry in reversed(buffered):
+            if before_id is not None and entry.id >= before_id:
+                continue
+            result.append(entry)
+            if len(result) >= limit:
+                break
+        result.reverse()
+        return result
+
+    def get(self, channel_id: int, message_id: int) -> Optional[BufferedMessage]:
+        """Return the buffered message with `message_id`, or None if it is not buffered."""
+        for entry in reversed(self.channels.get(channel_id, ())):
+            if entry.id == message_id:
+                return entry
+        return None
+
+    def evict_idle(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self.last_sweep = now
+        # Channels are ordered by activity, so stop at the first one still active
+        while self.channels:
+            channel_id = next(iter(self.channels))
+            if now - self.last_active[channel_id] < self.idle_ttl:
+                break
+            self._evict(channel_id)
+
+    def _touch(self, channel_id: int):
+        now = time.monotonic()
+        self.last_active[channel_id] = now
+        self.channels.move_to_end(channel_id)
+        if now - self.last_sweep >= self.idle_ttl:
+            self.evict_idle(now)
+
+    def _evict(self, channel_id: int):
+        del self.channels[channel_id]
+        del self.last_active[channel_id]
+        self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "channels": len(self.channels),
+            "messages": sum(len(b) for b in self.channels.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
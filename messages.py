@@ -1,65 +1,156 @@
-from dataclasses import dataclass, field
-from typing import Dict, List, Optional
+import os
+import re
+import sys
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from dataclasses import dataclass, field, asdict, replace
+from typing import Dict, List, Optional, Tuple
 from discord import Message
 
-MAX_MESSAGE_CONTEXT = 10    
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_CONTEXT = 10  # DM messages kept per user
 MAX_RECENT_MOD_ACTIONS = 20
+MAX_SUMMARY_SEGMENTS = 20  # Cached summary segments kept per channel
 
-@dataclass
+# Actions per user and server kept in memory; every action is also archived by the storage backend
+HISTORY_HOT_ACTIONS = int(os.getenv("HISTORY_HOT_ACTIONS", str(MAX_RECENT_MOD_ACTIONS)))
+# Users per server whose actions are kept in memory, the least recently active are dropped first
+HISTORY_HOT_USERS = int(os.getenv("HISTORY_HOT_USERS", "10000"))
+# Days archived actions are kept, 0 to keep them forever
+HISTORY_ARCHIVE_DAYS = int(os.getenv("HISTORY_ARCHIVE_DAYS", "0"))
+
+# A Discord ID, bare or written as a user, role or channel mention
+DISCORD_ID = re.compile(r"<(?:@[!&]?|#)?(\d+)>|(\d+)")
+
+def to_id(value) -> Optional[int]:
+    """Normalize a Discord ID given as an int, a string or a mention to an int, or None if missing or not an ID."""
+    if type(value) is int:
+        return value
+    if not isinstance(value, str):
+        return None
+    match = DISCORD_ID.fullmatch(value.strip())
+    if match is None:
+        return None
+    return int(match.group(1) or match.group(2))
+
+def intern_name(value):
+    """Share one copy of server, channel and user names across records."""
+    return sys.intern(value) if type(value) is str else value
+
+@dataclass(slots=True, frozen=True)
 class SingleMessage:
+    """A stored message. IDs are ints and names are interned, so millions of records stay small."""
     content: str
-    server_id: Optional[str]
+    server_id: Optional[int]
     server_name: str
-    user_id: str
+    user_id: int
     user_name: str
-    channel_id: Optional[str]
+    channel_id: Optional[int]
     channel_name: Optional[str]
-    message_id: str
-    
-@dataclass
+    message_id: Optional[int]
+
+    def __post_init__(self):
+        object.__setattr__(self, "server_id", to_id(self.server_id))
+        object.__setattr__(self, "user_id", to_id(self.user_id))
+        object.__setattr__(self, "channel_id", to_id(self.channel_id))
+        object.__setattr__(self, "message_id", to_id(self.message_id))
+        object.__setattr__(self, "server_name", intern_name(self.server_name))
+        object.__setattr__(self, "user_name", intern_name(self.user_name))
+        object.__setattr__(self, "channel_name", intern_name(self.channel_name))
+
+@dataclass(slots=True, frozen=True)
 class ModAction:
     action: str
     message: SingleMessage
+    timestamp: float = 0.0  # Unix time the action was taken, 0 for actions stored before timestamps were kept
 
-@dataclass
+    def __post_init__(self):
+        object.__setattr__(self, "action", intern_name(self.action))
+
+@dataclass(slots=True, frozen=True)
+class RetentionPolicy:
+    hot_actions: int = HISTORY_HOT_ACTIONS
+    hot_users: int = HISTORY_HOT_USERS
+    archive_days: int = HISTORY_ARCHIVE_DAYS
+
+@dataclass(slots=True)
 class Server:
     id: str
     rules: str
     name: str
     recent_actions: list[ModAction]
+    # Hot tier of the per-user history: user ID -> most recent actions, least recently active user first
     actions: Dict[str, list[ModAction]] = field(default_factory=dict)
-    channels: Dict[str, dict[str, str]] = field(default_factory=dict)
+    channels: Dict[str, dict[str, int]] = field(default_factory=dict)  # Channel ID -> user ID -> last read message ID
+    revision: int = 0  # Bumped whenever the rules or recent actions change
+    retention: RetentionPolicy = field(default_factory=RetentionPolicy)
+    # Hot users whose archived actions have been merged in; others may have older actions only in the archive
+    complete: set[str] = field(default_factory=set)
+
+    def keep_hot(self, user_id: str, user_actions: list[ModAction]):
+        """Make `user_actions` the user's hot history, trimmed to the retention policy."""
+        if len(user_actions) > self.retention.hot_actions:
+            del user_actions[:len(user_actions) - self.retention.hot_actions]
+        # Reinserting moves the user to the most recently active end
+        self.actions.pop(user_id, None)
+        self.actions[user_id] = user_actions
+        while len(self.actions) > self.retention.hot_users:
+            evicted = next(iter(self.actions))
+            del self.actions[evicted]
+            self.complete.discard(evicted)
 
 @dataclass
-class SingleMessage:
-    content: str
-    server_id: str
-    server_name: str
-    user_id: str
-    user_name: str
-    channel_id: str
-    channel_name: str
-    message_id: str
+class SummarySegment:
+    first_message_id: int  # Oldest message the summary covers
+    last_message_id: int  # Newest message the summary covers
+    message_count: int
+    summary: str
+
+@dataclass
+class ChannelSummary:
+    last_message_id: int  # Newest message folded into the segments
+    segments: list[SummarySegment] = field(default_factory=list)  # Oldest first
 
 DEFAULT_RULES = """Allow everything and don't do anything."""
 
 class Messages:
-    def __init__(self):
+    def __init__(self, storage=None):
+        if storage is None:
+            # Import here to avoid circular imports
+            from db import get_storage
+            storage = get_storage()
+        self.storage = storage  # Storage backend, see db.Storage
         self.servers = {
             # Server ID -> Server
         }
         self.dm_history = {}  # User ID -> list of message IDs
+        self.channel_summaries: Dict[str, ChannelSummary] = {}  # Channel ID -> cached summary segments
+        self.last_read: Dict[Tuple[str, str], int] = {}  # (Channel ID, user ID) -> last read message ID
+        self.channel_guilds: Dict[str, str] = {}  # Channel ID -> guild ID
+        self.journal_seq = 0  # Sequence number of the last journaled mutation
+        self.journal_size = 0  # Mutations journaled since the last snapshot
     
     # We still need to track servers for rules and moderation actions
     def ensure_server_exists(self, message: Message):
-        if message.guild and message.guild.id not in self.servers:
-            self.servers[str(message.guild.id)] = Server(
-                id=message.guild.id, 
-                name=message.guild.name, 
-                rules=DEFAULT_RULES, 
-                actions={},
-                recent_actions=[]
-            )
+        if not message.guild:
+            return
+        if str(message.guild.id) not in self.servers:
+            self._apply_server(message.guild.id, message.guild.name, DEFAULT_RULES)
+            self.record({"op": "server", "id": message.guild.id, "name": message.guild.name, "rules": DEFAULT_RULES})
+        self.channel_guilds[str(message.channel.id)] = str(message.guild.id)
+
+    def _apply_server(self, server_id: str, name: str, rules: str):
+        self.servers[str(server_id)] = Server(
+            id=server_id, 
+            name=name, 
+            rules=rules, 
+            actions={},
+            recent_actions=[]
+        )
     
     def add_message(self, message: Message):
         # We only need to ensure servers exist and track DM message IDs
@@ -67,12 +158,16 @@ class Messages:
             self.ensure_server_exists(message)
         else:
             # For DMs, just track the message ID
-            if message.author.id not in self.dm_history:
-                self.dm_history[message.author.id] = []
-            
-            self.dm_history[message.author.id].append(message.id)
-            # Keep only the most recent MAX_MESSAGE_CONTEXT messages
-            self.dm_history[message.author.id] = self.dm_history[message.author.id][-MAX_MESSAGE_CONTEXT:]
+            self._apply_dm(str(message.author.id), message.id)
+            self.record({"op": "dm", "user_id": str(message.author.id), "message_id": message.id})
+
+    def _apply_dm(self, user_id: str, message_id: str):
+        if user_id not in self.dm_history:
+            self.dm_history[user_id] = []
+        
+        self.dm_history[user_id].append(message_id)
+        # Keep only the most recent MAX_MESSAGE_CONTEXT messages
+        self.dm_history[user_id] = self.dm_history[user_id][-MAX_MESSAGE_CONTEXT:]
     
     def create_single_message(self, message: Message) -> SingleMessage:
         """Create a SingleMessage object from a Discord Message"""
@@ -99,29 +194,43 @@ class Messages:
                 message_id=message.id
             )
     
-    def get_user_mod_actions(self, user_id: str, server_ids: list[str]):
-        actions = []
-        for server_id in server_ids:
-            if str(server_id) not in self.servers:
-                continue
-
-            if user_id not in self.servers[str(server_id)].actions:
-                continue
+    async def get_user_mod_actions(self, user_id: str, server_ids: list[str], limit: int = MAX_RECENT_MOD_ACTIONS, since: Optional[float] = None) -> list[ModAction]:
+        """Return the user's `limit` most recent actions across `server_ids`, oldest first.
 
-            actions.extend(self.servers[str(server_id)].actions[user_id])
+        With `since`, only actions taken at or after that Unix time are returned,
+        e.g. `since=time.time() - 86400` for the last day. Each server's list is
+        already in time order, so the newest actions are taken from a heap merge
+        of the lists in O(limit log servers). Indexed backends are queried in a
+        worker thread."""
+        if self.storage.indexed:
+            return await asyncio.to_thread(self.storage.get_user_mod_actions, user_id, [str(s) for s in server_ids], limit, since)
 
-        return actions[:MAX_RECENT_MOD_ACTIONS]
+        user_id = str(user_id)
+        per_server = [
+            reversed(self.servers[str(server_id)].actions[user_id])
+            for server_id in server_ids
+            if str(server_id) in self.servers and user_id in self.servers[str(server_id)].actions
+        ]
+        newest = heapq.merge(*per_server, key=lambda action: action.timestamp, reverse=True)
+        if since is not None:
+            newest = itertools.takewhile(lambda action: action.timestamp >= since, newest)
+        actions = list(itertools.islice(newest, limit))
+        actions.reverse()
+        return actions
     
     def add_mod_action(self, action: str, message_data: dict, user_id: str):
-        server_id = message_data.get("server_id")
+        server_id = to_id(message_data.get("server_id"))
         if not server_id:
             return
             
         if str(server_id) not in self.servers:
             return
-            
-        if user_id not in self.servers[str(server_id)].actions:
-            self.servers[str(server_id)].actions[user_id] = []
+
+        # IDs may come from the LLM; a bad one skips the record rather than failing after the action ran
+        if to_id(user_id) is None:
+            logger.warning(f"Not recording {action} in server {server_id}: invalid user ID {user_id!r}")
+            return
+        user_id = str(to_id(user_id))
             
         # Create a SingleMessage object from the message data
         message = SingleMessage(
@@ -135,30 +244,169 @@ class Messages:
             message_id=message_data.get("message_id", "")
         )
         
-        self.servers[str(server_id)].actions[user_id].append(ModAction(action, message))
-        self.servers[str(server_id)].recent_actions.append(ModAction(action, message))
+        timestamp = time.time()
+        self._apply_mod_action(action, message, user_id, timestamp)
+        self.record({"op": "mod_action", "action": action, "user_id": user_id, "message": asdict(message), "timestamp": timestamp})
+
+    def _apply_mod_action(self, action: str, message: SingleMessage, user_id: str, timestamp: float = 0.0):
+        server = self.servers[str(message.server_id)]
+        # Records are immutable, so the per-user history and the recent actions share one
+        mod_action = ModAction(action, message, timestamp)
+        # Indexed backends serve per-user history from storage instead of memory
+        if not self.storage.indexed:
+            user_id = sys.intern(str(user_id))
+            user_actions = server.actions.get(user_id, [])
+            user_actions.append(mod_action)
+            server.keep_hot(user_id, user_actions)
+
+        server.recent_actions.append(mod_action)
         # Keep only the most recent MAX_RECENT_MOD_ACTIONS
-        self.servers[str(server_id)].recent_actions = self.servers[str(server_id)].recent_actions[-MAX_RECENT_MOD_ACTIONS:]
-        
-        # Save changes to disk
-        self.save()
+        server.recent_actions = server.recent_actions[-MAX_RECENT_MOD_ACTIONS:]
+        server.revision += 1
     
+    async def load_user_history(self, user_id: str, server_ids: list[str]):
+        """Merge the user's recent archived actions into the hot tier, once per server while the user stays hot.
+
+        Call before `get_user_mod_actions` when older history may matter, e.g. for a DM appeal."""
+        if self.storage.indexed:
+            return
+        user_id = sys.intern(str(user_id))
+        for server_id in server_ids:
+            server = self.servers.get(str(server_id))
+            if server is None or user_id in server.complete:
+                continue
+            archived = await asyncio.to_thread(self.storage.load_archived_actions, str(server_id), user_id, server.retention.hot_actions)
+            # Hot actions may be newer than the archive, e.g. still waiting for a background flush
+            seen = {(a.action, a.message.message_id) for a in archived}
+            merged = archived + [a for a in server.actions.get(user_id, []) if (a.action, a.message.message_id) not in seen]
+            server.keep_hot(user_id, merged)
+            server.complete.add(user_id)
+
+    async def get_archived_actions(self, user_id: str, server_id: str, since: Optional[float] = None) -> list[ModAction]:
+        """Return the user's full archived history in the server, oldest first, e.g. for an audit.
+
+        With `since`, only actions taken at or after that Unix time are returned."""
+        if self.storage.indexed:
+            # A negative LIMIT means no limit in SQLite
+            return await asyncio.to_thread(self.storage.get_user_mod_actions, str(user_id), [str(server_id)], -1, since)
+        actions = await asyncio.to_thread(self.storage.load_archived_actions, str(server_id), str(user_id), None)
+        return actions if since is None else [action for action in actions if action.timestamp >= since]
+
+    def set_retention(self, server_id: str, **changes):
+        """Change the server's retention policy, e.g. `set_retention(server_id, archive_days=90)`."""
+        policy = replace(self.servers[str(server_id)].retention, **changes)
+        self._apply_retention(str(server_id), policy)
+        self.record({"op": "retention", "server_id": str(server_id), "retention": asdict(policy)})
+
+    def _apply_retention(self, server_id: str, policy: RetentionPolicy):
+        server = self.servers[server_id]
+        server.retention = policy
+        for user_id, user_actions in list(server.actions.items()):
+            server.keep_hot(user_id, user_actions)
+
+    def update_server_rules(self, server_id: str, rules: str):
+        self._apply_rules(str(server_id), rules)
+        self.record({"op": "rules", "server_id": str(server_id), "rules": rules})
+
+    def _apply_rules(self, server_id: str, rules: str):
+        server = self.servers[server_id]
+        server.rules = rules
+        server.revision += 1
+
+    def add_summary_segment(self, channel_id: str, segment: SummarySegment, replace_last: bool = False):
+        """Cache a summary of the channel's newest messages, or with `replace_last` one extending the newest segment."""
+        self._apply_summary_segment(str(channel_id), segment, replace_last)
+        self.record({"op": "summary_segment", "channel_id": str(channel_id), "segment": asdict(segment), "replace_last": replace_last})
+
+    def _apply_summary_segment(self, channel_id: str, segment: SummarySegment, replace_last: bool):
+        state = self.channel_summaries.setdefault(channel_id, ChannelSummary(last_message_id=segment.last_message_id))
+        if replace_last and state.segments:
+            state.segments[-1] = segment
+        else:
+            state.segments.append(segment)
+        # Keep only the most recent MAX_SUMMARY_SEGMENTS
+        state.segments = state.segments[-MAX_SUMMARY_SEGMENTS:]
+        state.last_message_id = segment.last_message_id
+
+    def drop_channel_summary(self, channel_id: str):
+        """Forget a channel's cached summary, e.g. when messages since it can no longer be folded in."""
+        self._apply_drop_channel_summary(str(channel_id))
+        self.record({"op": "summary_drop", "channel_id": str(channel_id)})
+
+    def _apply_drop_channel_summary(self, channel_id: str):
+        self.channel_summaries.pop(channel_id, None)
+
+    def record(self, record: dict):
+        """Persist a single mutation through the storage backend."""
+        self.storage.record(self, record)
+
+    def replay(self, record: dict):
+        """Apply a journaled mutation without journaling it again."""
+        op = record["op"]
+        if op == "server":
+            self._apply_server(record["id"], record["name"], record["rules"])
+        elif op == "dm":
+            self._apply_dm(record["user_id"], record["message_id"])
+        elif op == "mod_action":
+            self._apply_mod_action(record["action"], SingleMessage(**record["message"]), record["user_id"], record.get("timestamp", 0.0))
+        elif op == "rules":
+            self._apply_rules(record["server_id"], record["rules"])
+        elif op == "last_read":
+            self._apply_last_read(str(record["user_id"]), str(record["channel_id"]), int(record["message_id"]), record.get("guild_id"))
+        elif op == "summary_segment":
+            self._apply_summary_segment(record["channel_id"], SummarySegment(**record["segment"]), record["replace_last"])
+        elif op == "summary_drop":
+            self._apply_drop_channel_summary(record["channel_id"])
+        elif op == "retention":
+            self._apply_retention(record["server_id"], RetentionPolicy(**record["retention"]))
+        else:
+            raise ValueError(f"Unknown journal record: {record}")
+        self.journal_seq = record["seq"]
+
     def save(self):
         """Save the current state to disk"""
-        # Import here to avoid circular imports
-        from db import FileDB
-        FileDB.save_messages(self)
+        self.storage.save_messages(self)
+
+    def flush(self):
+        """Synchronously write every pending change to disk, e.g. on shutdown"""
+        self.storage.flush(self)
     
     @classmethod
-    def load(cls):
+    def load(cls, storage=None):
         """Load the state from disk"""
-        # Import here to avoid circular imports
-        from db import FileDB
-        return FileDB.load_messages()
+        if storage is None:
+            # Import here to avoid circular imports
+            from db import get_storage
+            storage = get_storage()
+        return storage.load_messages()
+
+    async def get_last_read(self, user_id: str, channel_id: str) -> Optional[int]:
+        if self.storage.indexed:
+            return await asyncio.to_thread(self.storage.get_last_read, str(user_id), str(channel_id))
+        return self.last_read.get((str(channel_id), str(user_id)))
+
+    def update_last_read(self, user_id: str, channel_id: str, message_id: int, guild_id: Optional[str] = None):
+        user_id, channel_id, message_id = str(user_id), str(channel_id), int(message_id)
+        guild_id = str(guild_id) if guild_id else self.channel_guilds.get(channel_id)
+        self._apply_last_read(user_id, channel_id, message_id, guild_id)
+        self.record({"op": "last_read", "user_id": user_id, "channel_id": channel_id, "message_id": message_id, "guild_id": guild_id})
+
+    def _apply_last_read(self, user_id: str, channel_id: str, message_id: int, guild_id: Optional[str] = None):
+        # Indexed backends serve unread tracking from storage instead of memory
+        if self.storage.indexed:
+            return
+        self.last_read[(channel_id, user_id)] = int(message_id)
+        if guild_id:
+            self.channel_guilds[channel_id] = guild_id
+        # The channel's server holds the entry for snapshots; channels outside a known server are kept until restart
+        server = self.servers.get(guild_id) if guild_id else None
+        if server:
+            server.channels.setdefault(channel_id, {})[user_id] = int(message_id)
 
-    def update_last_read(self, user_id: str, channel_id: str, message_id: str):
+    def index_last_read(self):
+        """Rebuild the unread index from the servers' channels after loading a snapshot."""
         for server in self.servers.values():
-            if channel_id in server.channels:
-                server.channels[channel_id][user_id] = message_id
-            else:
-                server.channels[channel_id] = {user_id: message_id}
+            for channel_id, users in server.channels.items():
+                self.channel_guilds[channel_id] = str(server.id)
+                for user_id, message_id in users.items():
+                    self.last_read[(channel_id, user_id)] = int(message_id)
@@ -0,0 +1,213 @@
+import os
+import time
+import bisect
+import inspect
+import logging
+import threading
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Port serving /metrics in Prometheus text format (0 disables the endpoint)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Address the metrics endpoint listens on; keep it local unless a scraper needs it
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Bucket upper bounds in seconds, from a cached lookup to a slow LLM response
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Bucket upper bounds in tokens per request
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Registry:
+    """The metrics rendered together on the /metrics endpoint."""
+
+    def __init__(self):
+        self.metrics: List["Metric"] = []
+
+    def register(self, metric: "Metric"):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self.metrics)
+
+REGISTRY = Registry()
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()  # Storage writes observe from worker threads
+        if registry is not None:
+            registry.register(self)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            lines.extend(self.samples())
+        return "\n".join(lines) + "\n"
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), registry: Optional[Registry] = REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.values: Dict[Tuple[str, ...], float] = {}  # Label values -> count
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self.values.get(labels, 0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}" for labels, value in self.values.items()]
+
+class Gauge(Metric):
+    """Current values, either set directly or read from `function` when rendering.
+
+    `function` returns label values -> value, so a gauge can show a queue's
+    depth without the queue updating it on every change."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), registry: Optional[Registry] = REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.values: Dict[Tuple[str, ...], float] = {}  # Label values -> value
+        self.function: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None
+
+    def set(self, value: float, *labels: str):
+        with self.lock:
+            self.values[labels] = value
+
+    def set_function(self, function: Optional[Callable[[], Dict[Tuple[str, ...], float]]]):
+        self.function = function
+
+    def get(self, *labels: str) -> float:
+        values = self.function() if self.function is not None else self.values
+        return values.get(labels, 0)
+
+    def samples(self) -> List[str]:
+        values = self.function() if self.function is not None else self.values
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}" for labels, value in values.items()]
+
+class Histogram(Metric):
+    """Counts of observed values per bucket, with their sum, for each combination of label values.
+
+    Only the bucket an observation falls into is incremented; the cumulative
+    counts Prometheus expects are computed when rendering."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS, registry: Optional[Registry] = REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple[str, ...], list] = {}  # Label values -> [per-bucket counts (the last is +Inf), sum]
+
+    def observe(self, value: float, *labels: str):
+        self._observe(value, labels)
+
+    def _observe(self, value: float, labels: Tuple[str, ...]):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *labels: str) -> "Timer":
+        """Context manager observing the seconds spent inside it."""
+        return Timer(self, labels)
+
+    def count(self, *labels: str) -> int:
+        series = self.series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                bucket_labels = _labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: Tuple[str, ...]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram._observe(time.perf_counter() - self.start, self.labels)
+        return False
+
+STAGE_SECONDS = Histogram("moderation_stage_seconds", "Seconds spent in each stage of a handler.", ("handler", "stage"))
+LLM_TOKENS = Histogram("llm_tokens", "Tokens per LLM request.", ("kind",), buckets=TOKEN_BUCKETS)
+TOOL_CALLS = Counter("moderation_tool_calls_total", "Tool calls run, by action and result.", ("action", "result"))
+TOOL_SECONDS = Histogram("moderation_tool_seconds", "Seconds spent running a tool call, excluding time queued.", ("action",))
+
+def stage(handler: str, name: str) -> Timer:
+    """Time a stage of a handler: `with stage("moderate", "llm"): ...`"""
+    return STAGE_SECONDS.time(handler, name)
+
+def timed(handler: str, name: str):
+    """Decorator timing every call of a function or coroutine function as a stage."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with STAGE_SECONDS.time(handler, name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(handler, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+async def start_http_server(port: int = METRICS_PORT, host: str = METRICS_HOST, registry: Registry = REGISTRY) -> web.AppRunner:
+    """Serve `registry` on http://host:port/metrics. Returns the runner, whose `cleanup` stops the server."""
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,59 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict
+
+from messages import Server
+
+logger = logging.getLogger(__name__)
+
+@dataclass(slots=True)
+class CompiledPrompt:
+    revision: int  # Server.revision the prompt was rendered from
+    text: str  # Rendered per-server system prompt
+    rules_block: str  # "<server name>: <rules>" line used in DM prompts
+    variants: Dict[str, str] = field(default_factory=dict)  # Suffix -> text + suffix
+
+class PromptCache:
+    """Keeps each server's rendered system prompt until the server changes.
+
+    `Messages` bumps `Server.revision` whenever the rules or recent actions
+    change, and a prompt rendered from an older revision is rebuilt on its
+    next use. A rules update also drops the server's prompt and its variants
+    at once with `invalidate`."""
+
+    def __init__(self, render: Callable[[Server], str]):
+        self.render = render
+        self.compiled: Dict[str, CompiledPrompt] = {}  # Server ID -> compiled prompt
+        self.hits = 0
+        self.builds = 0
+
+    def get(self, server: Server) -> CompiledPrompt:
+        compiled = self.compiled.get(str(server.id))
+        if compiled is not None and compiled.revision == server.revision:
+            self.hits += 1
+            return compiled
+
+        self.builds += 1
+        compiled = CompiledPrompt(
+            revision=server.revision,
+            text=self.render(server),
+            rules_block=f"{server.name}: {server.rules}",
+        )
+        self.compiled[str(server.id)] = compiled
+        return compiled
+
+    def system_prompt(self, server: Server, suffix: str = "") -> str:
+        compiled = self.get(server)
+        if suffix not in compiled.variants:
+            compiled.variants[suffix] = compiled.text + suffix
+        return compiled.variants[suffix]
+
+    def invalidate(self, server_id: str):
+        self.compiled.pop(str(server_id), None)
+
+    def stats(self) -> dict:
+        return {
+            "servers": len(self.compiled),
+            "hits": self.hits,
+            "builds": self.builds,
+        }
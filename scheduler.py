@@ -0,0 +1,234 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from metrics import Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Discord actions started at once by the scheduler
+DISCORD_MAX_IN_FLIGHT = int(os.getenv("DISCORD_MAX_IN_FLIGHT", "16"))
+# In-flight slots only enforcement (priority 0) may use, so slow DMs cannot hold every slot
+DISCORD_RESERVED_SLOTS = int(os.getenv("DISCORD_RESERVED_SLOTS", "4"))
+# Requests per second allowed across every route
+DISCORD_GLOBAL_RATE = float(os.getenv("DISCORD_GLOBAL_RATE", "50"))
+# Seconds between sweeps dropping the token buckets of idle routes
+BUCKET_SWEEP_INTERVAL = float(os.getenv("BUCKET_SWEEP_INTERVAL", "60"))
+
+# Lower runs first: enforcement before unbans before chatter
+ACTION_PRIORITIES = {
+    "ban_user": 0,
+    "kick_user": 0,
+    "delete_message": 0,
+    "bulk_delete": 0,
+    "unban_user": 1,
+    "send_dm": 2,
+    "send_message": 2,
+}
+DEFAULT_PRIORITY = 2
+
+# Action -> (requests, per seconds) allowed on one route, i.e. per guild, channel or DM
+ROUTE_RATE_LIMITS = {
+    "ban_user": (5, 5.0),
+    "kick_user": (5, 5.0),
+    "unban_user": (5, 5.0),
+    # DiscordWrapper coalesces deletions into bulk deletes; single deletes are only for old messages
+    "delete_message": (5, 1.0),
+    "bulk_delete": (5, 1.0),
+    "send_message": (5, 5.0),
+    "send_dm": (5, 5.0),
+}
+DEFAULT_ROUTE_RATE_LIMIT = (5, 5.0)
+
+SCHEDULER_WAIT_SECONDS = Histogram("scheduler_wait_seconds", "Seconds a Discord action waited in the scheduler before it was sent.", ("priority",))
+SCHEDULER_QUEUE_DEPTH = Gauge("scheduler_queue_depth", "Discord actions waiting in the scheduler.", ("priority",))
+SCHEDULER_IN_FLIGHT = Gauge("scheduler_in_flight", "Discord actions sent by the scheduler and not yet finished.")
+
+class TokenBucket:
+    """Allows `capacity` requests at once, refilled at `rate` requests per second."""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a request may be sent, 0 if one may be sent now."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        """Whether the bucket has refilled, and so behaves like a new one."""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+@dataclass(slots=True)
+class ScheduledAction:
+    action: str
+    route: Tuple[str, str]  # (action, guild/channel/user ID) sharing a rate limit
+    func: Callable[..., Awaitable[Any]]
+    args: tuple
+    future: asyncio.Future
+    enqueued: float = field(default_factory=time.monotonic)
+
+class ActionScheduler:
+    """Queues Discord side effects by priority and sends them within modelled rate limits.
+
+    Every route has a token bucket modelled on Discord's per-route limits, and
+    a global bucket caps requests across routes. The dispatcher always starts
+    the highest priority action whose route has a free token, and `reserved`
+    of the `max_in_flight` slots are kept for enforcement, so slow DMs holding
+    the other slots do not delay a ban or a deletion. Buckets that have
+    refilled are dropped every `sweep_interval` seconds, since a new bucket
+    would behave the same; this keeps one bucket per active route only."""
+
+    def __init__(self, max_in_flight: int = DISCORD_MAX_IN_FLIGHT, global_rate: float = DISCORD_GLOBAL_RATE,
+                 reserved: int = DISCORD_RESERVED_SLOTS, sweep_interval: float = BUCKET_SWEEP_INTERVAL):
+        self.max_in_flight = max_in_flight
+        # At least one slot is always left for the other priorities
+        self.reserved = max(0, min(reserved, max_in_flight - 1))
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.monotonic()
+        self.evicted_buckets = 0
+        self.queues: Dict[int, Deque[ScheduledAction]] = {}  # Priority -> queued actions, oldest first
+        self.in_flight = 0
+        self.wakeup = asyncio.Event()
+        self.dispatcher: Optional[asyncio.Task] = None
+        self.running: set[asyncio.Task] = set()  # Keeps started actions referenced until they finish
+        self.dispatched = 0
+        self.deferred = 0
+        self.wait_total: Dict[int, float] = {}  # Priority -> seconds spent queued
+        self.wait_max: Dict[int, float] = {}
+        self.wait_count: Dict[int, int] = {}
+        # The most recently created scheduler is the one exported
+        SCHEDULER_QUEUE_DEPTH.set_function(lambda: {(str(priority),): len(queue) for priority, queue in self.queues.items()})
+        SCHEDULER_IN_FLIGHT.set_function(lambda: {(): self.in_flight})
+
+    async def run(self, action: str, major_id, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        """Queue `func(*args)` and return its result once it has run."""
+        scheduled = ScheduledAction(
+            action=action,
+            route=(action, str(major_id)),
+            func=func,
+            args=args,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        self.queues.setdefault(ACTION_PRIORITIES.get(action, DEFAULT_PRIORITY), deque()).append(scheduled)
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self._dispatch())
+        self.wakeup.set()
+        return await scheduled.future
+
+    def _bucket(self, route: Tuple[str, str]) -> TokenBucket:
+        bucket = self.buckets.get(route)
+        if bucket is None:
+            requests, per = ROUTE_RATE_LIMITS.get(route[0], DEFAULT_ROUTE_RATE_LIMIT)
+            bucket = self.buckets[route] = TokenBucket(requests, requests / per)
+        return bucket
+
+    def _sweep(self, now: float):
+        self.last_sweep = now
+        for route in [route for route, bucket in self.buckets.items() if bucket.is_full(now)]:
+            del self.buckets[route]
+            self.evicted_buckets += 1
+
+    def _next_ready(self, now: float) -> Tuple[Optional[ScheduledAction], Optional[float]]:
+        """Pop the highest priority action that may be sent now.
+
+        Returns (action, None), or (None, seconds until one may be sent) when
+        every queued route is out of tokens, or (None, None) when idle or when
+        only enforcement may use the free slots."""
+        if now - self.last_sweep >= self.sweep_interval:
+            self._sweep(now)
+        global_delay = self.global_bucket.delay(now)
+        reserved_only = self.in_flight >= self.max_in_flight - self.reserved
+        soonest = None
+        for priority in sorted(self.queues):
+            if reserved_only and priority > 0:
+                break
+            queue = self.queues[priority]
+            for scheduled in queue:
+                delay = max(global_delay, self._bucket(scheduled.route).delay(now))
+                if delay == 0:
+                    queue.remove(scheduled)
+                    return scheduled, None
+                soonest = delay if soonest is None else min(soonest, delay)
+        return None, soonest
+
+    async def _dispatch(self):
+        while any(self.queues.values()):
+            self.wakeup.clear()
+            if self.in_flight >= self.max_in_flight:
+                await self.wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            scheduled, delay = self._next_ready(now)
+            if scheduled is None:
+                self.deferred += 1
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.global_bucket.take(now)
+            self._bucket(scheduled.route).take(now)
+            self._record_wait(ACTION_PRIORITIES.get(scheduled.action, DEFAULT_PRIORITY), now - scheduled.enqueued)
+            self.in_flight += 1
+            self.dispatched += 1
+            task = asyncio.create_task(self._run(scheduled))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run(self, scheduled: ScheduledAction):
+        try:
+            result = await scheduled.func(*scheduled.args)
+            if not scheduled.future.done():
+                scheduled.future.set_result(result)
+        except Exception as e:
+            if not scheduled.future.done():
+                scheduled.future.set_exception(e)
+        finally:
+            self.in_flight -= 1
+            self.wakeup.set()
+
+    def _record_wait(self, priority: int, wait: float):
+        self.wait_count[priority] = self.wait_count.get(priority, 0) + 1
+        self.wait_total[priority] = self.wait_total.get(priority, 0.0) + wait
+        self.wait_max[priority] = max(self.wait_max.get(priority, 0.0), wait)
+        SCHEDULER_WAIT_SECONDS.observe(wait, str(priority))
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "dispatched": self.dispatched,
+            "deferred": self.deferred,
+            "buckets": len(self.buckets),
+            "evicted_buckets": self.evicted_buckets,
+            "queue_depth": {priority: len(queue) for priority, queue in self.queues.items()},
+            "wait_ms": {
+                priority: {
+                    "avg": self.wait_total[priority] / count * 1000,
+                    "max": self.wait_max[priority] * 1000,
+                }
+                for priority, count in self.wait_count.items()
+            },
+        }
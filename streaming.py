@@ -0,0 +1,78 @@
+import os
+import time
+import logging
+from typing import AsyncIterable, List
+
+logger = logging.getLogger(__name__)
+
+# Seconds between edits of a reply while its text is still being generated
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# Longest message Discord accepts
+DISCORD_MESSAGE_LIMIT = 2000
+# Shown at the end of a reply while more text is on its way
+STREAM_CURSOR = " …"
+
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> List[str]:
+    """Split text into parts of at most `limit` characters, preferring line and then word breaks."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n ")
+    parts.append(text)
+    return parts
+
+class StreamingReply:
+    """A reply that is posted at once and edited as its text grows.
+
+    Edits are sent at most once every `interval` seconds. Text past Discord's
+    2000-character limit continues in follow-up messages, and follow-ups the
+    text no longer needs are deleted."""
+
+    def __init__(self, destination, interval: float = STREAM_EDIT_INTERVAL):
+        self.destination = destination  # Anything with an async send(), e.g. a channel or command context
+        self.interval = interval
+        self.messages = []  # Sent Discord messages, one per part
+        self.rendered: List[str] = []  # Text currently shown in each message
+        self.last_edit = 0.0
+
+    async def start(self, text: str):
+        await self._render(text + STREAM_CURSOR)
+        self.last_edit = time.monotonic()
+
+    async def update(self, text: str):
+        if time.monotonic() - self.last_edit < self.interval:
+            return
+        await self._render(text + STREAM_CURSOR)
+        self.last_edit = time.monotonic()
+
+    async def finish(self, text: str):
+        await self._render(text)
+
+    async def stream(self, text: str, deltas: AsyncIterable[str]) -> str:
+        """Append the streamed text to `text` as it arrives. Returns the full reply."""
+        async for delta in deltas:
+            text += delta
+            await self.update(text)
+        await self.finish(text)
+        return text
+
+    async def _render(self, text: str):
+        parts = split_message(text)
+        for index, part in enumerate(parts):
+            if index < len(self.messages):
+                if self.rendered[index] != part:
+                    await self.messages[index].edit(content=part)
+                    self.rendered[index] = part
+            else:
+                self.messages.append(await self.destination.send(part))
+                self.rendered.append(part)
+        # The cursor can push a part over the limit that the final text does not need
+        for message in self.messages[len(parts):]:
+            await message.delete()
+        del self.messages[len(parts):]
+        del self.rendered[len(parts):]
@@ -1,35 +1,143 @@
+import os
+import asyncio
+from typing import AsyncIterator, List
+
 from agent import OpenAIAgent
 import discord
 import logging
 
 from messages import SingleMessage
+from utils import count_tokens
 
 logger = logging.getLogger(__name__)
 
+# Tokens of transcript summarized in a single request; longer transcripts are summarized in chunks
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "3000"))
+# Tokens of transcript accepted per summary; the oldest messages past it are left out
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "60000"))
+# Chunk summaries requested at once
+SUMMARY_MAX_CONCURRENCY = int(os.getenv("SUMMARY_MAX_CONCURRENCY", "4"))
+
+SUMMARY_PROMPT = "Summarize the following conversation:\n{transcript}"
+CHUNK_PROMPT = "Summarize the following part of a longer conversation. Keep who said what, decisions and open questions, since this summary will be combined with the summaries of the other parts:\n{transcript}"
+FOLD_PROMPT = "The following is a summary of a conversation so far, followed by the messages sent since. Rewrite the summary so it also covers the new messages:\nSummary:\n{summary}\n\nNew messages:\n{transcript}"
+REDUCE_PROMPT = "The following are summaries of consecutive parts of one conversation, oldest first. Combine them into a single summary of the whole conversation:\n{summaries}"
+
 class Summarizer:
-    def __init__(self):
-        self.agent = OpenAIAgent()
+    """Summarizes a list of messages, oldest first.
 
-    async def summarize_messages(self, messages: list) -> str:
-        # Prepare the message content for summarization
-        message_content = "\n".join([
-            f"{msg.author.name}: {msg.content}" if isinstance(msg, discord.Message) else f"{msg.user_name}: {msg.content}" 
-            for msg in messages
-        ])
+    Transcripts longer than `chunk_tokens` are summarized map-reduce style:
+    the transcript is split into token-bounded chunks, the chunks are
+    summarized concurrently, and the partial summaries are combined into the
+    final summary."""
+
+    def __init__(self, agent: OpenAIAgent = None, chunk_tokens: int = SUMMARY_CHUNK_TOKENS, token_budget: int = SUMMARY_TOKEN_BUDGET, max_concurrency: int = SUMMARY_MAX_CONCURRENCY):
+        # Share the caller's agent when given so all LLM traffic goes through one client
+        self.agent = agent or OpenAIAgent()
+        self.chunk_tokens = chunk_tokens
+        self.token_budget = token_budget
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    def transcript_line(self, msg) -> str:
+        return f"{msg.author.name}: {msg.content}" if isinstance(msg, discord.Message) else f"{msg.user_name}: {msg.content}"
+
+    def chunk_transcript(self, messages: list) -> List[str]:
+        """Split the transcript into chunks of at most `chunk_tokens` tokens, keeping the newest `token_budget` tokens."""
+        lines = []
+        total = 0
+        for msg in reversed(messages):
+            line = self.transcript_line(msg)
+            tokens = count_tokens(line)
+            if total + tokens > self.token_budget:
+                logger.info(f"Summary token budget reached, leaving out the {len(messages) - len(lines)} oldest messages")
+                break
+            lines.append((line, tokens))
+            total += tokens
+        lines.reverse()
+
+        chunks = []
+        current = []
+        current_tokens = 0
+        for line, tokens in lines:
+            if current and current_tokens + tokens > self.chunk_tokens:
+                chunks.append("\n".join(current))
+                current = []
+                current_tokens = 0
+            current.append(line)
+            current_tokens += tokens
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
+
+    async def summarize_chunk(self, transcript: str) -> str:
+        async with self.semaphore:
+            return await self.agent.send_message(CHUNK_PROMPT.format(transcript=transcript))
 
-        # Define a prompt for summarization
-        summarization_prompt = f"Summarize the following conversation:\n{message_content}"
+    async def reduce_prompt(self, chunks: List[str]) -> str:
+        """Summarize the chunks concurrently and return the prompt combining their summaries."""
+        summaries = await asyncio.gather(*[self.summarize_chunk(chunk) for chunk in chunks])
+        return await self.combine_prompt(list(summaries))
 
-        # Use the Mistral agent to generate a summary
-        summary = await self.agent.send_message(summarization_prompt)
+    async def combine_prompt(self, summaries: List[str]) -> str:
+        """Return the prompt combining consecutive summaries, oldest first, into one.
+
+        If the summaries are too long for one request they are combined in
+        groups first."""
+        while len(summaries) > 1 and count_tokens("\n\n".join(summaries)) > self.chunk_tokens:
+            groups = []
+            group = []
+            for summary in summaries:
+                if group and count_tokens("\n\n".join(group + [summary])) > self.chunk_tokens:
+                    groups.append(group)
+                    group = []
+                group.append(summary)
+            groups.append(group)
+            if len(groups) == len(summaries):
+                # Every summary fills a request on its own; combining further cannot shrink them
+                break
+            summaries = await asyncio.gather(*[self._reduce_group(group) for group in groups])
+        return REDUCE_PROMPT.format(summaries="\n\n".join(summaries))
+
+    async def _reduce_group(self, summaries: List[str]) -> str:
+        async with self.semaphore:
+            return await self.agent.send_message(REDUCE_PROMPT.format(summaries="\n\n".join(summaries)))
+
+    async def final_prompt(self, messages: list) -> str:
+        chunks = self.chunk_transcript(messages)
+        if len(chunks) <= 1:
+            return SUMMARY_PROMPT.format(transcript=chunks[0] if chunks else "")
+        logger.info(f"Summarizing {len(messages)} messages in {len(chunks)} chunks")
+        return await self.reduce_prompt(chunks)
+
+    async def summarize_messages(self, messages: list) -> str:
+        # Use the agent to generate a summary
+        summary = await self.agent.send_message(await self.final_prompt(messages))
 
         logger.info(f"Generated summary: {summary}")
         return summary
 
+    async def stream_summary(self, messages: list) -> AsyncIterator[str]:
+        """Yield the summary text as it is generated; for long transcripts only the final combining step is streamed."""
+        async for delta in self.agent.stream_message(await self.final_prompt(messages)):
+            yield delta
+
+    async def fold_summary(self, summary: str, messages: list) -> str:
+        """Extend an existing summary with the messages sent after it, oldest first."""
+        transcript = "\n".join(self.chunk_transcript(messages))
+        return await self.agent.send_message(FOLD_PROMPT.format(summary=summary, transcript=transcript))
+
+    async def stream_combined(self, summaries: List[str]) -> AsyncIterator[str]:
+        """Yield one summary combining the given ones, oldest first. A single summary is returned as is."""
+        if len(summaries) == 1:
+            yield summaries[0]
+            return
+        async for delta in self.agent.stream_message(await self.combine_prompt(summaries)):
+            yield delta
+
     def format_message(self, msg) -> str:
         if isinstance(msg, discord.Message):
             return f"{msg.author.name}: {msg.content}"
         elif isinstance(msg, SingleMessage):
             return f"{msg.user_name}: {msg.content}"
         else:
-            return "Unknown message type"
\ No newline at end of file
+            return "Unknown message type"
@@ -9,9 +9,24 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 # Import all test modules
 from unit.test_utils import TestUtils
 from unit.test_messages import TestMessages
-from unit.test_agent import TestMistralAgent
+from unit.test_agent import TestOpenAIAgent
 from unit.test_discord_wrapper import TestDiscordWrapper
 from unit.test_moderation import TestModeration
+from unit.test_batcher import TestModerationBatcher
+from unit.test_message_buffer import TestMessageBuffer
+from unit.test_cache import TestTTLCache, TestVerdictCache
+from unit.test_db import TestFileDBJournal, TestSQLiteDB, TestWriteBehindStorage
+from unit.test_prompt_cache import TestPromptCache
+from unit.test_context_builder import TestContextBuilder
+from unit.test_tool_executor import TestToolExecutor
+from unit.test_scheduler import TestTokenBucket, TestActionScheduler
+from unit.test_ingest import TestIngestQueue
+from unit.test_streaming import TestSplitMessage, TestStreamingReply
+from unit.test_summarizer import TestSummarizer
+from unit.test_channel_summaries import TestChannelSummaries, TestFoldSummary
+from unit.test_llm_stub import TestLLMStub
+from unit.test_metrics import TestMetrics
+from unit.test_loop_monitor import TestLoopMonitor
 
 def create_test_suite():
     """Create a test suite containing all tests."""
@@ -20,9 +35,30 @@ def create_test_suite():
     # Add test cases using the correct method
     test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestUtils))
     test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMessages))
-    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMistralAgent))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestOpenAIAgent))
     test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestDiscordWrapper))
     test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestModeration))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestModerationBatcher))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMessageBuffer))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestTTLCache))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestVerdictCache))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestFileDBJournal))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestSQLiteDB))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestWriteBehindStorage))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestPromptCache))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestContextBuilder))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestToolExecutor))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestTokenBucket))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestActionScheduler))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestIngestQueue))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestSplitMessage))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestStreamingReply))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestSummarizer))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestChannelSummaries))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestFoldSummary))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestLLMStub))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMetrics))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestLoopMonitor))
     
     return test_suite
 
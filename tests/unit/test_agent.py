@@ -1,44 +1,64 @@
 import unittest
 from unittest.mock import MagicMock, patch, AsyncMock
+import asyncio
 import json
 import os
-from agent import MistralAgent
+import agent
+from agent import OpenAIAgent
 
-class TestMistralAgent(unittest.TestCase):
+class TestOpenAIAgent(unittest.IsolatedAsyncioTestCase):
     def setUp(self):
-        # Create a patch for the Mistral client
-        self.mistral_client_patch = patch('agent.Mistral')
-        self.mock_mistral_client = self.mistral_client_patch.start()
-        
-        # Create a mock for the Mistral client instance
+        # Create a mock for the async OpenAI client
         self.mock_client_instance = MagicMock()
-        self.mock_mistral_client.return_value = self.mock_client_instance
-        
-        # Create a mock for the chat.complete_async method
         self.mock_client_instance.chat = MagicMock()
-        self.mock_client_instance.chat.complete_async = AsyncMock()
-        
-        # Create a MistralAgent instance for testing
-        self.agent = MistralAgent()
-    
-    def tearDown(self):
-        # Stop the patch
-        self.mistral_client_patch.stop()
-    
+        self.mock_client_instance.chat.completions = MagicMock()
+        self.mock_client_instance.chat.completions.create = AsyncMock()
+
+        # Create an OpenAIAgent instance for testing
+        self.agent = OpenAIAgent(client=self.mock_client_instance, semaphore=asyncio.Semaphore(2))
+
+    def _mock_response(self, content):
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message = MagicMock()
+        mock_response.choices[0].message.content = content
+        mock_response.usage = None
+        return mock_response
+
     def test_init(self):
-        # Test that the MistralAgent initializes correctly
+        # Test that the OpenAIAgent initializes correctly
         self.assertEqual(self.agent.client, self.mock_client_instance)
-        self.mock_mistral_client.assert_called_once()
-    
+
+    @patch('agent._shared_client', None)
+    @patch('agent._shared_semaphore', None)
+    @patch('agent.AsyncOpenAI')
+    def test_agents_share_client_and_semaphore(self, mock_async_openai):
+        # Test that agents built without arguments share one client and one semaphore
+        first = OpenAIAgent()
+        second = OpenAIAgent()
+
+        mock_async_openai.assert_called_once()
+        self.assertIs(first.client, second.client)
+        self.assertIs(first.semaphore, second.semaphore)
+
+    @patch('agent._shared_client', None)
+    @patch('agent.OPENAI_BASE_URL', 'http://localhost:8089/v1')
+    @patch('agent.AsyncOpenAI')
+    def test_shared_client_uses_configured_base_url(self, mock_async_openai):
+        # Test that the shared client can be pointed at another endpoint, such as a local stub
+        agent.get_shared_client()
+
+        self.assertEqual(mock_async_openai.call_args.kwargs["base_url"], 'http://localhost:8089/v1')
+
     def test_process_tool_call_single(self):
         # Test processing a single tool call
         message = "Here's a tool call: <tool>{\"name\": \"test_tool\", \"parameters\": {\"param1\": \"value1\"}}</tool>"
         expected_tool_calls = [{"name": "test_tool", "parameters": {"param1": "value1"}}]
-        
+
         tool_calls = self.agent.process_tool_call(message)
-        
+
         self.assertEqual(tool_calls, expected_tool_calls)
-    
+
     def test_process_tool_call_multiple(self):
         # Test processing multiple tool calls
         message = """
@@ -49,76 +69,109 @@ class TestMistralAgent(unittest.TestCase):
             {"name": "tool1", "parameters": {"param1": "value1"}},
             {"name": "tool2", "parameters": {"param2": "value2"}}
         ]
-        
+
         tool_calls = self.agent.process_tool_call(message)
-        
+
         self.assertEqual(tool_calls, expected_tool_calls)
-    
+
     def test_process_tool_call_no_tools(self):
         # Test processing a message with no tool calls
         message = "This message doesn't contain any tool calls."
-        
+
         tool_calls = self.agent.process_tool_call(message)
-        
+
         self.assertEqual(tool_calls, [])
-    
-    @patch('agent.MISTRAL_MODEL', 'test-model')
+
+    @patch('agent.OPENAI_MODEL', 'test-model')
     async def test_send_message(self):
-        # Create a mock response
-        mock_response = MagicMock()
-        mock_response.choices = [MagicMock()]
-        mock_response.choices[0].message = MagicMock()
-        mock_response.choices[0].message.content = "This is a test response"
-        
-        # Set the mock response for the complete_async method
-        self.mock_client_instance.chat.complete_async.return_value = mock_response
-        
+        # Set the mock response for the create method
+        self.mock_client_instance.chat.completions.create.return_value = self._mock_response("This is a test response")
+
         # Test sending a message
         message = "This is a test message"
         system_prompt = "This is a test system prompt"
-        
+
         response = await self.agent.send_message(message, system_prompt)
-        
-        # Check that the complete_async method was called with the correct arguments
-        self.mock_client_instance.chat.complete_async.assert_called_once_with(
+
+        # Check that the create method was awaited with the correct arguments
+        self.mock_client_instance.chat.completions.create.assert_awaited_once_with(
             model='test-model',
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": message},
             ],
         )
-        
+
         # Check that the correct response was returned
         self.assertEqual(response, "This is a test response")
-    
-    @patch('agent.MISTRAL_MODEL', 'test-model')
-    @patch('agent.SYSTEM_PROMPT', 'default-system-prompt')
+
+    @patch('agent.OPENAI_MODEL', 'test-model')
     async def test_send_message_default_system_prompt(self):
-        # Create a mock response
-        mock_response = MagicMock()
-        mock_response.choices = [MagicMock()]
-        mock_response.choices[0].message = MagicMock()
-        mock_response.choices[0].message.content = "This is a test response"
-        
-        # Set the mock response for the complete_async method
-        self.mock_client_instance.chat.complete_async.return_value = mock_response
-        
-        # Test sending a message with the default system prompt
+        # Test that the default system prompt is sent when none is given
+        self.mock_client_instance.chat.completions.create.return_value = self._mock_response("This is a test response")
         message = "This is a test message"
-        
+
         response = await self.agent.send_message(message)
-        
-        # Check that the complete_async method was called with the correct arguments
-        self.mock_client_instance.chat.complete_async.assert_called_once_with(
+
+        self.mock_client_instance.chat.completions.create.assert_awaited_once_with(
             model='test-model',
             messages=[
-                {"role": "system", "content": "default-system-prompt"},
+                {"role": "system", "content": agent.SYSTEM_PROMPT},
                 {"role": "user", "content": message},
             ],
         )
-        
-        # Check that the correct response was returned
         self.assertEqual(response, "This is a test response")
 
+    async def test_send_message_records_cached_tokens(self):
+        # Test that token usage, including cached prompt tokens, is accumulated
+        mock_response = self._mock_response("ok")
+        mock_response.usage = MagicMock(prompt_tokens=1200, completion_tokens=30)
+        mock_response.usage.prompt_tokens_details.cached_tokens = 1024
+        self.mock_client_instance.chat.completions.create.return_value = mock_response
+
+        await self.agent.send_message("This is a test message")
+
+        stats = self.agent.usage_stats()
+        self.assertEqual(stats["prompt_tokens"], 1200)
+        self.assertEqual(stats["cached_tokens"], 1024)
+        self.assertEqual(stats["completion_tokens"], 30)
+
+    async def test_stream_tool_calls_yields_each_completed_block(self):
+        # Test that tool calls are yielded as soon as their closing tag is streamed
+        deltas = ['Sure. <tool>{"action": "send_dm", ', '"args": {}}</tool> and <to', 'ol>{"action": "unban_user", "args": {}}</tool>']
+
+        async def stream():
+            for delta in deltas:
+                chunk = MagicMock(usage=None)
+                chunk.choices = [MagicMock()]
+                chunk.choices[0].delta.content = delta
+                yield chunk
+
+        self.mock_client_instance.chat.completions.create.return_value = stream()
+
+        tool_calls = [tool_call async for tool_call in self.agent.stream_tool_calls("This is a test message")]
+
+        self.assertEqual([c["action"] for c in tool_calls], ["send_dm", "unban_user"])
+        self.assertTrue(self.mock_client_instance.chat.completions.create.call_args.kwargs["stream"])
+
+    async def test_send_message_respects_concurrency_cap(self):
+        # Test that no more than the semaphore's worth of requests are in flight
+        in_flight = 0
+        peak = 0
+
+        async def slow_create(**kwargs):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return self._mock_response("ok")
+
+        self.mock_client_instance.chat.completions.create.side_effect = slow_create
+
+        await asyncio.gather(*[self.agent.send_message(f"message {i}") for i in range(6)])
+
+        self.assertEqual(peak, 2)
+
 if __name__ == "__main__":
-    unittest.main() 
\ No newline at end of file
+    unittest.main()
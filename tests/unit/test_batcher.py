@@ -0,0 +1,85 @@
+import unittest
+from unittest.mock import MagicMock, AsyncMock
+import asyncio
+from batcher import ModerationBatcher
+from ingest import IngestQueue
+
+class TestModerationBatcher(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Create a handler that records every batch it receives
+        self.batches = []
+
+        async def handler(batch):
+            self.batches.append([m.id for m in batch])
+            return len(batch)
+
+        self.handler = handler
+
+    def _message(self, message_id, channel_id=1):
+        message = MagicMock()
+        message.id = message_id
+        message.channel.id = channel_id
+        return message
+
+    async def test_messages_in_window_share_a_batch(self):
+        # Test that messages from the same channel within the window are handled together
+        batcher = ModerationBatcher(self.handler, window=0.01, max_batch_size=10)
+
+        results = await asyncio.gather(*[batcher.submit(self._message(i)) for i in range(3)])
+
+        self.assertEqual(self.batches, [[0, 1, 2]])
+        self.assertEqual(results, [3, 3, 3])
+
+    async def test_channels_are_batched_separately(self):
+        # Test that messages from different channels never share a batch
+        batcher = ModerationBatcher(self.handler, window=0.01, max_batch_size=10)
+
+        await asyncio.gather(batcher.submit(self._message(1, channel_id=1)), batcher.submit(self._message(2, channel_id=2)))
+
+        self.assertEqual(sorted(self.batches), [[1], [2]])
+
+    async def test_full_batch_flushes_without_waiting(self):
+        # Test that reaching the maximum batch size flushes before the window ends
+        batcher = ModerationBatcher(self.handler, window=60, max_batch_size=2)
+
+        await asyncio.wait_for(asyncio.gather(batcher.submit(self._message(1)), batcher.submit(self._message(2))), timeout=1)
+
+        self.assertEqual(self.batches, [[1, 2]])
+        self.assertEqual(batcher.stats()["batches_flushed"], 1)
+
+    async def test_handler_error_reaches_every_submitter(self):
+        # Test that a failing batch raises for every message in it
+        batcher = ModerationBatcher(AsyncMock(side_effect=RuntimeError("boom")), window=0.01, max_batch_size=10)
+
+        results = await asyncio.gather(batcher.submit(self._message(1)), batcher.submit(self._message(2)), return_exceptions=True)
+
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+
+    async def test_enqueue_returns_while_window_is_open(self):
+        # Test that queueing a message does not wait for its batch to be handled
+        batcher = ModerationBatcher(self.handler, window=0.05, max_batch_size=10)
+
+        waiter = batcher.enqueue(self._message(1))
+
+        self.assertFalse(waiter.done())
+        self.assertEqual(await waiter, 1)
+
+    async def test_batches_are_not_capped_by_ingest_workers(self):
+        # Test that a batch holds more messages than there are ingest workers
+        batcher = ModerationBatcher(self.handler, window=0.05, max_batch_size=10)
+
+        async def moderate(message):
+            batcher.enqueue(message)
+
+        ingest = IngestQueue(moderate, workers=2)
+        for i in range(5):
+            message = self._message(i)
+            message.guild.id = 1
+            ingest.submit(message)
+        await asyncio.sleep(0.1)
+        await ingest.stop()
+
+        self.assertEqual(self.batches, [[0, 1, 2, 3, 4]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -54,9 +54,8 @@ class TestBot(unittest.TestCase):
         # Check that process_commands was called
         self.mock_bot.process_commands.assert_not_called()
         
-        # Check that moderate and handle_user_conversation were not called
-        self.mock_moderation.moderate.assert_not_called()
-        self.mock_moderation.handle_user_conversation.assert_not_called()
+        # Check that the message was not queued
+        self.mock_moderation.ingest.submit.assert_not_called()
     
     async def test_on_message_command(self):
         # Test handling a message that starts with the command prefix
@@ -68,9 +67,8 @@ class TestBot(unittest.TestCase):
         # Check that process_commands was called
         self.mock_bot.process_commands.assert_called_once_with(self.mock_message)
         
-        # Check that moderate and handle_user_conversation were not called
-        self.mock_moderation.moderate.assert_not_called()
-        self.mock_moderation.handle_user_conversation.assert_not_called()
+        # Check that the message was not queued
+        self.mock_moderation.ingest.submit.assert_not_called()
     
     async def test_on_message_guild(self):
         # Test handling a message from a guild
@@ -81,11 +79,8 @@ class TestBot(unittest.TestCase):
         # Check that process_commands was called
         self.mock_bot.process_commands.assert_called_once_with(self.mock_message)
         
-        # Check that moderate was called
-        self.mock_moderation.moderate.assert_called_once_with(self.mock_message)
-        
-        # Check that handle_user_conversation was not called
-        self.mock_moderation.handle_user_conversation.assert_not_called()
+        # Check that the message was queued for moderation
+        self.mock_moderation.ingest.submit.assert_called_once_with(self.mock_message)
     
     async def test_on_message_dm(self):
         # Test handling a direct message
@@ -97,11 +92,8 @@ class TestBot(unittest.TestCase):
         # Check that process_commands was called
         self.mock_bot.process_commands.assert_called_once_with(self.mock_message)
         
-        # Check that moderate was not called
-        self.mock_moderation.moderate.assert_not_called()
-        
-        # Check that handle_user_conversation was called
-        self.mock_moderation.handle_user_conversation.assert_called_once_with(self.mock_message)
+        # Check that the message was queued for the DM handler
+        self.mock_moderation.ingest.submit.assert_called_once_with(self.mock_message)
     
     async def test_ping_no_arg(self):
         # Test the ping command with no argument
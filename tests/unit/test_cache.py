@@ -0,0 +1,140 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from discord import Message
+from cache import TTLCache, VerdictCache, normalize_content
+
+class TestTTLCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        # Test that the least recently used entry is dropped first
+        cache = TTLCache(max_entries=2, ttl=60)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    @patch('cache.time.monotonic')
+    def test_ttl_expiry(self, mock_monotonic):
+        # Test that entries expire after the TTL
+        mock_monotonic.return_value = 100
+        cache = TTLCache(max_entries=2, ttl=10)
+        cache.put("a", 1)
+
+        mock_monotonic.return_value = 111
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+class TestVerdictCache(unittest.TestCase):
+    def setUp(self):
+        # Create a VerdictCache instance for testing
+        self.cache = VerdictCache(max_entries=10, ttl=60)
+        self.rules = "No spam."
+
+    def _message(self, message_id, user_id, user_name, content="Buy cheap followers now!"):
+        message = MagicMock(spec=Message)
+        message.id = message_id
+        message.content = content
+        message.author.id = user_id
+        message.author.name = user_name
+        message.channel.id = 456789123
+        message.guild.id = 789123456
+        return message
+
+    def test_normalize_content(self):
+        # Test that case, whitespace and zero-width characters are ignored
+        self.assertEqual(normalize_content("  Buy\u200b  CHEAP\nfollowers "), "buy cheap followers")
+
+    def test_hit_substitutes_new_message_ids(self):
+        # Test that a cached plan is replayed against the new message
+        original = self._message(1001, 2001, "Spammer")
+        tool_calls = [
+            {"action": "delete_message", "args": {"channel_id": "456789123", "message_id": "1001"}},
+            {"action": "send_dm", "args": {"user_id": "2001", "message": "Spammer, your message was removed."}},
+        ]
+        self.cache.put(original, self.rules, tool_calls)
+
+        copy = self._message(1002, 2002, "OtherSpammer", content="buy cheap   followers now!")
+        replayed = self.cache.get(copy, self.rules)
+
+        self.assertEqual(replayed, [
+            {"action": "delete_message", "args": {"channel_id": "456789123", "message_id": "1002"}},
+            {"action": "send_dm", "args": {"user_id": "2002", "message": "OtherSpammer, your message was removed."}},
+        ])
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_text_is_not_rewritten(self):
+        # Test that IDs and names inside free text are left alone, unless the name is a whole word
+        original = self._message(1001, 2001, "Al")
+        tool_calls = [
+            {"action": "send_message", "args": {"channel_id": "456789123", "message": "Also, message 1001 from user 2001 was removed."}},
+            {"action": "ban_user", "args": {"server_id": "789123456", "user_id": "2001"}},
+        ]
+        self.cache.put(original, self.rules, tool_calls)
+        self.cache.put(self._message(1003, 2003, "Sam"), "No links.", [{"action": "send_dm", "args": {"user_id": "2003", "message": "Sam, Samantha's rules apply."}}])
+
+        replayed = self.cache.get(self._message(1002, 2002, "Bo"), self.rules)
+        renamed = self.cache.get(self._message(1004, 2004, "Kim"), "No links.")
+
+        self.assertEqual(replayed, [
+            {"action": "send_message", "args": {"channel_id": "456789123", "message": "Also, message 1001 from user 2001 was removed."}},
+            {"action": "ban_user", "args": {"server_id": "789123456", "user_id": "2002"}},
+        ])
+        self.assertEqual(renamed[0]["args"]["message"], "Kim, Samantha's rules apply.")
+
+    def test_empty_plan_is_cached(self):
+        # Test that "no action" verdicts are cached too
+        self.cache.put(self._message(1001, 2001, "User"), self.rules, [])
+
+        self.assertEqual(self.cache.get(self._message(1002, 2002, "User"), self.rules), [])
+
+    def test_rules_change_misses(self):
+        # Test that a different rules text never hits an old verdict
+        self.cache.put(self._message(1001, 2001, "User"), self.rules, [])
+
+        self.assertIsNone(self.cache.get(self._message(1002, 2002, "User"), "No links."))
+
+    def test_invalidate_server(self):
+        # Test that invalidating a server drops its verdicts
+        self.cache.put(self._message(1001, 2001, "User"), self.rules, [])
+
+        self.cache.invalidate_server("789123456")
+
+        self.assertIsNone(self.cache.get(self._message(1002, 2002, "User"), self.rules))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_invalidate_server_keeps_other_servers(self):
+        # Test that invalidation finds a server's verdicts among evictions and other servers' verdicts
+        for i in range(100):
+            self.cache.put(self._message(1000 + i, 2001, "User", content=f"Message {i}"), self.rules, [])
+        other = self._message(2000, 2001, "User")
+        other.guild.id = 111222333
+        self.cache.put(other, self.rules, [])
+
+        self.cache.invalidate_server("789123456")
+
+        self.assertEqual(self.cache.stats()["size"], 1)
+        self.assertEqual(self.cache.get(other, self.rules), [])
+
+    def test_plans_acting_on_other_messages_are_not_cached(self):
+        # Test that a plan deleting an earlier message from the context is never replayed for a copy
+        original = self._message(1001, 2001, "Spammer")
+        self.cache.put(original, self.rules, [
+            {"action": "delete_message", "args": {"channel_id": "456789123", "message_id": "1001"}},
+            {"action": "delete_message", "args": {"channel_id": "456789123", "message_id": "999"}},
+        ])
+
+        self.assertIsNone(self.cache.get(self._message(1002, 2002, "OtherSpammer"), self.rules))
+
+    def test_rules_updates_are_not_cached(self):
+        # Test that plans which change the rules are never replayed
+        self.cache.put(self._message(1001, 2001, "Admin"), self.rules, [{"action": "update_server_rules", "args": {"server_id": "789123456", "rules": "New"}}])
+
+        self.assertIsNone(self.cache.get(self._message(1002, 2002, "Admin"), self.rules))
+
+if __name__ == "__main__":
+    unittest.main()
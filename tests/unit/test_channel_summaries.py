@@ -0,0 +1,141 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+from channel_summaries import ChannelSummaries
+from messages import Messages, SummarySegment
+from summarizer import Summarizer, FOLD_PROMPT, REDUCE_PROMPT
+
+class FakeChannel:
+    """A channel whose history honours `after`, newest first like Discord's."""
+
+    def __init__(self, channel_id=456789123):
+        self.id = channel_id
+        self.messages = []  # Oldest first
+
+    def add(self, message_id, content="hello", bot=False):
+        message = MagicMock()
+        message.id = message_id
+        message.content = content
+        message.author.name = "TestUser"
+        message.author.bot = bot
+        self.messages.append(message)
+        return message
+
+    async def history(self, limit=100, after=None, oldest_first=False):
+        found = [m for m in reversed(self.messages) if after is None or m.id > after.id]
+        for message in found[:limit]:
+            yield message
+
+class TestChannelSummaries(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.messages = Messages()
+        self.messages.record = MagicMock()
+        self.summarizer = MagicMock()
+        self.summarizer.summarize_messages = AsyncMock(return_value="new segment")
+        self.summarizer.fold_summary = AsyncMock(return_value="folded")
+        self.channel_summaries = ChannelSummaries(self.summarizer, self.messages, segment_messages=5)
+        self.channel = FakeChannel()
+
+    def _seed(self, count=3):
+        seeded = [self.channel.add(i) for i in range(1, count + 1)]
+        self.channel_summaries.seed(self.channel.id, seeded, "seed")
+
+    async def test_uncached_channel_is_a_miss(self):
+        # Test that a channel without a cached summary is left to the caller
+        self.channel.add(1)
+
+        self.assertIsNone(await self.channel_summaries.latest(self.channel, 1))
+        self.summarizer.summarize_messages.assert_not_called()
+
+    async def test_no_new_messages_reuses_cache(self):
+        # Test that a cached summary is answered without any LLM request
+        self._seed()
+
+        segments = await self.channel_summaries.latest(self.channel, 3)
+
+        self.assertEqual([s.summary for s in segments], ["seed"])
+        self.summarizer.fold_summary.assert_not_called()
+        self.summarizer.summarize_messages.assert_not_called()
+
+    async def test_delta_is_folded_into_last_segment(self):
+        # Test that only the new messages are sent, folded into the newest segment
+        self._seed()
+        self.channel.add(4)
+        self.channel.add(5, content="!summarize")
+        self.channel.add(6, content="a summary", bot=True)
+
+        segments = await self.channel_summaries.latest(self.channel, 3)
+
+        previous, delta = self.summarizer.fold_summary.call_args.args
+        self.assertEqual(previous, "seed")
+        self.assertEqual([m.id for m in delta], [4])
+        self.assertEqual(segments, [SummarySegment(1, 4, 4, "folded")])
+
+    async def test_full_segment_starts_a_new_one(self):
+        # Test that messages past the segment size start a new segment
+        self._seed()
+        for i in range(4, 7):
+            self.channel.add(i)
+
+        await self.channel_summaries.refresh(self.channel)
+
+        state = self.channel_summaries.get(self.channel.id)
+        self.assertEqual([(s.first_message_id, s.last_message_id) for s in state.segments], [(1, 3), (4, 6)])
+        self.assertEqual([m.id for m in self.summarizer.summarize_messages.call_args.args[0]], [4, 5, 6])
+
+    async def test_uncovered_request_does_not_fold(self):
+        # Test that a request the cache cannot cover is a miss without any LLM request
+        self._seed()
+        self.channel.add(4)
+
+        self.assertIsNone(await self.channel_summaries.latest(self.channel, 10))
+        self.summarizer.fold_summary.assert_not_called()
+        self.assertEqual(self.channel_summaries.get(self.channel.id).last_message_id, 3)
+
+    async def test_gap_drops_cached_summary(self):
+        # Test that a summary is dropped rather than extended past messages it could not fetch
+        self.channel_summaries.delta_limit = 2
+        self._seed()
+        for i in range(4, 7):
+            self.channel.add(i)
+
+        self.assertIsNone(await self.channel_summaries.latest(self.channel, 1))
+        self.assertIsNone(self.channel_summaries.get(self.channel.id))
+        self.summarizer.summarize_messages.assert_not_called()
+        self.messages.record.assert_called_with({"op": "summary_drop", "channel_id": str(self.channel.id)})
+
+    async def test_since_requires_cache_to_reach_last_read(self):
+        # Test that unread requests are answered only when the cache covers every unread message
+        self.channel_summaries.seed(self.channel.id, [self.channel.add(5), self.channel.add(6)], "seed", after_id=4)
+
+        self.assertIsNone(await self.channel_summaries.since(self.channel, 2))
+        self.assertEqual([s.summary for s in await self.channel_summaries.since(self.channel, 4)], ["seed"])
+        self.assertEqual(await self.channel_summaries.since(self.channel, 6), [])
+
+    async def test_stream_combines_segments(self):
+        # Test that one segment is returned as is and several are combined
+        agent = MagicMock()
+        agent.stream_message = MagicMock(side_effect=self._deltas)
+        channel_summaries = ChannelSummaries(Summarizer(agent=agent), self.messages)
+
+        single = [d async for d in channel_summaries.stream([SummarySegment(1, 2, 2, "only")])]
+        combined = [d async for d in channel_summaries.stream([SummarySegment(1, 2, 2, "a"), SummarySegment(3, 4, 2, "b")])]
+
+        self.assertEqual(single, ["only"])
+        self.assertEqual(combined, [REDUCE_PROMPT.format(summaries="a\n\nb")])
+
+    async def _deltas(self, prompt):
+        yield prompt
+
+class TestFoldSummary(unittest.IsolatedAsyncioTestCase):
+    async def test_fold_prompt_includes_previous_summary_and_delta(self):
+        # Test that folding sends the previous summary with only the new messages
+        agent = MagicMock()
+        agent.send_message = AsyncMock(return_value="folded")
+        message = MagicMock()
+        message.user_name = "TestUser"
+        message.content = "new message"
+
+        result = await Summarizer(agent=agent).fold_summary("old summary", [message])
+
+        self.assertEqual(result, "folded")
+        agent.send_message.assert_awaited_once_with(FOLD_PROMPT.format(summary="old summary", transcript="TestUser: new message"))
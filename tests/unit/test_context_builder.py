@@ -0,0 +1,62 @@
+import unittest
+from unittest.mock import MagicMock
+from discord import Message, Guild
+from message_buffer import BufferedMessage
+from context_builder import ContextBuilder
+from utils import count_tokens
+
+class TestContextBuilder(unittest.TestCase):
+    def setUp(self):
+        # Create a ContextBuilder instance for testing
+        self.builder = ContextBuilder(budget=1000)
+
+    def _message(self, message_id, author_id, content="hello there", reference_id=None, mention_ids=()):
+        message = MagicMock(spec=Message)
+        message.id = message_id
+        message.content = content
+        message.author.id = author_id
+        message.author.name = f"user{author_id}"
+        message.channel.id = 456789123
+        message.channel.name = "test-channel"
+        message.guild = MagicMock(spec=Guild)
+        message.guild.id = 789123456
+        message.guild.name = "Test Server"
+        message.reference = MagicMock(message_id=reference_id) if reference_id else None
+        message.mentions = [MagicMock(id=user_id) for user_id in mention_ids]
+        return message
+
+    def test_count_tokens(self):
+        # Test that token counts grow with the text
+        self.assertGreater(count_tokens("a much longer piece of text " * 10), count_tokens("short"))
+
+    def test_compact_transcript(self):
+        # Test that the channel details are written once and each message on one line
+        candidates = [BufferedMessage.from_message(self._message(1, 100, "first\nline")), BufferedMessage.from_message(self._message(2, 200, "second", reference_id=1))]
+
+        transcript = self.builder.build([self._message(3, 300)], candidates)
+
+        lines = transcript.split("\n")
+        self.assertEqual(lines[0], "#test-channel (channel id: 456789123) in server Test Server (server id: 789123456)")
+        self.assertEqual(lines[2:], ["[1] user100 (100): first line", "[2] user200 (200) -> 1: second"])
+        self.assertEqual(transcript.count("789123456"), 1)
+
+    def test_budget_prefers_relevant_messages(self):
+        # Test that a tight budget keeps the reply chain and same-author messages over recent chatter
+        candidates = [
+            BufferedMessage.from_message(self._message(1, 100, "original question")),
+            BufferedMessage.from_message(self._message(2, 300, "earlier message from the same author")),
+            *[BufferedMessage.from_message(self._message(i, 200, f"unrelated chatter {i}")) for i in range(3, 8)],
+        ]
+        budget = candidates[0].tokens + candidates[1].tokens + candidates[6].tokens
+
+        selected = self.builder.select([self._message(8, 300, reference_id=1)], candidates, budget=budget)
+
+        self.assertEqual([m.id for m in selected], [1, 2, 7])
+        self.assertEqual(self.builder.stats()["included"], 3)
+
+    def test_empty_context(self):
+        # Test that no candidates gives an empty transcript
+        self.assertEqual(self.builder.build([self._message(1, 100)], []), "")
+
+if __name__ == "__main__":
+    unittest.main()
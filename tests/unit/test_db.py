@@ -0,0 +1,440 @@
+import os
+import shutil
+import json
+import asyncio
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+from discord import Message, Guild, User
+import db
+from db import FileDB, SQLiteDB, WriteBehindStorage
+from messages import Messages, SummarySegment, RetentionPolicy
+
+class TestFileDBJournal(unittest.TestCase):
+    def setUp(self):
+        # Point the database at a temporary directory
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.patches = [
+            patch('db.DB_DIR', self.tmp_dir.name),
+            patch('db.SERVERS_FILE', os.path.join(self.tmp_dir.name, "servers.json")),
+            patch('db.DM_HISTORY_FILE', os.path.join(self.tmp_dir.name, "dm_history.json")),
+            patch('db.JOURNAL_FILE', os.path.join(self.tmp_dir.name, "journal.jsonl")),
+            patch('db.SUMMARIES_FILE', os.path.join(self.tmp_dir.name, "channel_summaries.json")),
+            patch('db.ARCHIVE_DIR', os.path.join(self.tmp_dir.name, "archive")),
+            patch('db._archive_pruned', {}),
+            patch('db.JOURNAL_MODE', True),
+            patch('db.JOURNAL_COMPACT_EVERY', 100),
+        ]
+        for p in self.patches:
+            p.start()
+
+        # Create a mock guild message
+        self.mock_message = MagicMock(spec=Message)
+        self.mock_message.id = 987654321
+        self.mock_message.guild = MagicMock(spec=Guild)
+        self.mock_message.guild.id = 789123456
+        self.mock_message.guild.name = "Test Server"
+        self.mock_message.author = MagicMock(spec=User)
+        self.mock_message.author.id = 123456789
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.tmp_dir.cleanup()
+
+    def _add_action(self, messages, index):
+        messages.add_mod_action("delete_message", {
+            "content": f"spam {index}",
+            "server_id": 789123456,
+            "server_name": "Test Server",
+            "channel_id": 456789123,
+            "channel_name": "test-channel",
+            "message_id": index,
+        }, "123456789")
+
+    def test_mutations_are_appended_not_snapshotted(self):
+        # Test that mutations go to the journal without writing a snapshot
+        messages = Messages()
+        messages.ensure_server_exists(self.mock_message)
+        self._add_action(messages, 1)
+        messages.update_server_rules("789123456", "No spam.")
+
+        self.assertFalse(os.path.exists(db.SERVERS_FILE))
+        with open(db.JOURNAL_FILE) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r["op"] for r in records], ["server", "mod_action", "rules"])
+        self.assertEqual([r["seq"] for r in records], [1, 2, 3])
+
+    def test_load_replays_journal_after_snapshot(self):
+        # Test that loading applies journal records newer than the snapshot
+        messages = Messages()
+        messages.ensure_server_exists(self.mock_message)
+        self._add_action(messages, 1)
+        messages.save()
+        self._add_action(messages, 2)
+        messages.update_server_rules("789123456", "No spam.")
+
+        loaded = FileDB.load_messages()
+
+        server = loaded.servers["789123456"]
+        self.assertEqual(server.rules, "No spam.")
+        self.assertEqual([a.message.content for a in server.actions["123456789"]], ["spam 1", "spam 2"])
+        self.assertEqual(loaded.journal_seq, 4)
+
+    def test_compaction_resets_journal(self):
+        # Test that a snapshot is written once the journal reaches the compaction threshold
+        messages = Messages()
+        messages.ensure_server_exists(self.mock_message)
+        with patch('db.JOURNAL_COMPACT_EVERY', 3):
+            self._add_action(messages, 1)
+            self._add_action(messages, 2)
+
+        self.assertTrue(os.path.exists(db.SERVERS_FILE))
+        self.assertFalse(os.path.exists(db.JOURNAL_FILE))
+        self.assertEqual(messages.journal_size, 0)
+        self.assertEqual(len(FileDB.load_messages().servers["789123456"].actions["123456789"]), 2)
+
+    def test_summary_segments_survive_snapshot_and_journal(self):
+        # Test that cached channel summaries are restored from the snapshot and the journal
+        messages = Messages()
+        messages.add_summary_segment(456789123, SummarySegment(1, 5, 5, "first"))
+        messages.save()
+        messages.add_summary_segment(456789123, SummarySegment(1, 8, 8, "first, extended"), replace_last=True)
+        messages.add_summary_segment(456789123, SummarySegment(9, 12, 4, "second"))
+
+        state = FileDB.load_messages().channel_summaries["456789123"]
+
+        self.assertEqual([s.summary for s in state.segments], ["first, extended", "second"])
+        self.assertEqual(state.last_message_id, 12)
+
+    def test_last_read_survives_reload(self):
+        # Test that unread tracking is restored from the snapshot and the journal as int IDs
+        self.mock_message.channel.id = 456789123
+        messages = Messages()
+        messages.ensure_server_exists(self.mock_message)
+        messages.update_last_read(123456789, 456789123, 1001)
+        messages.save()
+        messages.update_last_read(555, 456789123, 1002)
+
+        loaded = FileDB.load_messages()
+
+        self.assertEqual(asyncio.run(loaded.get_last_read("123456789", "456789123")), 1001)
+        self.assertEqual(asyncio.run(loaded.get_last_read(555, 456789123)), 1002)
+
+    def test_archive_serves_history_outside_hot_tier(self):
+        # Test that every action is archived and read back lazily once it leaves memory
+        messages = Messages()
+        messages.ensure_server_exists(self.mock_message)
+        messages.set_retention(789123456, hot_actions=2)
+        for i in range(5):
+            self._add_action(messages, i)
+        server = messages.servers["789123456"]
+        self.assertEqual(len(server.actions["123456789"]), 2)
+
+        # The user was evicted and came back with a new action
+        del server.actions["123456789"]
+        self._add_action(messages, 5)
+        asyncio.run(messages.load_user_history("123456789", ["789123456"]))
+        full = asyncio.run(messages.get_archived_actions("123456789", "789123456"))
+
+        self.assertEqual([a.message.content for a in server.actions["123456789"]], ["spam 4", "spam 5"])
+        self.assertEqual([a.message.content for a in full], [f"spam {i}" for i in range(6)])
+
+    def test_retention_survives_reload_and_prunes_archive(self):
+        # Test that the per-server policy is persisted and expired archive entries are dropped
+        messages = Messages()
+        messages.ensure_server_exists(self.mock_message)
+        self._add_action(messages, 1)
+        with patch('db.time.time', return_value=time.time() + 2 * 86400):
+            messages.set_retention(789123456, archive_days=1)
+            self._add_action(messages, 2)
+            messages.save()
+
+        loaded = FileDB.load_messages()
+
+        self.assertEqual(loaded.servers["789123456"].retention.archive_days, 1)
+        self.assertEqual([a.message.content for a in FileDB.load_archived_actions("789123456", "123456789")], ["spam 2"])
+
+    def test_archive_is_split_by_user(self):
+        # Test that each user's actions are archived in their own file, and a single-file archive is split on load
+        messages = Messages()
+        messages.ensure_server_exists(self.mock_message)
+        self._add_action(messages, 1)
+        messages.save()
+        os.makedirs(os.path.join(self.tmp_dir.name, "archive"), exist_ok=True)
+        with open(os.path.join(self.tmp_dir.name, "archive", "789123456.jsonl"), 'w') as f:
+            for user_id in ("111", "222"):
+                f.write(json.dumps({"action": "kick_user", "user_id": user_id, "timestamp": 1.0, "message": {
+                    "content": "old", "server_id": 789123456, "server_name": "Test Server", "user_id": int(user_id), "user_name": "Old",
+                    "channel_id": None, "channel_name": None, "message_id": None}}) + "\n")
+
+        FileDB.load_messages()
+
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, "archive", "789123456.jsonl")))
+        self.assertTrue(os.path.exists(FileDB.archive_path("789123456", "123456789")))
+        self.assertEqual([a.message.content for a in FileDB.load_archived_actions("789123456", "222")], ["old"])
+        self.assertEqual(len(list(FileDB.read_archive("789123456"))), 3)
+
+    def test_legacy_snapshot_is_archived_on_load(self):
+        # Test that a snapshot holding the full history is moved to the archive when loaded
+        messages = Messages()
+        messages.ensure_server_exists(self.mock_message)
+        messages.servers["789123456"].retention = RetentionPolicy(hot_actions=30)
+        for i in range(30):
+            self._add_action(messages, i)
+        messages.save()
+        shutil.rmtree(db.ARCHIVE_DIR)
+        with open(db.SERVERS_FILE) as f:
+            servers_data = json.load(f)
+        del servers_data["789123456"]["retention"]
+        # The oldest snapshots have no timestamps
+        del servers_data["789123456"]["actions"]["123456789"][0]["timestamp"]
+        with open(db.SERVERS_FILE, 'w') as f:
+            json.dump(servers_data, f)
+
+        loaded = FileDB.load_messages()
+
+        self.assertEqual(len(loaded.servers["789123456"].actions["123456789"]), 20)
+        archived = FileDB.load_archived_actions("789123456", "123456789")
+        self.assertEqual(len(archived), 30)
+        self.assertEqual(archived[0].timestamp, 0.0)
+        self.assertEqual(archived[-1].timestamp, servers_data["789123456"]["actions"]["123456789"][-1]["timestamp"])
+
+    def test_truncated_journal_line_is_skipped(self):
+        # Test that a partially written last record does not break loading
+        messages = Messages()
+        messages.ensure_server_exists(self.mock_message)
+        with open(db.JOURNAL_FILE, 'a') as f:
+            f.write('{"seq": 2, "op": "ru')
+
+        loaded = FileDB.load_messages()
+
+        self.assertIn("789123456", loaded.servers)
+
+    def test_files_are_imported_into_sqlite(self):
+        # Test that switching to SQLite keeps the snapshot, the journal and the full archived history
+        self.mock_message.channel.id = 456789123
+        messages = Messages()
+        messages.ensure_server_exists(self.mock_message)
+        messages.set_retention(789123456, hot_actions=2)
+        for i in range(3):
+            self._add_action(messages, i)
+        messages.save()
+        messages.update_last_read(123456789, 456789123, 1001)
+        messages.add_summary_segment(456789123, SummarySegment(1, 5, 5, "first"))
+
+        storage = SQLiteDB(os.path.join(self.tmp_dir.name, "test.sqlite3"))
+        self.addCleanup(storage.close)
+        storage.import_files()
+        storage.import_files()
+        loaded = storage.load_messages()
+
+        self.assertEqual(loaded.servers["789123456"].retention.hot_actions, 2)
+        actions = asyncio.run(loaded.get_user_mod_actions(123456789, [789123456]))
+        self.assertEqual([a.message.content for a in actions], ["spam 0", "spam 1", "spam 2"])
+        self.assertEqual(asyncio.run(loaded.get_last_read(123456789, 456789123)), 1001)
+        self.assertEqual([s.summary for s in loaded.channel_summaries["456789123"].segments], ["first"])
+
+class TestSQLiteDB(unittest.TestCase):
+    def setUp(self):
+        # Create a SQLite database in a temporary directory
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = SQLiteDB(os.path.join(self.tmp_dir.name, "test.sqlite3"))
+        self.messages = Messages(storage=self.storage)
+
+        # Create a mock guild message
+        self.mock_message = MagicMock(spec=Message)
+        self.mock_message.guild = MagicMock(spec=Guild)
+        self.mock_message.guild.id = 789123456
+        self.mock_message.guild.name = "Test Server"
+        self.messages.ensure_server_exists(self.mock_message)
+
+    def tearDown(self):
+        self.storage.close()
+        self.tmp_dir.cleanup()
+
+    def _add_action(self, index, user_id="123456789"):
+        self.messages.add_mod_action("ban_user", {
+            "content": f"spam {index}",
+            "server_id": 789123456,
+            "server_name": "Test Server",
+            "message_id": index,
+        }, user_id)
+
+    def test_actions_are_not_kept_in_memory(self):
+        # Test that per-user history lives in the database only
+        self._add_action(1)
+
+        server = self.messages.servers["789123456"]
+        self.assertEqual(server.actions, {})
+        self.assertEqual(len(server.recent_actions), 1)
+
+    def test_get_user_mod_actions_returns_most_recent(self):
+        # Test that the indexed query returns the newest actions, oldest first
+        for i in range(25):
+            self._add_action(i)
+        self._add_action(99, user_id="555")
+
+        actions = asyncio.run(self.messages.get_user_mod_actions(123456789, [789123456]))
+
+        self.assertEqual(len(actions), 20)
+        self.assertEqual(actions[0].message.content, "spam 5")
+        self.assertEqual(actions[-1].message.content, "spam 24")
+
+    def test_get_user_mod_actions_since(self):
+        # Test that time-window queries filter on the action's timestamp
+        with patch('messages.time.time', return_value=1000.0):
+            self._add_action(1)
+        with patch('messages.time.time', return_value=2000.0):
+            self._add_action(2)
+
+        actions = asyncio.run(self.messages.get_user_mod_actions(123456789, [789123456], since=1500.0))
+
+        self.assertEqual([(a.message.content, a.timestamp) for a in actions], [("spam 2", 2000.0)])
+
+    def test_last_read(self):
+        # Test that unread tracking is stored and queried per channel and user
+        self.messages.update_last_read(123456789, 456789123, 1001)
+        self.messages.update_last_read(123456789, 456789123, 1002)
+
+        self.assertEqual(asyncio.run(self.messages.get_last_read(123456789, 456789123)), 1002)
+        self.assertIsNone(asyncio.run(self.messages.get_last_read(123456789, 111)))
+
+    def test_load_messages(self):
+        # Test that servers, rules and recent actions survive a reload
+        self.messages.update_server_rules("789123456", "No spam.")
+        self._add_action(1)
+
+        loaded = self.storage.load_messages()
+
+        server = loaded.servers["789123456"]
+        self.assertEqual(server.rules, "No spam.")
+        self.assertEqual([a.message.content for a in server.recent_actions], ["spam 1"])
+
+    def test_retention_survives_reload(self):
+        # Test that the per-server policy is stored with the server and kept when the server is saved again
+        self.messages.set_retention(789123456, archive_days=30)
+        self.messages.update_server_rules("789123456", "No spam.")
+        self.messages.save()
+
+        loaded = self.storage.load_messages()
+
+        self.assertEqual(loaded.servers["789123456"].retention.archive_days, 30)
+
+    def test_summary_segments(self):
+        # Test that a replaced segment overwrites the newest row and segments load in order
+        self.messages.add_summary_segment(456789123, SummarySegment(1, 5, 5, "first"))
+        self.messages.add_summary_segment(456789123, SummarySegment(1, 8, 8, "first, extended"), replace_last=True)
+        self.messages.add_summary_segment(456789123, SummarySegment(9, 12, 4, "second"))
+
+        state = self.storage.load_messages().channel_summaries["456789123"]
+
+        self.assertEqual([s.summary for s in state.segments], ["first, extended", "second"])
+        self.assertEqual(state.last_message_id, 12)
+
+        # A dropped summary is not loaded again
+        self.messages.drop_channel_summary(456789123)
+        self.assertNotIn("456789123", self.storage.load_messages().channel_summaries)
+
+class TestWriteBehindStorage(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Create a fake backend that records every job it writes
+        self.inner = MagicMock()
+        self.inner.prepare_flush.side_effect = lambda messages, records, snapshot=False: {"records": records, "snapshot": snapshot}
+        self.written = []
+        self.inner.write_flush.side_effect = self.written.append
+        self.messages = MagicMock()
+
+    async def test_burst_is_coalesced_into_one_write(self):
+        # Test that many mutations within the interval are written together
+        storage = WriteBehindStorage(self.inner, interval=0.01, threshold=100)
+        for i in range(50):
+            storage.record(self.messages, {"op": "dm", "message_id": i})
+
+        self.assertEqual(self.written, [])
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(len(self.written), 1)
+        self.assertEqual(len(self.written[0]["records"]), 50)
+        self.assertEqual(storage.stats()["records_flushed"], 50)
+
+    async def test_threshold_triggers_early_flush(self):
+        # Test that reaching the dirty threshold flushes before the interval ends
+        storage = WriteBehindStorage(self.inner, interval=60, threshold=3)
+        for i in range(3):
+            storage.record(self.messages, {"op": "dm", "message_id": i})
+
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(len(self.written), 1)
+
+    async def test_flush_writes_pending_with_snapshot(self):
+        # Test that a forced flush writes queued records and a snapshot synchronously
+        storage = WriteBehindStorage(self.inner, interval=60, threshold=100)
+        storage.record(self.messages, {"op": "dm", "message_id": 1})
+
+        storage.flush(self.messages)
+
+        self.assertEqual(self.written, [{"records": [{"op": "dm", "message_id": 1}], "snapshot": True}])
+        self.assertEqual(storage.pending, [])
+
+    async def test_failed_write_is_retried_without_preparing_again(self):
+        # Test that a failed job is written again as prepared, before newer records
+        storage = WriteBehindStorage(self.inner, interval=60, threshold=100)
+        storage.messages = self.messages
+        self.inner.write_flush.side_effect = [OSError("disk full"), None, None]
+        storage.pending = [{"op": "dm", "message_id": 1}]
+
+        await storage.flush_pending()
+        storage.pending = [{"op": "dm", "message_id": 2}]
+        await storage.flush_pending()
+
+        self.assertEqual(self.inner.prepare_flush.call_count, 2)
+        written = [call.args[0]["records"] for call in self.inner.write_flush.call_args_list]
+        self.assertEqual(written, [[{"op": "dm", "message_id": 1}], [{"op": "dm", "message_id": 1}], [{"op": "dm", "message_id": 2}]])
+        self.assertEqual(storage.stats()["records_flushed"], 2)
+
+    async def test_queued_actions_are_included_in_lookups(self):
+        # Test that actions not yet written to an indexed backend are still returned
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            inner = SQLiteDB(os.path.join(tmp_dir, "test.sqlite3"))
+            self.addCleanup(inner.close)
+            storage = WriteBehindStorage(inner, interval=60, threshold=100)
+            messages = Messages(storage=storage)
+            message = MagicMock(spec=Message)
+            message.guild = MagicMock(spec=Guild)
+            message.guild.id = 789123456
+            message.guild.name = "Test Server"
+            messages.ensure_server_exists(message)
+            for i in range(2):
+                messages.add_mod_action("ban_user", {"server_id": 789123456, "message_id": i, "content": f"spam {i}"}, "123456789")
+            await storage.flush_pending()
+            messages.add_mod_action("ban_user", {"server_id": 789123456, "message_id": 2, "content": "spam 2"}, "123456789")
+
+            actions = await messages.get_user_mod_actions(123456789, [789123456], limit=2)
+
+            self.assertEqual([a.message.content for a in actions], ["spam 1", "spam 2"])
+
+    async def test_queued_last_read_is_returned(self):
+        # Test that a last read message not yet written to the backend is returned instead of the stored one
+        storage = WriteBehindStorage(self.inner, interval=60, threshold=100)
+        self.inner.get_last_read.return_value = 100
+        storage.writing = [{"op": "last_read", "user_id": "1", "channel_id": "10", "message_id": 200, "guild_id": None}]
+        storage.pending = [{"op": "last_read", "user_id": "1", "channel_id": "10", "message_id": 300, "guild_id": None}]
+
+        self.assertEqual(storage.get_last_read(1, 10), 300)
+        storage.pending = []
+        self.assertEqual(storage.get_last_read(1, 10), 200)
+        self.assertEqual(storage.get_last_read(1, 11), 100)
+
+    def test_writes_immediately_without_event_loop(self):
+        # Test that mutations outside an event loop go straight to the backend
+        storage = WriteBehindStorage(self.inner, interval=60, threshold=100)
+
+        storage.record(self.messages, {"op": "dm", "message_id": 1})
+
+        self.inner.record.assert_called_once_with(self.messages, {"op": "dm", "message_id": 1})
+
+if __name__ == "__main__":
+    unittest.main()
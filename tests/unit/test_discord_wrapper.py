@@ -1,27 +1,43 @@
+import asyncio
 import unittest
+from datetime import datetime, timezone
+import discord
 from unittest.mock import MagicMock, patch, AsyncMock
 from discord.ext import commands
-from discord_wrapper import DiscordWrapper
+from discord_wrapper import DiscordWrapper, BULK_DELETE_MAX
+from scheduler import ActionScheduler
 
-class TestDiscordWrapper(unittest.TestCase):
+class TestDiscordWrapper(unittest.IsolatedAsyncioTestCase):
     def setUp(self):
         # Create a mock bot
         self.mock_bot = MagicMock(spec=commands.Bot)
         
         # Create a DiscordWrapper instance for testing
-        self.discord_wrapper = DiscordWrapper(self.mock_bot)
+        self.discord_wrapper = DiscordWrapper(self.mock_bot, delete_window=0)
         
         # Create mock objects for testing
         self.mock_user = AsyncMock()
+        self.mock_dm_channel = AsyncMock()
+        self.mock_user.dm_channel = None
+        self.mock_user.create_dm = AsyncMock(return_value=self.mock_dm_channel)
         self.mock_channel = MagicMock()
+        self.mock_channel.send = AsyncMock()
         self.mock_guild = MagicMock()
+        self.mock_guild.ban = AsyncMock()
+        self.mock_guild.kick = AsyncMock()
+        self.mock_guild.unban = AsyncMock()
         self.mock_message = MagicMock()
+        self.mock_message.delete = AsyncMock()
         
         # Set up the mock bot's methods
         self.mock_bot.fetch_user = AsyncMock(return_value=self.mock_user)
+        self.mock_bot.get_user = MagicMock(return_value=None)
         self.mock_bot.get_channel = MagicMock(return_value=self.mock_channel)
         self.mock_bot.get_guild = MagicMock(return_value=self.mock_guild)
+        self.mock_channel.id = 987654321
         self.mock_channel.fetch_message = AsyncMock(return_value=self.mock_message)
+        self.mock_channel.get_partial_message = MagicMock(return_value=self.mock_message)
+        self.mock_channel.delete_messages = AsyncMock()
     
     async def test_send_dm(self):
         # Test sending a DM
@@ -33,8 +49,35 @@ class TestDiscordWrapper(unittest.TestCase):
         # Check that fetch_user was called with the correct user ID
         self.mock_bot.fetch_user.assert_called_once_with(int(user_id))
         
-        # Check that send was called on the user with the correct message
-        self.mock_user.send.assert_called_once_with(message)
+        # Check that send was called on the user's DM channel with the correct message
+        self.mock_dm_channel.send.assert_called_once_with(message)
+
+    async def test_long_dm_is_split(self):
+        # Test that a DM over Discord's message limit is sent in parts
+        await self.discord_wrapper.send_dm("123456789", "a" * 1500 + "\n" + "b" * 1500)
+
+        self.assertEqual([call.args[0] for call in self.mock_dm_channel.send.call_args_list], ["a" * 1500, "b" * 1500])
+
+    async def test_send_dm_reuses_cached_user_and_channel(self):
+        # Test that repeated DMs to a user make a single REST request
+        await self.discord_wrapper.send_dm("123456789", "First")
+        await self.discord_wrapper.send_dm("123456789", "Second")
+
+        self.mock_bot.fetch_user.assert_called_once_with(123456789)
+        self.mock_user.create_dm.assert_called_once()
+        self.assertEqual(self.mock_dm_channel.send.call_count, 2)
+        self.assertEqual(self.discord_wrapper.stats()["dm_channels"]["hits"], 1)
+
+    async def test_get_user_prefers_gateway_cache(self):
+        # Test that a user known to the gateway is never fetched
+        gateway_user = MagicMock()
+        self.mock_bot.get_user.return_value = gateway_user
+
+        user = await self.discord_wrapper.get_user(123456789)
+
+        self.assertIs(user, gateway_user)
+        self.mock_bot.fetch_user.assert_not_called()
+        self.assertEqual(self.discord_wrapper.stats()["gateway_hits"], 1)
     
     async def test_send_message(self):
         # Test sending a message to a channel
@@ -59,11 +102,11 @@ class TestDiscordWrapper(unittest.TestCase):
         # Check that get_guild was called with the correct guild ID
         self.mock_bot.get_guild.assert_called_once_with(int(guild_id))
         
-        # Check that fetch_user was called with the correct user ID
-        self.mock_bot.fetch_user.assert_called_once_with(int(user_id))
+        # Check that the user was not fetched
+        self.mock_bot.fetch_user.assert_not_called()
         
-        # Check that ban was called on the guild with the correct user
-        self.mock_guild.ban.assert_called_once_with(self.mock_user)
+        # Check that ban was called on the guild with the user's ID
+        self.mock_guild.ban.assert_called_once_with(discord.Object(id=int(user_id)))
     
     async def test_kick_user(self):
         # Test kicking a user
@@ -75,11 +118,11 @@ class TestDiscordWrapper(unittest.TestCase):
         # Check that get_guild was called with the correct guild ID
         self.mock_bot.get_guild.assert_called_once_with(int(guild_id))
         
-        # Check that fetch_user was called with the correct user ID
-        self.mock_bot.fetch_user.assert_called_once_with(int(user_id))
+        # Check that the user was not fetched
+        self.mock_bot.fetch_user.assert_not_called()
         
-        # Check that kick was called on the guild with the correct user
-        self.mock_guild.kick.assert_called_once_with(self.mock_user)
+        # Check that kick was called on the guild with the user's ID
+        self.mock_guild.kick.assert_called_once_with(discord.Object(id=int(user_id)))
     
     async def test_unban_user(self):
         # Test unbanning a user
@@ -91,11 +134,11 @@ class TestDiscordWrapper(unittest.TestCase):
         # Check that get_guild was called with the correct guild ID
         self.mock_bot.get_guild.assert_called_once_with(int(guild_id))
         
-        # Check that fetch_user was called with the correct user ID
-        self.mock_bot.fetch_user.assert_called_once_with(int(user_id))
+        # Check that the user was not fetched
+        self.mock_bot.fetch_user.assert_not_called()
         
-        # Check that unban was called on the guild with the correct user
-        self.mock_guild.unban.assert_called_once_with(self.mock_user)
+        # Check that unban was called on the guild with the user's ID
+        self.mock_guild.unban.assert_called_once_with(discord.Object(id=int(user_id)))
     
     async def test_delete_message(self):
         # Test deleting a message
@@ -107,8 +150,9 @@ class TestDiscordWrapper(unittest.TestCase):
         # Check that get_channel was called with the correct channel ID
         self.mock_bot.get_channel.assert_called_once_with(int(channel_id))
         
-        # Check that fetch_message was called on the channel with the correct message ID
-        self.mock_channel.fetch_message.assert_called_once_with(int(message_id))
+        # Check that the message was deleted through a partial message, without fetching it
+        self.mock_channel.get_partial_message.assert_called_once_with(int(message_id))
+        self.mock_channel.fetch_message.assert_not_called()
         
         # Check that delete was called on the message
         self.mock_message.delete.assert_called_once()
@@ -144,25 +188,67 @@ class TestDiscordWrapper(unittest.TestCase):
         # Check that get_channel was called with the correct channel ID
         self.mock_bot.get_channel.assert_called_once_with(int(channel_id))
         
-        # Check that fetch_message was not called
-        self.mock_channel.fetch_message.assert_not_called()
+        # Check that no deletion was attempted
+        self.mock_channel.get_partial_message.assert_not_called()
     
-    async def test_delete_message_no_message(self):
-        # Test deleting a non-existent message
-        channel_id = "987654321"
-        message_id = "123456789"
-        
-        # Set fetch_message to return None
-        self.mock_channel.fetch_message.return_value = None
-        
-        # This should not raise an exception
-        await self.discord_wrapper.delete_message(channel_id, message_id)
-        
-        # Check that get_channel was called with the correct channel ID
-        self.mock_bot.get_channel.assert_called_once_with(int(channel_id))
-        
-        # Check that fetch_message was called with the correct message ID
-        self.mock_channel.fetch_message.assert_called_once_with(int(message_id))
+    async def test_deletes_are_coalesced_into_bulk_delete(self):
+        # Test that deletions in one channel within the window become one bulk delete
+        wrapper = DiscordWrapper(self.mock_bot, delete_window=0.01)
+        message_ids = [discord.utils.time_snowflake(datetime.now(timezone.utc)) + i for i in range(5)]
+
+        await asyncio.gather(*[wrapper.delete_message("987654321", str(message_id)) for message_id in message_ids])
+
+        self.mock_channel.delete_messages.assert_awaited_once()
+        self.assertEqual([m.id for m in self.mock_channel.delete_messages.call_args.args[0]], message_ids)
+        self.mock_channel.get_partial_message.assert_not_called()
+        self.assertEqual(wrapper.stats()["bulk_deletes"], 1)
+
+    async def test_old_messages_are_deleted_one_by_one(self):
+        # Test that messages older than two weeks fall back to single deletes
+        wrapper = DiscordWrapper(self.mock_bot, delete_window=0.01)
+
+        await asyncio.gather(*[wrapper.delete_message("987654321", str(123456789 + i)) for i in range(2)])
+
+        self.mock_channel.delete_messages.assert_not_called()
+        self.assertEqual(self.mock_message.delete.await_count, 2)
+
+    async def test_coalesced_deletes_are_one_scheduled_job(self):
+        # Test that deletions waiting for their window hold no scheduler slot and are sent as one job
+        scheduler = ActionScheduler(max_in_flight=1, global_rate=1000)
+        wrapper = DiscordWrapper(self.mock_bot, delete_window=0.01, scheduler=scheduler)
+        message_ids = [discord.utils.time_snowflake(datetime.now(timezone.utc)) + i for i in range(5)]
+
+        await asyncio.gather(*[wrapper.delete_message("987654321", str(message_id)) for message_id in message_ids])
+
+        self.mock_channel.delete_messages.assert_awaited_once()
+        self.assertEqual(scheduler.stats()["dispatched"], 1)
+
+    async def test_failed_flush_resolves_every_deletion(self):
+        # Test that an unexpected error in a flush is returned to every waiting caller
+        wrapper = DiscordWrapper(self.mock_bot, delete_window=0.01)
+        self.mock_channel.delete_messages.side_effect = RuntimeError("connection reset")
+        message_ids = [discord.utils.time_snowflake(datetime.now(timezone.utc)) + i for i in range(3)]
+
+        results = await asyncio.wait_for(asyncio.gather(*[wrapper.delete_message("987654321", str(message_id)) for message_id in message_ids], return_exceptions=True), 1)
+
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+
+    async def test_full_batch_is_taken_before_more_deletions_arrive(self):
+        # Test that more than BULK_DELETE_MAX concurrent deletions never exceed one bulk delete's limit
+        wrapper = DiscordWrapper(self.mock_bot, delete_window=0.01)
+
+        async def delete_messages(messages):
+            if len(messages) > BULK_DELETE_MAX:
+                raise discord.ClientException("Can only bulk delete messages up to 100 messages")
+
+        self.mock_channel.delete_messages.side_effect = delete_messages
+        message_ids = [discord.utils.time_snowflake(datetime.now(timezone.utc)) + i for i in range(150)]
+
+        results = await asyncio.gather(*[wrapper.delete_message("987654321", str(message_id)) for message_id in message_ids], return_exceptions=True)
+
+        self.assertEqual(results, [None] * 150)
+        self.assertEqual([len(call.args[0]) for call in self.mock_channel.delete_messages.call_args_list], [100, 50])
+        self.assertEqual(wrapper.stats()["single_deletes"], 0)
 
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
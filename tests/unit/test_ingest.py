@@ -0,0 +1,93 @@
+import asyncio
+import unittest
+from unittest.mock import MagicMock
+from discord import Message
+from ingest import IngestQueue, INGEST_MESSAGES, INGEST_QUEUE_DEPTH
+
+class TestIngestQueue(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Record the messages in the order the workers handle them
+        self.handled = []
+
+    async def handler(self, message):
+        self.handled.append(message.id)
+        await asyncio.sleep(0)
+
+    def _message(self, message_id, guild_id=1, author_id=100, channel_id=10, admin=False):
+        message = MagicMock(spec=Message)
+        message.id = message_id
+        message.guild.id = guild_id
+        message.channel.id = channel_id
+        message.author.id = author_id
+        message.admin = admin
+        return message
+
+    def _queue(self, **kwargs):
+        return IngestQueue(self.handler, is_priority=lambda m: m.admin, **kwargs)
+
+    async def test_guilds_are_served_round_robin(self):
+        # Test that a flooded guild does not hold up a quiet one
+        ingest = self._queue(workers=1)
+        for i in range(5):
+            ingest.submit(self._message(i, guild_id=1))
+        ingest.submit(self._message(100, guild_id=2))
+
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(self.handled[:3], [0, 100, 1])
+        self.assertEqual(ingest.stats()["processed"], 6)
+        await ingest.stop()
+
+    async def test_coalesce_replaces_queued_message_from_same_author(self):
+        # Test that a full queue replaces the author's queued message with the newer one
+        ingest = self._queue(workers=1, max_queue_size=2)
+        ingest.start = MagicMock()
+        ingest.submit(self._message(1, author_id=100))
+        ingest.submit(self._message(2, author_id=200))
+        ingest.submit(self._message(3, author_id=100))
+
+        self.assertEqual([item.message.id for item in ingest.queues[1]], [3, 2])
+        self.assertEqual(ingest.stats()["coalesced"], 1)
+
+    async def test_skip_drops_new_message_but_keeps_admin(self):
+        # Test that the skip policy drops low priority messages and makes room for admins
+        ingest = self._queue(workers=1, max_queue_size=2, overload_policy="skip")
+        ingest.start = MagicMock()
+        ingest.submit(self._message(1))
+        ingest.submit(self._message(2))
+
+        self.assertFalse(ingest.submit(self._message(3)))
+        self.assertTrue(ingest.submit(self._message(4, admin=True)))
+
+        self.assertEqual([item.message.id for item in ingest.queues[1]], [2, 4])
+        self.assertEqual(ingest.stats()["dropped"], 2)
+
+    async def test_queue_is_exported(self):
+        # Test that the queue depth and drops are exported as metrics, not just in stats
+        dropped_before = INGEST_MESSAGES.get("dropped")
+        ingest = self._queue(workers=1, max_queue_size=1, overload_policy="skip")
+        ingest.start = MagicMock()
+        ingest.submit(self._message(1))
+        ingest.submit(self._message(2))
+
+        self.assertEqual(INGEST_QUEUE_DEPTH.get(), 1)
+        self.assertEqual(INGEST_MESSAGES.get("dropped"), dropped_before + 1)
+
+    async def test_dropping_only_queued_message_keeps_workers_running(self):
+        # Test that a queue of one can drop its only message without the guild being served twice
+        ingest = self._queue(workers=2, max_queue_size=1)
+        ingest.start = MagicMock()
+        for i in range(3):
+            ingest.submit(self._message(i, author_id=100 + i))
+
+        self.assertEqual(list(ingest.ready), [1])
+        IngestQueue.start(ingest)
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(self.handled, [2])
+        self.assertEqual(ingest.stats()["dropped"], 2)
+        self.assertFalse(any(worker.done() for worker in ingest.workers))
+        await ingest.stop()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import json
+import asyncio
+import tempfile
+import unittest
+from aiohttp.test_utils import TestClient, TestServer
+from openai import AsyncOpenAI
+from agent import OpenAIAgent
+from llm_stub import StubServer, Cassette, synthetic_reply, VIOLATION_MARKER
+
+JUDGED = "TestUser (user id: 111, message id: 222) in general (channel id: 333) in server Test Server (server id: 444):\n"
+
+class TestLLMStub(unittest.IsolatedAsyncioTestCase):
+    async def _start(self, server: StubServer) -> OpenAIAgent:
+        self.client = TestClient(TestServer(server.app()))
+        await self.client.start_server()
+        self.addAsyncCleanup(self.client.close)
+        openai_client = AsyncOpenAI(api_key="stub", base_url=str(self.client.make_url("/v1")), max_retries=0)
+        self.addAsyncCleanup(openai_client.close)
+        return OpenAIAgent(client=openai_client, semaphore=asyncio.Semaphore(2))
+
+    def test_synthetic_reply_flags_marked_messages(self):
+        # Test that synthetic moderation replies act only on messages containing the marker
+        flagged = json.loads(synthetic_reply(JUDGED + f"{VIOLATION_MARKER} now", ["delete_message"])[len("<tool>"):-len("</tool>")])
+
+        self.assertEqual(flagged, {"action": "delete_message", "message_id": "222", "args": {"channel_id": "333", "message_id": "222"}})
+        self.assertEqual(synthetic_reply(JUDGED + "hello", ["delete_message"]), "No action needed.")
+
+    async def test_agent_gets_synthetic_response(self):
+        # Test that the agent talks to the stub through the OpenAI client and records usage
+        server = StubServer()
+        agent = await self._start(server)
+
+        response = await agent.send_message(JUDGED + f"{VIOLATION_MARKER} now")
+
+        self.assertEqual([c["action"] for c in agent.process_tool_call(response)], ["delete_message", "send_dm"])
+        self.assertEqual(agent.usage["requests"], 1)
+        self.assertEqual(server.stats()["synthetic"], 1)
+
+    async def test_streamed_response_matches_unstreamed(self):
+        # Test that a streamed response is sent in chunks that add up to the whole response, with usage
+        server = StubServer(chunk_size=4)
+        agent = await self._start(server)
+
+        deltas = [delta async for delta in agent.stream_message("Summarize this")]
+
+        self.assertGreater(len(deltas), 1)
+        self.assertEqual("".join(deltas), synthetic_reply("Summarize this", []))
+        self.assertEqual(agent.usage["requests"], 1)
+
+    async def test_cassette_is_replayed(self):
+        # Test that the latest recording is served for its prompt and a cut-off last line is skipped
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cassette.jsonl")
+            cassette = Cassette(path)
+            messages = [{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": "Hello"}]
+            await cassette.put(Cassette.key("gpt-4o", messages), {"content": "Stale hello", "usage": None})
+            await cassette.put(Cassette.key("gpt-4o", messages), {"content": "Recorded hello", "usage": None})
+            with open(path, 'a') as f:
+                f.write('{"key": "cut')
+
+            server = StubServer(cassette=Cassette(path))
+            agent = await self._start(server)
+
+            self.assertEqual(await agent.send_message("Hello"), "Recorded hello")
+            self.assertEqual(server.stats()["replayed"], 1)
+
+    async def test_error_rate(self):
+        # Test that failed requests return a retryable error status
+        server = StubServer(error_rate=1.0)
+        await self._start(server)
+
+        response = await self.client.post("/v1/chat/completions", json={"model": "gpt-4o", "messages": []})
+
+        self.assertIn(response.status, (429, 500, 503))
+        self.assertEqual(server.stats()["errors"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import time
+import asyncio
+import unittest
+from loop_monitor import LoopMonitor
+from metrics import Histogram, REGISTRY
+
+def block_loop(seconds):
+    # Stands in for blocking I/O called from a coroutine
+    time.sleep(seconds)
+
+class TestLoopMonitor(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.monitor = LoopMonitor(interval=0.01, threshold=0.05, lag=Histogram("test_lag_seconds", "Test lag.", registry=None))
+        self.monitor.start()
+        self.addAsyncCleanup(self.monitor.stop)
+
+    async def test_blocking_call_is_captured(self):
+        # Test that a blocked loop is recorded with the stack of the blocking call
+        await asyncio.sleep(0.03)
+        block_loop(0.3)
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(len(self.monitor.stalls), 1)
+        stall = self.monitor.stalls[0]
+        self.assertGreaterEqual(stall.lag, 0.25)
+        self.assertIn("in block_loop", stall.location)
+        self.assertIn("test_blocking_call_is_captured", stall.stack)
+        self.assertEqual(self.monitor.stats()["stalls"], 1)
+
+    async def test_responsive_loop_records_lag_only(self):
+        # Test that a loop that is never blocked is sampled without recording stalls
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+
+        self.assertGreater(self.monitor.samples, 0)
+        self.assertEqual(len(self.monitor.stalls), 0)
+        self.assertEqual(self.monitor.lag.count(), self.monitor.samples)
+
+    def test_lag_metric_is_registered_once(self):
+        # Test that monitors share the module-level histogram instead of registering their own
+        before = len(REGISTRY.metrics)
+        LoopMonitor()
+        LoopMonitor()
+
+        self.assertEqual(len(REGISTRY.metrics), before)
+        self.assertEqual(sum(metric.name == "event_loop_lag_seconds" for metric in REGISTRY.metrics), 1)
+
+    async def test_stop_ends_watchdog(self):
+        # Test that stopping the monitor ends its task and watchdog thread
+        watchdog = self.monitor.watchdog
+
+        await self.monitor.stop()
+
+        self.assertFalse(watchdog.is_alive())
+        self.assertIsNone(self.monitor.task)
+
+if __name__ == '__main__':
+    unittest.main()
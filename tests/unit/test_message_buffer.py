@@ -0,0 +1,67 @@
+import unittest
+from unittest.mock import MagicMock
+from discord import Message
+from message_buffer import MessageBuffer
+
+class TestMessageBuffer(unittest.TestCase):
+    def setUp(self):
+        # Create a small buffer for testing
+        self.buffer = MessageBuffer(size=3, max_channels=2, idle_ttl=60)
+
+    def _message(self, message_id, channel_id=1):
+        message = MagicMock(spec=Message)
+        message.id = message_id
+        message.content = f"message {message_id}"
+        message.guild = None
+        message.channel.id = channel_id
+        message.author.id = 100
+        message.author.name = "TestUser"
+        message.reference = None
+        message.mentions = []
+        return message
+
+    def test_cold_channel_is_not_buffered(self):
+        # Test that messages for unseeded channels are skipped
+        self.buffer.add(self._message(1))
+
+        self.assertFalse(self.buffer.is_warm(1))
+        self.assertEqual(self.buffer.recent(1, 10), [])
+
+    def test_seed_and_add_keep_most_recent(self):
+        # Test that the buffer keeps only the newest messages once seeded
+        self.buffer.seed(1, [self._message(i) for i in range(1, 3)])
+        self.buffer.add(self._message(3))
+        self.buffer.add(self._message(4))
+
+        self.assertEqual([m.id for m in self.buffer.recent(1, 10)], [2, 3, 4])
+        self.assertEqual(self.buffer.recent(1, 10)[0].line, "[2] TestUser (100): message 2")
+
+    def test_recent_before_id(self):
+        # Test reading only the messages older than a given message
+        self.buffer.seed(1, [self._message(i) for i in range(1, 4)])
+
+        self.assertEqual([m.id for m in self.buffer.recent(1, 10, before_id=3)], [1, 2])
+        self.assertEqual([m.id for m in self.buffer.recent(1, 1, before_id=3)], [2])
+
+    def test_max_channels_evicts_least_recently_active(self):
+        # Test that the channel cap drops the least recently active channel
+        self.buffer.seed(1, [self._message(1, channel_id=1)])
+        self.buffer.seed(2, [self._message(2, channel_id=2)])
+        self.buffer.add(self._message(3, channel_id=1))
+        self.buffer.seed(3, [self._message(4, channel_id=3)])
+
+        self.assertTrue(self.buffer.is_warm(1))
+        self.assertFalse(self.buffer.is_warm(2))
+        self.assertTrue(self.buffer.is_warm(3))
+
+    def test_evict_idle(self):
+        # Test that idle channels are dropped
+        self.buffer.seed(1, [self._message(1)])
+
+        self.buffer.evict_idle(now=self.buffer.last_active[1] + 61)
+
+        self.assertFalse(self.buffer.is_warm(1))
+        self.assertEqual(self.buffer.stats()["evictions"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
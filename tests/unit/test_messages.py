@@ -1,7 +1,8 @@
+import asyncio
 import unittest
 from unittest.mock import MagicMock, patch
 from discord import Message, Guild, TextChannel, User
-from messages import Messages, SingleMessage, ModAction, Server
+from messages import Messages, SingleMessage, ModAction, Server, RetentionPolicy, to_id
 
 class TestMessages(unittest.TestCase):
     def setUp(self):
@@ -61,6 +62,18 @@ class TestMessages(unittest.TestCase):
         server = self.messages.servers[self.mock_guild.id]
         self.assertEqual(server.rules, "Custom rules")
     
+    def test_last_read_is_stored_in_owning_server_only(self):
+        # Test that unread tracking is keyed by channel and user, with IDs normalized to ints
+        self.messages.ensure_server_exists(self.mock_message)
+        self.messages.servers["111"] = Server(id="111", name="Other Server", rules="", recent_actions=[])
+
+        self.messages.update_last_read(self.mock_user.id, self.mock_channel.id, "1002")
+
+        self.assertEqual(asyncio.run(self.messages.get_last_read(int(self.mock_user.id), int(self.mock_channel.id))), 1002)
+        self.assertEqual(self.messages.servers[self.mock_guild.id].channels, {"456789123": {"123456789": 1002}})
+        self.assertEqual(self.messages.servers["111"].channels, {})
+        self.assertIsNone(asyncio.run(self.messages.get_last_read(self.mock_user.id, "111")))
+
     def test_add_message_guild(self):
         # Test adding a message from a guild
         self.messages.add_message(self.mock_message)
@@ -89,13 +102,13 @@ class TestMessages(unittest.TestCase):
         
         # Check that the SingleMessage has the correct attributes
         self.assertEqual(single_message.content, self.mock_message.content)
-        self.assertEqual(single_message.server_id, self.mock_guild.id)
+        self.assertEqual(single_message.server_id, int(self.mock_guild.id))
         self.assertEqual(single_message.server_name, self.mock_guild.name)
-        self.assertEqual(single_message.user_id, self.mock_user.id)
+        self.assertEqual(single_message.user_id, int(self.mock_user.id))
         self.assertEqual(single_message.user_name, self.mock_user.name)
-        self.assertEqual(single_message.channel_id, self.mock_channel.id)
+        self.assertEqual(single_message.channel_id, int(self.mock_channel.id))
         self.assertEqual(single_message.channel_name, self.mock_channel.name)
-        self.assertEqual(single_message.message_id, self.mock_message.id)
+        self.assertEqual(single_message.message_id, int(self.mock_message.id))
     
     def test_create_single_message_dm(self):
         # Create a DM message
@@ -112,12 +125,74 @@ class TestMessages(unittest.TestCase):
         self.assertEqual(single_message.content, dm_message.content)
         self.assertIsNone(single_message.server_id)
         self.assertEqual(single_message.server_name, "Private User DMs")
-        self.assertEqual(single_message.user_id, self.mock_user.id)
+        self.assertEqual(single_message.user_id, int(self.mock_user.id))
         self.assertEqual(single_message.user_name, self.mock_user.name)
         self.assertIsNone(single_message.channel_id)
         self.assertEqual(single_message.channel_name, None)
-        self.assertEqual(single_message.message_id, dm_message.id)
+        self.assertEqual(single_message.message_id, int(dm_message.id))
     
+    def test_records_are_compact(self):
+        # Test that records are slotted and immutable, with int IDs and shared name strings
+        first = self.messages.create_single_message(self.mock_message)
+        second = self.messages.create_single_message(self.mock_message)
+
+        self.assertFalse(hasattr(first, "__dict__"))
+        self.assertIs(first.server_name, second.server_name)
+        with self.assertRaises(AttributeError):
+            first.content = "edited"
+
+    def test_ids_are_normalized(self):
+        # Test that IDs written as mentions are accepted and anything else is treated as missing
+        self.assertEqual(to_id("<@!123>"), 123)
+        self.assertEqual(to_id("<#456> "), 456)
+        self.assertEqual(to_id(789), 789)
+        self.assertIsNone(to_id("n/a"))
+        self.assertIsNone(SingleMessage("", "server", "", 1, "", None, None, "n/a").server_id)
+
+    def test_add_mod_action_skips_invalid_user(self):
+        # Test that an action against an invalid user ID is not recorded instead of raising
+        self.messages.ensure_server_exists(self.mock_message)
+        self.messages.add_mod_action("delete_message", {"server_id": self.mock_guild.id, "message_id": "1"}, "server")
+        self.messages.add_mod_action("ban_user", {"server_id": f"<@{self.mock_guild.id}>", "message_id": "2"}, f"<@{self.mock_user.id}>")
+
+        server = self.messages.servers[self.mock_guild.id]
+        self.assertEqual([a.action for a in server.recent_actions], ["ban_user"])
+        self.assertEqual(list(server.actions), [self.mock_user.id])
+
+    def test_add_mod_action_shares_one_record(self):
+        # Test that the per-user history and the recent actions hold the same record
+        self.messages.ensure_server_exists(self.mock_message)
+        self.messages.add_mod_action("ban_user", {"server_id": self.mock_guild.id, "message_id": "1"}, self.mock_user.id)
+
+        server = self.messages.servers[self.mock_guild.id]
+        self.assertIs(server.actions[self.mock_user.id][0], server.recent_actions[0])
+
+    def test_hot_tier_is_bounded(self):
+        # Test that only the newest actions of the most recently active users stay in memory
+        self.messages.ensure_server_exists(self.mock_message)
+        server = self.messages.servers[self.mock_guild.id]
+        server.retention = RetentionPolicy(hot_actions=2, hot_users=2)
+        for user_id, message_id in [("1", 1), ("1", 2), ("1", 3), ("2", 4), ("3", 5), ("1", 6)]:
+            self.messages.add_mod_action("ban_user", {"server_id": self.mock_guild.id, "message_id": message_id}, user_id)
+
+        # User 1 was evicted in between, so only the action since is hot
+        self.assertEqual(list(server.actions), ["3", "1"])
+        self.assertEqual([a.message.message_id for a in server.actions["1"]], [6])
+
+    def test_get_user_mod_actions_merges_servers_by_recency(self):
+        # Test that the newest actions across servers are returned, oldest first, with time windows
+        def action(server_id, message_id, timestamp):
+            return ModAction("ban_user", SingleMessage("", server_id, "", 1, "", None, None, message_id), timestamp)
+
+        self.messages.servers["1"] = Server(id="1", name="", rules="", recent_actions=[], actions={"1": [action(1, i, float(i)) for i in (1, 4, 5)]})
+        self.messages.servers["2"] = Server(id="2", name="", rules="", recent_actions=[], actions={"1": [action(2, i, float(i)) for i in (2, 3, 6)]})
+
+        newest = asyncio.run(self.messages.get_user_mod_actions(1, ["1", "2", "3"], limit=4))
+        window = asyncio.run(self.messages.get_user_mod_actions(1, ["1", "2"], since=4.5))
+
+        self.assertEqual([a.message.message_id for a in newest], [3, 4, 5, 6])
+        self.assertEqual([a.message.message_id for a in window], [5, 6])
+
     def test_get_user_mod_actions(self):
         # Add a server to the servers dictionary
         server_id = self.mock_guild.id
@@ -151,7 +226,7 @@ class TestMessages(unittest.TestCase):
         self.messages.servers[server_id].actions[self.mock_user.id] = [mod_action]
         
         # Test getting user mod actions
-        actions = self.messages.get_user_mod_actions(self.mock_user.id, [server_id])
+        actions = asyncio.run(self.messages.get_user_mod_actions(self.mock_user.id, [server_id]))
         
         # Check that the correct actions were returned
         self.assertEqual(len(actions), 1)
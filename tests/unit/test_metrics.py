@@ -0,0 +1,104 @@
+import asyncio
+import unittest
+from unittest.mock import MagicMock
+import aiohttp
+from metrics import Registry, Counter, Gauge, Histogram, timed, start_http_server, STAGE_SECONDS, LLM_TOKENS, TOOL_CALLS
+from agent import OpenAIAgent
+from tool_executor import ToolExecutor
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_histogram_renders_cumulative_buckets(self):
+        # Test that each observation counts in its own bucket and every bucket above it
+        histogram = Histogram("test_seconds", "Test latency.", ("stage",), buckets=(0.1, 1.0), registry=self.registry)
+        histogram.observe(0.05, "llm")
+        histogram.observe(0.1, "llm")
+        histogram.observe(5.0, "llm")
+
+        lines = self.registry.render().splitlines()
+
+        self.assertEqual(lines[:2], ["# HELP test_seconds Test latency.", "# TYPE test_seconds histogram"])
+        self.assertIn('test_seconds_bucket{stage="llm",le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="llm",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="llm",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum{stage="llm"} 5.15', lines)
+        self.assertIn('test_seconds_count{stage="llm"} 3', lines)
+
+    def test_counter_escapes_label_values(self):
+        # Test that label values are escaped as the text format requires
+        counter = Counter("test_total", "Test counter.", ("action",), registry=self.registry)
+        counter.inc('say "hi"')
+        counter.inc('say "hi"', amount=2)
+
+        self.assertIn('test_total{action="say \\"hi\\""} 3', self.registry.render().splitlines())
+
+    def test_gauge_reads_function_when_rendering(self):
+        # Test that a gauge backed by a function shows its value at render time
+        queue = [1, 2]
+        gauge = Gauge("test_depth", "Test depth.", ("priority",), registry=self.registry)
+        gauge.set_function(lambda: {("0",): len(queue)})
+        queue.append(3)
+
+        lines = self.registry.render().splitlines()
+
+        self.assertIn("# TYPE test_depth gauge", lines)
+        self.assertIn('test_depth{priority="0"} 3', lines)
+
+    async def test_timed_records_sync_and_async_calls(self):
+        # Test that the decorator times plain functions and coroutines, including ones that raise
+        @timed("test", "sync")
+        def sync():
+            return 1
+
+        @timed("test", "async")
+        async def fails():
+            raise ValueError("boom")
+
+        sync_before, async_before = STAGE_SECONDS.count("test", "sync"), STAGE_SECONDS.count("test", "async")
+        self.assertEqual(sync(), 1)
+        with self.assertRaises(ValueError):
+            await fails()
+
+        self.assertEqual(STAGE_SECONDS.count("test", "sync"), sync_before + 1)
+        self.assertEqual(STAGE_SECONDS.count("test", "async"), async_before + 1)
+
+    def test_llm_usage_is_observed(self):
+        # Test that token usage recorded by the agent feeds the token histograms
+        agent = OpenAIAgent(client=MagicMock(), semaphore=asyncio.Semaphore(1))
+        before = LLM_TOKENS.count("prompt")
+
+        agent.record_usage(MagicMock(prompt_tokens=120, completion_tokens=30, prompt_tokens_details=None))
+
+        self.assertEqual(LLM_TOKENS.count("prompt"), before + 1)
+
+    async def test_tool_calls_are_counted_by_action(self):
+        # Test that tool calls are counted by action and result
+        async def run(tool_call):
+            if tool_call["action"] == "kick_user":
+                raise RuntimeError("missing permissions")
+
+        ok_before, error_before = TOOL_CALLS.get("send_dm", "ok"), TOOL_CALLS.get("kick_user", "error")
+        await ToolExecutor(run).execute([{"action": "send_dm", "args": {"user_id": "1"}}, {"action": "kick_user", "args": {"user_id": "2"}}])
+
+        self.assertEqual(TOOL_CALLS.get("send_dm", "ok"), ok_before + 1)
+        self.assertEqual(TOOL_CALLS.get("kick_user", "error"), error_before + 1)
+
+    async def test_http_endpoint_serves_text_format(self):
+        # Test that /metrics serves the registry in the Prometheus text format
+        Counter("test_requests_total", "Test requests.", registry=self.registry).inc()
+        runner = await start_http_server(0, registry=self.registry)
+        self.addAsyncCleanup(runner.cleanup)
+        port = runner.addresses[0][1]
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                body = await response.text()
+                content_type = response.headers["Content-Type"]
+
+        self.assertTrue(content_type.startswith("text/plain; version=0.0.4"))
+        self.assertIn("test_requests_total 1", body)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,21 +1,22 @@
+import asyncio
 import unittest
 from unittest.mock import MagicMock, patch, AsyncMock
 import json
 from discord import Message, Member, Guild, TextChannel, User
 from discord.ext import commands
-from moderation import Moderation, TOOLS
+from moderation import Moderation, TOOLS, normalize_tool_args
 from messages import Messages, SingleMessage, ModAction
-from agent import MistralAgent
+from agent import OpenAIAgent
 from discord_wrapper import DiscordWrapper
 
-class TestModeration(unittest.TestCase):
+class TestModeration(unittest.IsolatedAsyncioTestCase):
     def setUp(self):
         # Create mock objects
         self.mock_bot = MagicMock(spec=commands.Bot)
         
         # Create patches
         self.messages_patch = patch('moderation.Messages')
-        self.agent_patch = patch('moderation.MistralAgent')
+        self.agent_patch = patch('moderation.OpenAIAgent')
         self.discord_wrapper_patch = patch('moderation.DiscordWrapper')
         
         # Start patches
@@ -25,7 +26,7 @@ class TestModeration(unittest.TestCase):
         
         # Create mock instances
         self.mock_messages = MagicMock(spec=Messages)
-        self.mock_agent = MagicMock(spec=MistralAgent)
+        self.mock_agent = MagicMock(spec=OpenAIAgent)
         self.mock_discord_wrapper = MagicMock(spec=DiscordWrapper)
         
         # Set return values for the mock classes
@@ -107,8 +108,8 @@ class TestModeration(unittest.TestCase):
     async def test_run_tool_send_dm(self):
         # Test running the send_dm tool
         tool_call = {
-            "name": "send_dm",
-            "parameters": {
+            "action": "send_dm",
+            "args": {
                 "user_id": "123456789",
                 "message": "This is a test DM"
             }
@@ -124,8 +125,8 @@ class TestModeration(unittest.TestCase):
     async def test_run_tool_send_message(self):
         # Test running the send_message tool
         tool_call = {
-            "name": "send_message",
-            "parameters": {
+            "action": "send_message",
+            "args": {
                 "channel_id": "456789123",
                 "message": "This is a test message"
             }
@@ -141,8 +142,8 @@ class TestModeration(unittest.TestCase):
     async def test_run_tool_delete_message(self):
         # Test running the delete_message tool
         tool_call = {
-            "name": "delete_message",
-            "parameters": {
+            "action": "delete_message",
+            "args": {
                 "channel_id": "456789123",
                 "message_id": "987654321"
             }
@@ -158,26 +159,27 @@ class TestModeration(unittest.TestCase):
     async def test_run_tool_ban_user(self):
         # Test running the ban_user tool
         tool_call = {
-            "name": "ban_user",
-            "parameters": {
-                "guild_id": "789123456",
+            "action": "ban_user",
+            "args": {
+                "server_id": "789123456",
                 "user_id": "123456789"
             }
         }
         
         await self.moderation.run_tool(tool_call)
         
-        # Check that ban_user was called with the correct arguments
+        # Check that ban_user was called with the correct arguments and the ban was recorded
         self.mock_discord_wrapper.ban_user.assert_called_once_with(
             "789123456", "123456789"
         )
+        self.moderation.messages.add_mod_action.assert_called_once_with("ban_user", tool_call["args"], "123456789")
     
     async def test_run_tool_kick_user(self):
         # Test running the kick_user tool
         tool_call = {
-            "name": "kick_user",
-            "parameters": {
-                "guild_id": "789123456",
+            "action": "kick_user",
+            "args": {
+                "server_id": "789123456",
                 "user_id": "123456789"
             }
         }
@@ -192,9 +194,9 @@ class TestModeration(unittest.TestCase):
     async def test_run_tool_unban_user(self):
         # Test running the unban_user tool
         tool_call = {
-            "name": "unban_user",
-            "parameters": {
-                "guild_id": "789123456",
+            "action": "unban_user",
+            "args": {
+                "server_id": "789123456",
                 "user_id": "123456789"
             }
         }
@@ -207,44 +209,42 @@ class TestModeration(unittest.TestCase):
         )
     
     async def test_run_tool_unknown_tool(self):
-        # Test running an unknown tool
+        # Test that an unknown tool is rejected
         tool_call = {
-            "name": "unknown_tool",
-            "parameters": {}
+            "action": "unknown_tool",
+            "args": {}
         }
         
-        # This should not raise an exception
-        await self.moderation.run_tool(tool_call)
+        with self.assertRaises(ValueError):
+            await self.moderation.run_tool(tool_call)
     
-    @patch('moderation.format_discord_message')
-    async def test_moderate(self, mock_format_discord_message):
-        # Set up the mock format_discord_message function
-        mock_format_discord_message.return_value = "Formatted message"
-        
+    async def test_moderate(self):
         # Set up the mock agent's send_message method
         self.mock_agent.send_message.return_value = "Response with tool calls"
         
         # Set up the mock agent's process_tool_call method
         tool_call = {
-            "name": "send_message",
-            "parameters": {
+            "action": "send_message",
+            "args": {
                 "channel_id": "456789123",
                 "message": "This is a response message"
             }
         }
         self.mock_agent.process_tool_call.return_value = [tool_call]
+
+        # Admin messages are judged on their own, without the verdict cache or the batcher
+        self.mock_message.author = MagicMock(spec=Member)
+        self.mock_message.author.bot = False
+        self.mock_message.author.guild_permissions.administrator = True
+        self.moderation.get_message_context = AsyncMock(return_value="Message context")
+        self.moderation.build_system_prompt = MagicMock(return_value="System prompt")
         
         # Test moderating a message
-        await self.moderation.moderate(self.mock_message)
+        with patch('moderation.format_message', return_value="Formatted message"):
+            await self.moderation.moderate(self.mock_message)
         
         # Check that ensure_server_exists was called
-        self.mock_messages.ensure_server_exists.assert_called_once_with(self.mock_message)
-        
-        # Check that add_message was called
-        self.mock_messages.add_message.assert_called_once_with(self.mock_message)
-        
-        # Check that format_discord_message was called
-        mock_format_discord_message.assert_called_once_with(self.mock_message)
+        self.moderation.messages.ensure_server_exists.assert_called_once_with(self.mock_message)
         
         # Check that send_message was called with the correct arguments
         self.mock_agent.send_message.assert_called_once()
@@ -257,23 +257,23 @@ class TestModeration(unittest.TestCase):
             "456789123", "This is a response message"
         )
     
-    @patch('moderation.format_discord_message')
-    async def test_handle_user_conversation(self, mock_format_discord_message):
-        # Set up the mock format_discord_message function
-        mock_format_discord_message.return_value = "Formatted message"
-        
-        # Set up the mock agent's send_message method
-        self.mock_agent.send_message.return_value = "Response with tool calls"
-        
-        # Set up the mock agent's process_tool_call method
+    async def test_handle_user_conversation(self):
+        # Set up the mock agent's stream_tool_calls method
         tool_call = {
-            "name": "send_dm",
-            "parameters": {
+            "action": "send_dm",
+            "args": {
                 "user_id": "123456789",
                 "message": "This is a response DM"
             }
         }
-        self.mock_agent.process_tool_call.return_value = [tool_call]
+
+        async def stream_tool_calls(prompt, system_prompt):
+            yield tool_call
+
+        self.mock_agent.stream_tool_calls = MagicMock(side_effect=stream_tool_calls)
+        self.moderation.messages.load_user_history = AsyncMock()
+        self.moderation.messages.get_user_mod_actions = AsyncMock(return_value=[])
+        self.moderation.get_message_context = AsyncMock(return_value="DM conversation")
         
         # Create a DM message
         dm_message = MagicMock(spec=Message)
@@ -281,26 +281,99 @@ class TestModeration(unittest.TestCase):
         dm_message.content = "This is a test DM"
         dm_message.guild = None
         dm_message.author = self.mock_user
+        dm_message.author.bot = False
+        dm_message.author.mutual_guilds = []
         
         # Test handling a user conversation
         await self.moderation.handle_user_conversation(dm_message)
         
         # Check that add_message was called
-        self.mock_messages.add_message.assert_called_once_with(dm_message)
+        self.moderation.messages.add_message.assert_called_once_with(dm_message)
         
-        # Check that format_discord_message was called
-        mock_format_discord_message.assert_called_once_with(dm_message)
-        
-        # Check that send_message was called with the correct arguments
-        self.mock_agent.send_message.assert_called_once()
-        
-        # Check that process_tool_call was called with the correct arguments
-        self.mock_agent.process_tool_call.assert_called_once_with("Response with tool calls")
+        # Check that the conversation was sent to the agent
+        self.mock_agent.stream_tool_calls.assert_called_once()
+        self.assertIn("DM conversation", self.mock_agent.stream_tool_calls.call_args.args[0])
         
         # Check that run_tool was called with the correct arguments
         self.mock_discord_wrapper.send_dm.assert_called_once_with(
             "123456789", "This is a response DM"
         )
 
+    def test_map_tool_calls(self):
+        # Test mapping batched tool calls back to the messages they target
+        other_message = MagicMock(spec=Message)
+        other_message.id = "111111111"
+        other_message.author = MagicMock(spec=User)
+        other_message.author.id = "222222222"
+
+        self.moderation.messages.create_single_message.side_effect = lambda m: SingleMessage(
+            content=m.content, server_id="789123456", server_name="Test Server",
+            user_id=m.author.id, user_name="TestUser", channel_id="456789123",
+            channel_name="test-channel", message_id=m.id
+        )
+
+        tool_calls = [
+            {"message_id": "987654321", "action": "delete_message", "args": {"channel_id": "456789123", "message_id": "987654321"}},
+            {"action": "ban_user", "args": {"server_id": "789123456", "user_id": "222222222"}},
+            {"action": "send_message", "args": {"channel_id": "456789123", "message": "Hello"}},
+        ]
+
+        plan = self.moderation.map_tool_calls([self.mock_message, other_message], tool_calls)
+
+        # Check that each call landed under the message it targets
+        self.assertEqual([c["action"] for c in plan["987654321"]], ["delete_message"])
+        self.assertEqual([c["action"] for c in plan["111111111"]], ["ban_user"])
+        self.assertEqual([c["action"] for c in plan[None]], ["send_message"])
+
+        # Check that the target message's details were added to the args
+        self.assertEqual(plan["987654321"][0]["args"]["content"], "This is a test message")
+        self.assertEqual(plan["111111111"][0]["args"]["user_id"], "222222222")
+
+    def test_normalize_tool_args(self):
+        # Test that IDs from the LLM are normalized, and a bad one is rejected before any action runs
+        self.assertEqual(normalize_tool_args({"user_id": "<@!123>", "message": "Hi"}), {"user_id": "123", "message": "Hi"})
+        with self.assertRaises(ValueError):
+            normalize_tool_args({"server_id": "server", "user_id": "123"})
+
+    def test_record_deletion_uses_author(self):
+        # Test that a deletion is recorded against the deleted message's author, not the server
+        self.moderation.messages.channel_guilds = {"456789123": "789123456"}
+        buffered = MagicMock(author_id=123456789, author_name="TestUser", content="spam")
+        self.moderation.message_buffer.get = MagicMock(return_value=buffered)
+
+        self.moderation.record_deletion({"channel_id": "456789123", "message_id": "987654321"})
+
+        action, data, user_id = self.moderation.messages.add_mod_action.call_args.args
+        self.assertEqual((action, user_id), ("delete_message", "123456789"))
+        self.assertEqual((data["server_id"], data["content"]), ("789123456", "spam"))
+
+        # Without a known author nothing is recorded
+        self.moderation.messages.add_mod_action.reset_mock()
+        self.moderation.message_buffer.get = MagicMock(return_value=None)
+        self.moderation.record_deletion({"channel_id": "456789123", "message_id": "1"})
+        self.moderation.messages.add_mod_action.assert_not_called()
+
+    async def test_get_unread_messages_fetches_after_last_read(self):
+        # Test that only the messages after the last read one are requested, oldest first, up to the command
+        self.moderation.messages.get_last_read = AsyncMock(return_value=1000)
+        history = [MagicMock(spec=Message, id=message_id) for message_id in (1001, 1002, 1003)]
+        self.mock_message.id = 1002
+        fetched = []
+
+        async def channel_history(**kwargs):
+            self.history_kwargs = kwargs
+            for message in history:
+                fetched.append(message)
+                yield message
+
+        self.mock_message.channel.history = channel_history
+
+        result = await self.moderation.get_unread_messages("123456789", "456789123", self.mock_message)
+
+        self.assertEqual(result, history[:2])
+        self.assertEqual(fetched, history[:2])
+        self.assertEqual(self.history_kwargs["after"].id, 1000)
+        self.assertTrue(self.history_kwargs["oldest_first"])
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
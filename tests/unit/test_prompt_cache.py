@@ -0,0 +1,59 @@
+import unittest
+from unittest.mock import MagicMock
+from messages import Messages, Server
+from prompt_cache import PromptCache
+
+class TestPromptCache(unittest.TestCase):
+    def setUp(self):
+        # Create a server and a cache with a counting renderer
+        self.messages = Messages(storage=MagicMock(indexed=False))
+        self.messages.servers["789123456"] = Server(
+            id="789123456",
+            name="Test Server",
+            rules="No spam.",
+            recent_actions=[]
+        )
+        self.server = self.messages.servers["789123456"]
+        self.render = MagicMock(side_effect=lambda server: f"Rules: {server.rules} ({len(server.recent_actions)} actions)")
+        self.cache = PromptCache(self.render)
+
+    def test_prompt_is_reused_until_server_changes(self):
+        # Test that the prompt is rendered once while the server is unchanged
+        first = self.cache.system_prompt(self.server, " suffix")
+        second = self.cache.system_prompt(self.server, " suffix")
+
+        self.assertEqual(first, "Rules: No spam. (0 actions) suffix")
+        self.assertIs(first, second)
+        self.render.assert_called_once()
+
+    def test_rules_update_rebuilds_prompt(self):
+        # Test that changing the rules renders the prompt again
+        self.cache.system_prompt(self.server)
+
+        self.messages.update_server_rules("789123456", "No links.")
+
+        self.assertEqual(self.cache.system_prompt(self.server), "Rules: No links. (0 actions)")
+        self.assertEqual(self.cache.get(self.server).rules_block, "Test Server: No links.")
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_invalidate_drops_prompt(self):
+        # Test that an invalidated server's prompt and variants are dropped
+        self.cache.system_prompt(self.server, " suffix")
+
+        self.cache.invalidate(789123456)
+
+        self.assertEqual(self.cache.stats()["servers"], 0)
+        self.cache.system_prompt(self.server, " suffix")
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_mod_action_rebuilds_prompt(self):
+        # Test that a new moderation action renders the prompt again
+        self.cache.system_prompt(self.server)
+
+        self.messages.add_mod_action("delete_message", {"server_id": "789123456", "content": "spam"}, "123456789")
+
+        self.assertEqual(self.cache.system_prompt(self.server), "Rules: No spam. (1 actions)")
+        self.assertEqual(self.cache.stats()["builds"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import asyncio
+import unittest
+from scheduler import ActionScheduler, TokenBucket
+
+class TestTokenBucket(unittest.TestCase):
+    def test_delay_after_burst(self):
+        # Test that an empty bucket reports how long until it refills one token
+        bucket = TokenBucket(capacity=2, rate=1.0)
+        bucket.take(bucket.updated)
+        bucket.take(bucket.updated)
+
+        self.assertAlmostEqual(bucket.delay(bucket.updated), 1.0)
+        self.assertEqual(bucket.delay(bucket.updated + 1.0), 0.0)
+        self.assertTrue(bucket.is_full(bucket.updated + 1.0))
+
+class TestActionScheduler(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Create a scheduler that starts one action at a time so the order is observable
+        self.scheduler = ActionScheduler(max_in_flight=1, global_rate=1000)
+        self.order = []
+
+    async def action(self, name):
+        self.order.append(name)
+        await asyncio.sleep(0)
+        return name
+
+    async def test_enforcement_runs_before_chatter(self):
+        # Test that a ban queued after DMs is started before them
+        dms = [asyncio.create_task(self.scheduler.run("send_dm", i, self.action, f"dm {i}")) for i in range(3)]
+        await asyncio.sleep(0)
+        ban = self.scheduler.run("ban_user", "789123456", self.action, "ban")
+
+        results = await asyncio.gather(ban, *dms)
+
+        self.assertEqual(results[0], "ban")
+        self.assertLess(self.order.index("ban"), self.order.index("dm 2"))
+
+    async def test_reserved_slots_are_kept_for_enforcement(self):
+        # Test that DMs stuck in flight cannot take the slots a ban needs
+        scheduler = ActionScheduler(max_in_flight=3, global_rate=1000, reserved=1)
+        release = asyncio.Event()
+
+        async def slow_dm(i):
+            await release.wait()
+            return i
+
+        dms = [asyncio.create_task(scheduler.run("send_dm", i, slow_dm, i)) for i in range(5)]
+        await asyncio.sleep(0.01)
+        self.assertEqual(scheduler.stats()["in_flight"], 2)
+
+        self.assertEqual(await asyncio.wait_for(scheduler.run("ban_user", "789123456", self.action, "ban"), 1), "ban")
+        release.set()
+        self.assertEqual(await asyncio.gather(*dms), list(range(5)))
+
+    async def test_refilled_buckets_are_evicted(self):
+        # Test that a route's bucket is dropped once it has refilled
+        scheduler = ActionScheduler(max_in_flight=10, global_rate=1000, sweep_interval=0)
+        await scheduler.run("send_dm", "1", self.action, "dm")
+        self.assertIn(("send_dm", "1"), scheduler.buckets)
+
+        scheduler.buckets[("send_dm", "1")].updated -= 10
+        await scheduler.run("send_dm", "2", self.action, "dm")
+
+        self.assertNotIn(("send_dm", "1"), scheduler.buckets)
+        self.assertEqual(scheduler.stats()["evicted_buckets"], 1)
+
+    async def test_route_limit_defers_without_blocking_other_routes(self):
+        # Test that an exhausted route waits while other routes keep running
+        scheduler = ActionScheduler(max_in_flight=10, global_rate=1000)
+        scheduler._bucket(("send_message", "1")).tokens = 0
+
+        blocked = asyncio.create_task(scheduler.run("send_message", "1", self.action, "blocked"))
+        await scheduler.run("send_message", "2", self.action, "free")
+
+        self.assertEqual(self.order, ["free"])
+        self.assertFalse(blocked.done())
+        self.assertEqual(scheduler.stats()["queue_depth"][2], 1)
+        blocked.cancel()
+
+    async def test_errors_are_returned_to_caller(self):
+        # Test that a failing action raises in the caller and frees its slot
+        async def fail():
+            raise RuntimeError("Discord error")
+
+        with self.assertRaises(RuntimeError):
+            await self.scheduler.run("delete_message", "1", fail)
+
+        self.assertEqual(await self.scheduler.run("delete_message", "1", self.action, "next"), "next")
+        self.assertEqual(self.scheduler.stats()["in_flight"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+from streaming import StreamingReply, split_message, STREAM_CURSOR
+
+class TestSplitMessage(unittest.TestCase):
+    def test_short_text_is_one_part(self):
+        # Test that text within the limit is not split
+        self.assertEqual(split_message("hello", limit=10), ["hello"])
+
+    def test_splits_on_line_then_word_breaks(self):
+        # Test that long text is split at the last line or word break within the limit
+        self.assertEqual(split_message("first line\nsecond line", limit=15), ["first line", "second line"])
+        self.assertEqual(split_message("one two three", limit=8), ["one two", "three"])
+        self.assertEqual(split_message("abcdefghij", limit=4), ["abcd", "efgh", "ij"])
+
+class TestStreamingReply(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Create a destination whose sent messages can be edited
+        self.sent = []
+
+        async def send(content):
+            message = MagicMock()
+            message.content = content
+            message.edit = AsyncMock()
+            message.delete = AsyncMock()
+            self.sent.append(message)
+            return message
+
+        self.destination = MagicMock()
+        self.destination.send = send
+
+    async def _deltas(self, *deltas):
+        for delta in deltas:
+            yield delta
+
+    async def test_reply_is_posted_then_edited(self):
+        # Test that the header is posted at once and the final text replaces it
+        reply = StreamingReply(self.destination, interval=0)
+        await reply.start("Summary:\n")
+
+        text = await reply.stream("Summary:\n", self._deltas("All ", "good."))
+
+        self.assertEqual(text, "Summary:\nAll good.")
+        self.assertEqual(self.sent[0].content, "Summary:\n" + STREAM_CURSOR)
+        self.sent[0].edit.assert_awaited_with(content="Summary:\nAll good.")
+
+    async def test_edits_are_throttled(self):
+        # Test that no edits are sent between intervals, only the final one
+        reply = StreamingReply(self.destination, interval=60)
+        await reply.start("")
+
+        await reply.stream("", self._deltas(*["word "] * 20))
+
+        self.assertEqual(self.sent[0].edit.await_count, 1)
+
+    async def test_long_reply_continues_in_new_message(self):
+        # Test that text past Discord's limit is sent as a follow-up message
+        reply = StreamingReply(self.destination, interval=0)
+        await reply.start("")
+
+        await reply.stream("", self._deltas("a" * 1990, " " + "b" * 30))
+
+        self.assertEqual(len(self.sent), 2)
+        self.sent[0].edit.assert_awaited_with(content="a" * 1990)
+        self.sent[1].edit.assert_awaited_with(content="b" * 30)
+
+    async def test_part_only_needed_for_the_cursor_is_deleted(self):
+        # Test that a follow-up message holding just the cursor is removed once the final text fits
+        reply = StreamingReply(self.destination, interval=0)
+        await reply.start("")
+
+        await reply.stream("", self._deltas("a" * 1999))
+
+        self.assertEqual(len(self.sent), 2)
+        self.sent[0].edit.assert_awaited_with(content="a" * 1999)
+        self.sent[1].delete.assert_awaited_once()
+        self.assertEqual(reply.messages, [self.sent[0]])
+
+if __name__ == "__main__":
+    unittest.main()
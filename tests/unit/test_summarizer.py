@@ -0,0 +1,66 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+from messages import SingleMessage
+from summarizer import Summarizer, CHUNK_PROMPT, SUMMARY_PROMPT
+
+class TestSummarizer(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Create a Summarizer with a mock agent and small chunks
+        self.mock_agent = MagicMock()
+        self.mock_agent.send_message = AsyncMock(side_effect=self._fake_summary)
+        self.summarizer = Summarizer(agent=self.mock_agent, chunk_tokens=50, token_budget=1000, max_concurrency=2)
+        self.in_flight = 0
+        self.peak = 0
+
+    async def _fake_summary(self, prompt):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return f"summary {len(prompt)}"
+
+    def _messages(self, count):
+        return [
+            SingleMessage(content=f"message number {i} with some words", server_id="789123456", server_name="Test Server",
+                          user_id="123456789", user_name="TestUser", message_id=str(i), channel_id="456789123", channel_name="test-channel")
+            for i in range(count)
+        ]
+
+    def test_chunks_are_token_bounded_and_ordered(self):
+        # Test that the transcript is split in order into chunks within the token limit
+        chunks = self.summarizer.chunk_transcript(self._messages(20))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(chunks[0].startswith("TestUser: message number 0 "))
+        self.assertTrue(chunks[-1].endswith("message number 19 with some words"))
+
+    def test_budget_keeps_newest_messages(self):
+        # Test that messages past the token budget are dropped from the oldest end
+        self.summarizer.token_budget = 30
+
+        transcript = "\n".join(self.summarizer.chunk_transcript(self._messages(20)))
+
+        self.assertIn("message number 19 ", transcript)
+        self.assertNotIn("message number 0 ", transcript)
+
+    async def test_short_transcript_is_summarized_in_one_request(self):
+        # Test that a short conversation needs a single request
+        await self.summarizer.summarize_messages(self._messages(2))
+
+        self.mock_agent.send_message.assert_awaited_once()
+        self.assertTrue(self.mock_agent.send_message.call_args.args[0].startswith(SUMMARY_PROMPT.split("{")[0]))
+
+    async def test_long_transcript_is_map_reduced_concurrently(self):
+        # Test that chunks are summarized concurrently within the limit before the final request
+        chunk_count = len(self.summarizer.chunk_transcript(self._messages(20)))
+
+        summary = await self.summarizer.summarize_messages(self._messages(20))
+
+        prompts = [c.args[0] for c in self.mock_agent.send_message.call_args_list]
+        self.assertEqual(sum(p.startswith(CHUNK_PROMPT.split("{")[0]) for p in prompts), chunk_count)
+        self.assertEqual(self.peak, 2)
+        self.assertTrue(summary.startswith("summary"))
+
+if __name__ == "__main__":
+    unittest.main()
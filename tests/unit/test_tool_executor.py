@@ -0,0 +1,87 @@
+import asyncio
+import unittest
+from tool_executor import ToolExecutor
+
+class TestToolExecutor(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Create a fake tool runner that records the order calls start and finish in
+        self.started = []
+        self.finished = []
+        self.in_flight = 0
+        self.peak = 0
+        self.executor = ToolExecutor(self.fake_run_tool, max_per_guild=4)
+
+    async def fake_run_tool(self, tool_call):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        self.started.append(tool_call["action"])
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        if tool_call["args"].get("fail"):
+            raise RuntimeError("Discord error")
+        self.finished.append(tool_call["action"])
+
+    def _call(self, action, **args):
+        return {"action": action, "args": {"server_id": "789123456", **args}}
+
+    async def test_dm_is_sent_before_ban(self):
+        # Test that a DM to a user runs before that user is banned, even if listed after
+        await self.executor.execute([self._call("ban_user", user_id="1"), self._call("send_dm", user_id="1", message="Bye")])
+
+        self.assertEqual(self.finished, ["send_dm", "ban_user"])
+        self.assertEqual(self.peak, 1)
+
+    async def test_independent_calls_run_concurrently(self):
+        # Test that calls about different targets overlap
+        await self.executor.execute([
+            self._call("delete_message", channel_id="2", message_id="10"),
+            self._call("send_dm", user_id="1", message="Removed"),
+            self._call("kick_user", user_id="3"),
+        ])
+
+        self.assertEqual(self.peak, 3)
+
+    async def test_per_guild_fan_out_is_bounded(self):
+        # Test that no more than max_per_guild calls run at once in a guild
+        executor = ToolExecutor(self.fake_run_tool, max_per_guild=2)
+
+        await executor.execute([self._call("send_message", channel_id=str(i), message="Hi") for i in range(6)])
+
+        self.assertEqual(self.peak, 2)
+
+    async def test_dm_calls_are_not_limited_as_one_guild(self):
+        # Test that DMs to different users, outside any guild, do not share one guild's limit
+        executor = ToolExecutor(self.fake_run_tool, max_per_guild=2)
+
+        await asyncio.gather(*[executor.execute([{"action": "send_dm", "args": {"user_id": str(i), "message": "Hi"}}]) for i in range(6)])
+
+        self.assertEqual(self.peak, 6)
+        self.assertEqual(executor.semaphores, {})
+
+    async def test_errors_are_isolated(self):
+        # Test that a failing call does not stop the calls after it
+        results = await self.executor.execute([
+            self._call("send_dm", user_id="1", message="Bye", fail=True),
+            self._call("ban_user", user_id="1"),
+        ])
+
+        self.assertEqual([r.ok for r in results], [False, True])
+        self.assertIsInstance(results[0].error, RuntimeError)
+        self.assertEqual(self.executor.stats()["send_dm"]["errors"], 1)
+        self.assertEqual(self.executor.stats()["ban_user"]["calls"], 1)
+
+    async def test_execute_stream_starts_calls_as_they_arrive(self):
+        # Test that streamed calls start before the stream ends, in order per user
+        async def stream():
+            yield self._call("send_dm", user_id="1", message="Bye")
+            await asyncio.sleep(0.005)
+            self.assertEqual(self.started, ["send_dm"])
+            yield self._call("ban_user", user_id="1")
+
+        results = await self.executor.execute_stream(stream())
+
+        self.assertEqual(self.finished, ["send_dm", "ban_user"])
+        self.assertTrue(all(r.ok for r in results))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -69,5 +69,10 @@ class TestUtils(unittest.TestCase):
         expected_output = "delete (user id: 123456789, message id: 987654321) in test-channel (channel id: 456789123) in server Test Server (server id: 789123456):\nThis is a test message"
         self.assertEqual(format_mod_action(self.mod_action), expected_output)
 
+    def test_format_mod_action_with_timestamp(self):
+        # Test that the time an action was taken is shown when known
+        action = ModAction(action="delete", message=self.mod_action.message, timestamp=0.5 * 86400)
+        self.assertTrue(format_mod_action(action).startswith("delete at 1970-01-01 12:00 UTC (user id: 123456789,"))
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
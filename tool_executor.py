@@ -0,0 +1,146 @@
+import os
+import time
+import asyncio
+import contextlib
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterable, Awaitable, Callable, Dict, List, Optional
+
+from metrics import TOOL_CALLS, TOOL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Tool calls run at once against a single guild
+TOOL_MAX_CONCURRENCY_PER_GUILD = int(os.getenv("TOOL_MAX_CONCURRENCY_PER_GUILD", "4"))
+
+# Actions that remove the user from the server; a DM to the same user must be sent first
+REMOVAL_ACTIONS = {"ban_user", "kick_user"}
+# Actions not counted against the per-guild limit: DiscordWrapper queues deletions and sends them as bulk deletes
+UNLIMITED_ACTIONS = {"delete_message"}
+
+@dataclass(slots=True)
+class ToolResult:
+    tool_call: dict
+    ok: bool
+    duration: float  # Seconds spent running the call, excluding time queued
+    error: Optional[Exception] = None
+
+def dependency_key(tool_call: dict):
+    """Return the key of the calls that must run in order with this one, or None if it can run on its own.
+
+    Calls about the same user run in order (a DM before a kick or ban), as do
+    messages sent to the same channel and rules updates to the same server."""
+    action = tool_call.get("action")
+    args = tool_call.get("args", {})
+    if action in ("send_dm", "ban_user", "kick_user", "unban_user"):
+        return ("user", str(args.get("user_id")))
+    if action == "send_message":
+        return ("channel", str(args.get("channel_id")))
+    if action == "update_server_rules":
+        return ("rules", str(args.get("server_id")))
+    return None
+
+class ToolExecutor:
+    """Runs the tool calls of one LLM response concurrently where that is safe.
+
+    Calls are grouped by `dependency_key`; groups run concurrently while the
+    calls inside a group run one after another, with DMs moved ahead of kicks
+    and bans of the same user. At most `max_per_guild` calls run at once per
+    guild; calls made outside a guild, from DMs, are not limited here. A failing call is logged and does not stop the others."""
+
+    def __init__(self, run: Callable[[dict], Awaitable[object]], max_per_guild: int = TOOL_MAX_CONCURRENCY_PER_GUILD):
+        self.run = run
+        self.max_per_guild = max_per_guild
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}  # Guild ID -> semaphore
+        self.calls: Dict[str, int] = {}  # Action -> calls run
+        self.errors: Dict[str, int] = {}  # Action -> calls failed
+        self.total_time: Dict[str, float] = {}  # Action -> seconds spent
+
+    def plan(self, tool_calls: List[dict]) -> List[List[dict]]:
+        """Split tool calls into groups that may run concurrently, each in the order it must run."""
+        groups: Dict[object, List[dict]] = {}
+        independent = []
+        for tool_call in tool_calls:
+            key = dependency_key(tool_call)
+            if key is None:
+                independent.append([tool_call])
+            else:
+                groups.setdefault(key, []).append(tool_call)
+
+        for key, group in groups.items():
+            if key[0] == "user":
+                # Stable sort keeps the model's order otherwise
+                group.sort(key=lambda c: c.get("action") in REMOVAL_ACTIONS)
+        return list(groups.values()) + independent
+
+    async def execute(self, tool_calls: List[dict], guild_id=None) -> List[ToolResult]:
+        """Run `tool_calls` and return their results in the order they were given."""
+        results: Dict[int, ToolResult] = {}
+        index = {id(tool_call): i for i, tool_call in enumerate(tool_calls)}
+
+        async def run_group(group: List[dict]):
+            for tool_call in group:
+                results[index[id(tool_call)]] = await self._run_one(tool_call, guild_id)
+
+        await asyncio.gather(*[run_group(group) for group in self.plan(tool_calls)])
+        return [results[i] for i in range(len(tool_calls))]
+
+    async def execute_stream(self, tool_calls: AsyncIterable[dict], guild_id=None) -> List[ToolResult]:
+        """Start each tool call as soon as it arrives, e.g. while the rest of the response is still generated.
+
+        Calls sharing a dependency key run in the order they arrive, since a
+        later call cannot be moved ahead of one that has already started."""
+        tasks: List[asyncio.Task] = []
+        last: Dict[object, asyncio.Task] = {}  # Dependency key -> the latest call started for it
+
+        async def run_after(previous: Optional[asyncio.Task], tool_call: dict) -> ToolResult:
+            if previous is not None:
+                await asyncio.wait([previous])
+            return await self._run_one(tool_call, guild_id)
+
+        async for tool_call in tool_calls:
+            key = dependency_key(tool_call)
+            task = asyncio.create_task(run_after(last.get(key) if key is not None else None, tool_call))
+            if key is not None:
+                last[key] = task
+            tasks.append(task)
+        return list(await asyncio.gather(*tasks))
+
+    async def _run_one(self, tool_call: dict, guild_id) -> ToolResult:
+        action = tool_call.get("action")
+        guild = tool_call.get("args", {}).get("server_id") or guild_id
+        if action in UNLIMITED_ACTIONS or guild is None:
+            # Calls from DMs belong to no guild; the scheduler still limits them per user and channel
+            semaphore = contextlib.nullcontext()
+        else:
+            semaphore = self.semaphores.get(str(guild))
+            if semaphore is None:
+                semaphore = self.semaphores[str(guild)] = asyncio.Semaphore(self.max_per_guild)
+
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await self.run(tool_call)
+                result = ToolResult(tool_call, ok=True, duration=time.perf_counter() - start)
+            except Exception as e:
+                result = ToolResult(tool_call, ok=False, duration=time.perf_counter() - start, error=e)
+                logger.error(f"Error running tool call {action}: {e}")
+
+        self.calls[action] = self.calls.get(action, 0) + 1
+        self.total_time[action] = self.total_time.get(action, 0.0) + result.duration
+        if not result.ok:
+            self.errors[action] = self.errors.get(action, 0) + 1
+        TOOL_CALLS.inc(str(action), "ok" if result.ok else "error")
+        TOOL_SECONDS.observe(result.duration, str(action))
+        logger.info(f"Tool call {action} {'succeeded' if result.ok else 'failed'} in {result.duration * 1000:.1f}ms")
+        return result
+
+    def stats(self) -> dict:
+        return {
+            action: {
+                "calls": count,
+                "errors": self.errors.get(action, 0),
+                "avg_ms": self.total_time[action] / count * 1000,
+            }
+            for action, count in self.calls.items()
+        }
@@ -1,5 +1,30 @@
+from datetime import datetime, timezone
+from typing import Optional
 from discord import Message
 from messages import SingleMessage, ModAction
+from agent import OPENAI_MODEL
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+
+def count_tokens(text: str) -> int:
+    """Count tokens locally with tiktoken, a declared dependency.
+
+    Without it, e.g. in a stripped-down environment, roughly four characters
+    count as a token, so token budgets are only approximate."""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            try:
+                _encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+            except KeyError:
+                _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
 
 def format_message(message: Message) -> str:
     return f"{message.author.name} (user id: {message.author.id}, message id: {message.id}) in {message.channel.name} (channel id: {message.channel.id}) in server {message.guild.name} (server id: {message.guild.id}):\n{message.content}"
@@ -15,4 +40,10 @@ def format_discord_message(message: Message) -> str:
         return f"{message.author.name} (user id: {message.author.id}, message id: {message.id}) in DM:\n{message.content}"
 
 def format_mod_action(action: ModAction) -> str:
-    return f"{action.action} (user id: {action.message.user_id}, message id: {action.message.message_id}) in {action.message.channel_name} (channel id: {action.message.channel_id}) in server {action.message.server_name} (server id: {action.message.server_id}):\n{action.message.content}"
+    taken = f" at {datetime.fromtimestamp(action.timestamp, timezone.utc):%Y-%m-%d %H:%M} UTC" if action.timestamp else ""
+    return f"{action.action}{taken} (user id: {action.message.user_id}, message id: {action.message.message_id}) in {action.message.channel_name} (channel id: {action.message.channel_id}) in server {action.message.server_name} (server id: {action.message.server_id}):\n{action.message.content}"
+
+def format_compact_message(message_id: int, author_name: str, author_id: int, content: str, reference_id: Optional[int] = None) -> str:
+    """Format a message as one transcript line, without the channel and server details"""
+    reply = f" -> {reference_id}" if reference_id else ""
+    return f"[{message_id}] {author_name} ({author_id}){reply}: {' '.join(content.split())}"